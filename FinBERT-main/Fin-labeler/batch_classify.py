@@ -0,0 +1,383 @@
+"""
+Streaming file-to-file batch classification with SentimentInferenceEngine.
+
+The input (CSV, JSONL or Parquet) is read in chunks of chunk_size rows, each
+chunk is classified in batches and written as one Parquet part file next to a
+progress file recording the rows committed so far. Memory use depends on the
+chunk size only, and an interrupted run resumes after the last committed chunk.
+The output directory can be read back with pandas.read_parquet(output_dir).
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Constants
+INPUT_FORMATS = ('csv', 'jsonl', 'parquet')
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_BATCH_SIZE = 64
+# Leading underscore: Parquet dataset readers skip the file
+PROGRESS_FILE = '_progress.json'
+PART_TEMPLATE = 'part-{:05d}.parquet'
+
+
+def detect_format(path: Union[str, Path]) -> str:
+    """
+    Infer the input format from the file extension.
+
+    Raises:
+        ValueError: If the extension is not .csv, .jsonl/.json or .parquet
+    """
+    suffix = Path(path).suffix.lower()
+    formats = {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl', '.parquet': 'parquet'}
+    if suffix not in formats:
+        raise ValueError(f"Cannot infer the format of '{path}', pass one of {INPUT_FORMATS}")
+    return formats[suffix]
+
+
+def _json_text(value) -> str:
+    """A JSON value as the text a CSV cell would hold: strings as is, '' for null."""
+    if value is None:
+        return ''
+    return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+
+def _iter_jsonl_chunks(path: Union[str, Path], columns: List[str], chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Read the given columns of a JSONL file as strings, without pandas type inference.
+
+    Raises:
+        ValueError: If a column is missing from every record of the first chunk
+    """
+    with open(path, encoding='utf-8') as f:
+        lines = (line for line in f if line.strip())
+        first = True
+        while True:
+            records = [json.loads(line) for line in itertools.islice(lines, chunk_size)]
+            if not records:
+                return
+            if first:
+                missing = [column for column in columns if not any(column in record for record in records)]
+                if missing:
+                    raise ValueError(f"Columns {missing} not found in '{path}'")
+                first = False
+            yield pd.DataFrame({
+                column: [_json_text(record.get(column)) for record in records] for column in columns
+            })
+
+
+def iter_input_chunks(
+    path: Union[str, Path],
+    columns: List[str],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    input_format: Optional[str] = None,
+    skip_rows: int = 0
+) -> Iterator[pd.DataFrame]:
+    """
+    Read the given columns of a CSV, JSONL or Parquet file in chunks.
+
+    Args:
+        path: Input file
+        columns: Columns to keep
+        chunk_size: Rows per chunk
+        input_format: One of INPUT_FORMATS (inferred from the extension if omitted)
+        skip_rows: Number of leading data rows to skip (rows already committed)
+
+    CSV and JSONL columns are read as strings, with '' for empty or null
+    values, so ids such as zero-padded stock codes keep their exact text.
+    Parquet columns keep their stored types.
+
+    Yields:
+        DataFrames of at most chunk_size rows, in file order
+    """
+    input_format = input_format or detect_format(path)
+    if input_format not in INPUT_FORMATS:
+        raise ValueError(f"Unknown input format '{input_format}', expected one of {INPUT_FORMATS}")
+
+    if input_format == 'csv':
+        # skiprows keeps the header line and drops the committed rows while parsing
+        chunks = pd.read_csv(
+            path, usecols=columns, chunksize=chunk_size, skiprows=range(1, skip_rows + 1),
+            dtype=str, keep_default_na=False
+        )
+        skip_rows = 0
+    elif input_format == 'jsonl':
+        chunks = _iter_jsonl_chunks(path, columns, chunk_size)
+    else:
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        chunks = (
+            batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns)
+        )
+
+    for chunk in chunks:
+        if skip_rows >= len(chunk):
+            skip_rows -= len(chunk)
+            continue
+        if skip_rows:
+            chunk = chunk.iloc[skip_rows:]
+            skip_rows = 0
+        yield chunk
+
+
+class PartitionedParquetWriter:
+    """
+    Directory of Parquet part files plus a progress file.
+
+    Each part is written to a temporary file and renamed into place before the
+    progress file is updated (also by rename), so a crash never leaves a
+    partial part behind and `committed_rows` always matches the parts on disk.
+    """
+
+    def __init__(self, output_dir: Union[str, Path], settings: Dict, overwrite: bool = False):
+        """
+        Open or create the output directory.
+
+        Args:
+            output_dir: Directory holding the part files
+            settings: Run settings stored with the progress; a resumed run must match them
+            overwrite: Discard existing parts instead of resuming
+
+        Raises:
+            ValueError: If existing output was written with different settings
+        """
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.progress_path = self.output_dir / PROGRESS_FILE
+        self.settings = settings
+
+        if overwrite:
+            for part in self.output_dir.glob('part-*.parquet'):
+                part.unlink()
+            self.progress_path.unlink(missing_ok=True)
+
+        self.committed_rows = 0
+        self.num_parts = 0
+        if self.progress_path.exists():
+            progress = json.loads(self.progress_path.read_text(encoding='utf-8'))
+            if progress['settings'] != settings:
+                raise ValueError(
+                    f"{self.output_dir} was written with settings {progress['settings']}, "
+                    f"not {settings}; pass overwrite=True (--overwrite) to start over"
+                )
+            self.committed_rows = progress['committed_rows']
+            self.num_parts = progress['num_parts']
+        # Parts past the committed count come from a run killed between the two renames
+        for part in self.output_dir.glob('part-*.parquet'):
+            if int(part.stem.split('-')[1]) >= self.num_parts:
+                part.unlink()
+
+    def write(self, table) -> None:
+        """Commit one pyarrow Table as the next part."""
+        import pyarrow.parquet as pq
+
+        part_path = self.output_dir / PART_TEMPLATE.format(self.num_parts)
+        tmp_path = part_path.with_suffix('.parquet.tmp')
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, part_path)
+
+        self.num_parts += 1
+        self.committed_rows += table.num_rows
+        progress = {
+            'committed_rows': self.committed_rows,
+            'num_parts': self.num_parts,
+            'settings': self.settings,
+        }
+        tmp_progress = self.progress_path.with_suffix('.json.tmp')
+        tmp_progress.write_text(json.dumps(progress, ensure_ascii=False, indent=2), encoding='utf-8')
+        os.replace(tmp_progress, self.progress_path)
+
+
+def classify_chunk(engine, texts: List[str], batch_size: int, return_cls: bool) -> Dict[str, np.ndarray]:
+    """
+    Classify the texts of one chunk.
+
+    Texts are batched in order of length to limit padding and the results are
+    put back in input order. Empty or missing texts are not sent to the model;
+    they get label id -1 and NaN probabilities (and CLS vectors).
+
+    Returns:
+        {'label_id': (n,) int64, 'probs': (n, num_labels) float32, 'cls': (n, hidden) float32 if return_cls}
+    """
+    num_labels = len(engine.id2label)
+    label_ids = np.full(len(texts), -1, dtype=np.int64)
+    probs = np.full((len(texts), num_labels), np.nan, dtype=np.float32)
+    cls_vectors = np.full((len(texts), engine.hidden_size), np.nan, dtype=np.float32) if return_cls else None
+    layers = [engine.hidden_layer] if return_cls else []
+
+    valid = [i for i, text in enumerate(texts) if isinstance(text, str) and text.strip()]
+    order = sorted(valid, key=lambda i: len(texts[i]))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        result = engine.infer_batch([texts[i] for i in batch], layers=layers)
+        label_ids[batch] = result.label_ids
+        probs[batch] = result.probs
+        if return_cls:
+            cls_vectors[batch] = result.cls_vectors[engine.hidden_layer]
+
+    outputs = {'label_id': label_ids, 'probs': probs}
+    if return_cls:
+        outputs['cls'] = cls_vectors
+    return outputs
+
+
+def build_table(
+    chunk: pd.DataFrame,
+    first_row: int,
+    outputs: Dict[str, np.ndarray],
+    label_names: List[str],
+    id_column: Optional[str] = None
+):
+    """
+    Assemble the output columns of one chunk as a pyarrow Table.
+
+    Columns: row (position in the input file), the id column if given, label
+    ('' for empty texts), prob_<label> per class and, with CLS vectors, cls as
+    a fixed-size list of float32. Every column is built from the numpy
+    buffers, without per-row Python objects.
+    """
+    import pyarrow as pa
+
+    columns = {'row': pa.array(np.arange(first_row, first_row + len(chunk), dtype=np.int64))}
+    if id_column:
+        columns[id_column] = pa.array(chunk[id_column].to_numpy(), from_pandas=True)
+    # Label id -1 (empty text) points at an extra '' entry of the dictionary
+    codes = np.where(outputs['label_id'] < 0, len(label_names), outputs['label_id']).astype(np.int32)
+    columns['label'] = pa.DictionaryArray.from_arrays(
+        pa.array(codes), pa.array(list(label_names) + [''], type=pa.string())
+    ).cast(pa.string())
+    for name, column in zip(label_names, np.ascontiguousarray(outputs['probs'].T)):
+        columns[f'prob_{name}'] = pa.array(column)
+    if 'cls' in outputs:
+        vectors = outputs['cls']
+        columns['cls'] = pa.FixedSizeListArray.from_arrays(
+            pa.array(vectors.reshape(-1), type=pa.float32()), vectors.shape[1]
+        )
+    return pa.table(columns)
+
+
+def run_batch_classification(
+    engine,
+    input_path: Union[str, Path],
+    output_dir: Union[str, Path],
+    text_column: str = 'text',
+    id_column: Optional[str] = None,
+    input_format: Optional[str] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    return_cls: bool = False,
+    overwrite: bool = False
+) -> int:
+    """
+    Classify every row of an input file into a Parquet output directory.
+
+    Args:
+        engine: SentimentInferenceEngine
+        input_path: CSV, JSONL or Parquet file
+        output_dir: Output directory (resumed if it holds a matching run)
+        text_column: Column with the texts to classify
+        id_column: Optional column copied to the output
+        input_format: One of INPUT_FORMATS (inferred from the extension if omitted)
+        chunk_size: Rows read, classified and committed at a time
+        batch_size: Texts per forward pass
+        return_cls: Also write the CLS vector of engine.hidden_layer
+        overwrite: Discard existing output instead of resuming
+
+    Returns:
+        Total number of rows committed to the output
+    """
+    settings = {
+        'input': str(Path(input_path).resolve()),
+        'text_column': text_column,
+        'id_column': id_column,
+        'model_path': str(engine.model_path),
+        'hidden_layer': engine.hidden_layer if return_cls else None,
+        # Predictions from another backend or truncation must not be mixed into one output
+        'backend': engine.backend,
+        'max_length': engine.max_length,
+        'long_text_stride': engine.long_text_stride,
+        'window_aggregation': engine.window_aggregation if engine.long_text_stride is not None else None,
+    }
+    writer = PartitionedParquetWriter(output_dir, settings, overwrite=overwrite)
+    if writer.committed_rows:
+        logger.info(f"Resuming after {writer.committed_rows} committed rows")
+
+    label_names = engine.label_names
+    columns = [text_column] + ([id_column] if id_column and id_column != text_column else [])
+    start = time.perf_counter()
+    num_new = 0
+    for chunk in iter_input_chunks(input_path, columns, chunk_size, input_format, skip_rows=writer.committed_rows):
+        texts = chunk[text_column].tolist()
+        outputs = classify_chunk(engine, texts, batch_size, return_cls)
+        writer.write(build_table(chunk, writer.committed_rows, outputs, label_names, id_column))
+        num_new += len(chunk)
+        rate = num_new / (time.perf_counter() - start)
+        logger.info(f"Committed {writer.committed_rows} rows ({rate:.1f} rows/s)")
+    return writer.committed_rows
+
+
+def main():
+    """Classify a large file into a Parquet directory."""
+    from inference_backends import BACKEND_CHOICES, DEFAULT_BACKEND
+    from sequence_inference import SentimentInferenceEngine
+
+    parser = argparse.ArgumentParser(
+        description='Classify a CSV / JSONL / Parquet file in chunks into resumable Parquet output',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--model_path', type=str, required=True, help='Path to the fine-tuned model')
+    parser.add_argument('--input', type=str, required=True, help='Input CSV, JSONL or Parquet file')
+    parser.add_argument('--output_dir', type=str, required=True, help='Directory for the Parquet part files')
+    parser.add_argument('--input_format', choices=INPUT_FORMATS, default=None,
+                        help='Input format (inferred from the extension if omitted)')
+    parser.add_argument('--text_column', type=str, default='text', help='Column with the texts')
+    parser.add_argument('--id_column', type=str, default=None, help='Column copied to the output')
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Rows read and committed at a time; bounds memory use')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE, help='Texts per forward pass')
+    parser.add_argument('--return_cls', action='store_true', help='Also write CLS vectors')
+    parser.add_argument('--overwrite', action='store_true', help='Discard existing output instead of resuming')
+    parser.add_argument('--device', type=str, default=None, help='Device (auto-detected if omitted)')
+    parser.add_argument('--backend', choices=BACKEND_CHOICES, default=DEFAULT_BACKEND, help='Inference backend')
+    parser.add_argument('--cache_size', type=int, default=0,
+                        help='Cache the predictions of up to this many distinct texts (0 disables)')
+    args = parser.parse_args()
+
+    engine = SentimentInferenceEngine(
+        args.model_path, device=args.device, backend=args.backend, cache_size=args.cache_size
+    )
+    total = run_batch_classification(
+        engine,
+        args.input,
+        args.output_dir,
+        text_column=args.text_column,
+        id_column=args.id_column,
+        input_format=args.input_format,
+        chunk_size=args.chunk_size,
+        batch_size=args.batch_size,
+        return_cls=args.return_cls,
+        overwrite=args.overwrite
+    )
+    logger.info(f"{total} rows classified into {args.output_dir}")
+    if engine.get_cache_stats() is not None:
+        logger.info(f"Prediction cache: {engine.get_cache_stats()}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
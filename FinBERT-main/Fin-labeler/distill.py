@@ -0,0 +1,404 @@
+"""
+Knowledge distillation of a fine-tuned FinBERT2 classifier into a shallow student.
+
+1. The fine-tuned teacher labels an unlabeled corpus (by default the report
+   sentences in 年报分析/csv_output); its logits are cached together with the
+   tokenized corpus, so later runs skip both steps.
+2. A student with the teacher's embeddings, classifier head and a subset of
+   its encoder layers is trained on the temperature-softened teacher
+   distribution.
+3. The student is saved as an ordinary BertForSequenceClassification directory
+   that SentimentInferenceEngine loads like any other model, and is compared
+   with the teacher on the labelled test set: accuracy, agreement and speed.
+"""
+
+import argparse
+import copy
+import glob
+import hashlib
+import json
+import logging
+import re
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Sequence, Union
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from transformers import BertForSequenceClassification, TrainingArguments
+
+from batch_classify import iter_input_chunks
+from downstream_dataset import (
+    TOKEN_CACHE_FORMAT,
+    LengthGroupedSampler,
+    TokenizedDataCollator,
+    TokenizedRecord,
+    TokenizedSentimentDataset,
+    tokenizer_fingerprint,
+)
+from finetune_sentiment_classification import PaddingAwareTrainer, PaddingStatsCallback
+from inference_backends import model_fingerprint
+from sequence_inference import DEFAULT_MAX_LENGTH, SentimentInferenceEngine
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Constants
+DEFAULT_CORPUS = '../../年报分析/csv_output/*.csv'
+DEFAULT_TEXT_COLUMN = 'sentence'
+DEFAULT_STUDENT_LAYERS = 4
+DEFAULT_TEMPERATURE = 2.0
+DEFAULT_ALPHA = 0.9
+DEFAULT_TEACHER_BATCH_SIZE = 64
+TEACHER_LOGITS_FILE = 'teacher_logits.float32.bin'
+REPORT_FILE = 'distillation.json'
+
+
+def load_corpus(patterns: Sequence[str], text_column: str = DEFAULT_TEXT_COLUMN) -> List[str]:
+    """
+    Read the distinct non-empty texts of the corpus files, in order of first appearance.
+
+    Args:
+        patterns: Files or glob patterns (CSV, JSONL or Parquet)
+        text_column: Column holding the texts
+
+    Raises:
+        FileNotFoundError: If no file matches
+    """
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+    if not paths:
+        raise FileNotFoundError(f"No corpus files match {list(patterns)}")
+    texts = {}
+    for path in paths:
+        for chunk in iter_input_chunks(path, [text_column]):
+            for text in chunk[text_column].dropna().astype(str):
+                text = text.strip()
+                if text:
+                    texts[text] = None
+    logger.info(f"Loaded {len(texts)} distinct texts from {len(paths)} corpus files")
+    return list(texts)
+
+
+def teacher_logits(engine: SentimentInferenceEngine, texts: List[str], batch_size: int) -> np.ndarray:
+    """Teacher logits of every text, computed in batches of similar length."""
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    logits = np.empty((len(texts), len(engine.label_names)), dtype=np.float32)
+    start_time = time.perf_counter()
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        logits[batch] = engine.infer_batch([texts[i] for i in batch], layers=[]).logits
+        if (start // batch_size) % 100 == 0:
+            logger.info(f"Teacher labelled {min(start + batch_size, len(texts))}/{len(texts)} texts "
+                        f"({time.perf_counter() - start_time:.0f}s)")
+    return logits
+
+
+@dataclass
+class DistillationRecord(TokenizedRecord):
+    """Tokenized text with the teacher's logits; label is the teacher's prediction."""
+    teacher_logits: np.ndarray = None
+
+
+class DistillationDataset(TokenizedSentimentDataset):
+    """
+    Token cache of an unlabeled corpus with the teacher's logits.
+
+    Same layout as TokenizedSentimentDataset, where the labels are the
+    teacher's predictions, plus a (num_records, num_labels) float32 array of
+    teacher logits. The cache is keyed by the corpus texts, the teacher's
+    weights, the tokenizer and max_length.
+    """
+
+    @classmethod
+    def build(
+        cls,
+        texts: List[str],
+        engine: SentimentInferenceEngine,
+        cache_dir: Union[str, Path],
+        teacher_batch_size: int = DEFAULT_TEACHER_BATCH_SIZE
+    ) -> 'DistillationDataset':
+        """
+        Open the distillation cache of a corpus, labelling it with the teacher first if needed.
+
+        Args:
+            texts: Corpus texts
+            engine: Engine of the teacher model; its tokenizer and max_length are used
+            cache_dir: Directory holding the caches
+            teacher_batch_size: Texts per teacher forward pass
+
+        Returns:
+            DistillationDataset over the cached tokens and logits
+        """
+        corpus_digest = hashlib.sha1('\0'.join(texts).encode('utf-8')).hexdigest()
+        payload = '\0'.join([
+            str(TOKEN_CACHE_FORMAT), corpus_digest, model_fingerprint(engine.model_path), engine.backend,
+            tokenizer_fingerprint(engine.tokenizer), str(engine.max_length)
+        ])
+        cache_path = Path(cache_dir) / f"distill-{hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]}"
+        if (cache_path / cls.META_FILE).exists():
+            logger.info(f"Reusing distillation cache {cache_path}")
+            return cls(cache_path)
+
+        logger.info(f"Labelling {len(texts)} texts with the teacher {engine.model_path}")
+        logits = teacher_logits(engine, texts, teacher_batch_size)
+        cls.write_cache(
+            cache_path, texts, logits.argmax(axis=1), engine.tokenizer, engine.max_length,
+            meta={'teacher': str(engine.model_path), 'num_labels': logits.shape[1]},
+            extra_arrays={TEACHER_LOGITS_FILE: logits}
+        )
+        return cls(cache_path)
+
+    def __init__(self, cache_path: Union[str, Path]):
+        super().__init__(cache_path)
+        num_records, num_labels = self.meta['num_records'], self.meta['num_labels']
+        self.teacher_logits = self._open_array(
+            TEACHER_LOGITS_FILE, np.float32, num_records * num_labels
+        ).reshape(num_records, num_labels)
+
+    def __getitem__(self, idx: int) -> DistillationRecord:
+        record = super().__getitem__(idx)
+        return DistillationRecord(
+            input_ids=record.input_ids, label=record.label, teacher_logits=self.teacher_logits[idx]
+        )
+
+
+class DistillationDataCollator(TokenizedDataCollator):
+    """TokenizedDataCollator that also stacks the teacher logits of the batch."""
+
+    def __call__(self, records: List[DistillationRecord]) -> Dict[str, torch.Tensor]:
+        batch = super().__call__(records)
+        batch['teacher_logits'] = torch.from_numpy(np.stack([record.teacher_logits for record in records]))
+        return batch
+
+
+def select_teacher_layers(num_teacher_layers: int, num_student_layers: int) -> List[int]:
+    """Evenly spaced teacher layers ending with the last one, e.g. [2, 5, 8, 11] for 4 of 12."""
+    return [round((i + 1) * num_teacher_layers / num_student_layers) - 1 for i in range(num_student_layers)]
+
+
+def build_student(teacher: BertForSequenceClassification, layer_map: Sequence[int]) -> BertForSequenceClassification:
+    """
+    Create a shallower copy of the teacher.
+
+    Args:
+        teacher: Fine-tuned teacher
+        layer_map: Teacher layer copied into each student layer
+
+    Returns:
+        Student with the teacher's embeddings, pooler and classifier and
+        len(layer_map) encoder layers
+
+    Raises:
+        ValueError: If a layer index is out of range
+    """
+    num_teacher_layers = teacher.config.num_hidden_layers
+    if not layer_map or any(not 0 <= layer < num_teacher_layers for layer in layer_map):
+        raise ValueError(f"Student layers {list(layer_map)} must come from [0, {num_teacher_layers})")
+    config = copy.deepcopy(teacher.config)
+    config.num_hidden_layers = len(layer_map)
+    student = BertForSequenceClassification(config)
+
+    state = {}
+    for name, tensor in teacher.state_dict().items():
+        match = re.match(r'(.*\.encoder\.layer\.)(\d+)(\..*)', name)
+        if match is None:
+            state[name] = tensor
+            continue
+        for student_layer, teacher_layer in enumerate(layer_map):
+            if teacher_layer == int(match.group(2)):
+                state[f"{match.group(1)}{student_layer}{match.group(3)}"] = tensor
+    student.load_state_dict(state)
+    return student
+
+
+class DistillationTrainer(PaddingAwareTrainer):
+    """
+    Trainer optimizing a mix of soft and hard distillation losses.
+
+    loss = alpha * T^2 * KL(softmax(teacher / T) || softmax(student / T))
+           + (1 - alpha) * cross-entropy with the teacher's predicted labels
+    """
+
+    def __init__(self, *args, temperature: float = DEFAULT_TEMPERATURE, alpha: float = DEFAULT_ALPHA, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        teacher_logits = inputs.pop('teacher_logits')
+        outputs = model(**inputs)
+        temperature = self.temperature
+        soft_loss = F.kl_div(
+            F.log_softmax(outputs.logits / temperature, dim=-1),
+            F.softmax(teacher_logits / temperature, dim=-1),
+            reduction='batchmean'
+        ) * temperature ** 2
+        loss = self.alpha * soft_loss + (1 - self.alpha) * outputs.loss
+        return (loss, outputs) if return_outputs else loss
+
+
+def compare_on_test_set(
+    teacher_path: Union[str, Path],
+    student_path: Union[str, Path],
+    test_csv: Union[str, Path],
+    batch_size: int = DEFAULT_TEACHER_BATCH_SIZE,
+    max_length: int = DEFAULT_MAX_LENGTH,
+    device: str = 'cpu'
+) -> Dict[str, float]:
+    """
+    Accuracy of teacher and student on a labelled CSV, their agreement and relative speed.
+
+    Both models are loaded with SentimentInferenceEngine and timed on the same
+    batches after one warm-up batch.
+
+    Args:
+        teacher_path: Teacher model directory
+        student_path: Student model directory
+        test_csv: CSV with 'text' and integer 'label' columns
+        batch_size: Texts per call
+        max_length: Truncation length
+        device: Device for both engines
+
+    Returns:
+        Report with per-model accuracy and sentences/second, agreement and speedup
+    """
+    data = pd.read_csv(test_csv).dropna(subset=['text', 'label'])
+    texts = data['text'].astype(str).tolist()
+    gold = data['label'].astype(int).to_numpy()
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+
+    report = {'test_samples': len(texts)}
+    predictions = {}
+    for name, path in (('teacher', teacher_path), ('student', student_path)):
+        engine = SentimentInferenceEngine(path, device=device, max_length=max_length)
+        engine.infer_batch(batches[0], layers=[])
+        start = time.perf_counter()
+        predictions[name] = np.concatenate([engine.infer_batch(batch, layers=[]).label_ids for batch in batches])
+        elapsed = time.perf_counter() - start
+        report[f'{name}_layers'] = engine.num_hidden_layers
+        report[f'{name}_accuracy'] = float((predictions[name] == gold).mean())
+        report[f'{name}_sentences_per_sec'] = len(texts) / elapsed
+    report['agreement'] = float((predictions['teacher'] == predictions['student']).mean())
+    report['speedup'] = report['student_sentences_per_sec'] / report['teacher_sentences_per_sec']
+    return report
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Distill a fine-tuned FinBERT2 classifier into a shallow student',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--teacher_path', type=str, required=True, help='Fine-tuned teacher model directory')
+    parser.add_argument('--output_dir', type=str, required=True, help='Directory for the student model')
+    parser.add_argument('--corpus', nargs='+', default=[DEFAULT_CORPUS],
+                        help='Unlabeled corpus files or glob patterns (CSV, JSONL or Parquet)')
+    parser.add_argument('--text_column', type=str, default=DEFAULT_TEXT_COLUMN, help='Text column of the corpus')
+    parser.add_argument('--test_data', type=str, default='SC_2/test_SC_2.csv',
+                        help='Labelled CSV for the teacher/student comparison')
+    parser.add_argument('--cache_dir', type=str, default='distill_cache',
+                        help='Where the tokenized corpus and teacher logits are cached')
+    parser.add_argument('--student_layers', type=int, default=DEFAULT_STUDENT_LAYERS,
+                        help='Encoder layers of the student (2-6 is typical)')
+    parser.add_argument('--layer_map', type=str, default=None,
+                        help='Comma-separated teacher layers to initialize the student from '
+                             '(default: evenly spaced, ending with the last)')
+    parser.add_argument('--max_length', type=int, default=DEFAULT_MAX_LENGTH, help='Truncation length')
+    parser.add_argument('--temperature', type=float, default=DEFAULT_TEMPERATURE, help='Softmax temperature')
+    parser.add_argument('--alpha', type=float, default=DEFAULT_ALPHA,
+                        help='Weight of the soft loss; 1 - alpha goes to the teacher-label cross-entropy')
+    parser.add_argument('--num_epochs', type=int, default=3, help='Training epochs')
+    parser.add_argument('--batch_size', type=int, default=32, help='Training batch size')
+    parser.add_argument('--learning_rate', type=float, default=1e-4, help='Learning rate')
+    parser.add_argument('--teacher_batch_size', type=int, default=DEFAULT_TEACHER_BATCH_SIZE,
+                        help='Texts per teacher forward pass and per timed test batch')
+    parser.add_argument('--group_by_length', action='store_true', help='Batch corpus texts of similar length')
+    parser.add_argument('--device', type=str, default='cpu', help='Device of the teacher/student comparison')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    return parser.parse_args()
+
+
+def main():
+    """Label the corpus, train and export the student, then compare it with the teacher."""
+    args = parse_arguments()
+    if not 0.0 <= args.alpha <= 1.0:
+        raise ValueError("alpha must be between 0 and 1")
+    torch.manual_seed(args.seed)
+
+    teacher_engine = SentimentInferenceEngine(args.teacher_path, max_length=args.max_length)
+    texts = load_corpus(args.corpus, args.text_column)
+    dataset = DistillationDataset.build(texts, teacher_engine, args.cache_dir, args.teacher_batch_size)
+    tokenizer = teacher_engine.tokenizer
+
+    teacher = BertForSequenceClassification.from_pretrained(args.teacher_path)
+    if args.layer_map:
+        layer_map = [int(layer) for layer in args.layer_map.split(',')]
+    else:
+        layer_map = select_teacher_layers(teacher.config.num_hidden_layers, args.student_layers)
+    logger.info(f"Initializing a {len(layer_map)}-layer student from teacher layers {layer_map}")
+    student = build_student(teacher, layer_map)
+    del teacher, teacher_engine
+
+    output_dir = Path(args.output_dir)
+    training_args = TrainingArguments(
+        output_dir=str(output_dir / 'checkpoints'),
+        num_train_epochs=args.num_epochs,
+        per_device_train_batch_size=args.batch_size,
+        learning_rate=args.learning_rate,
+        weight_decay=0.01,
+        logging_steps=50,
+        save_strategy="no",
+        eval_strategy="no",
+        seed=args.seed
+    )
+    train_sampler = None
+    if args.group_by_length:
+        train_sampler = LengthGroupedSampler(dataset.lengths, batch_size=args.batch_size, seed=args.seed)
+    trainer = DistillationTrainer(
+        model=student,
+        args=training_args,
+        data_collator=DistillationDataCollator.from_tokenizer(tokenizer),
+        train_dataset=dataset,
+        train_sampler=train_sampler,
+        padding_stats=PaddingStatsCallback(),
+        temperature=args.temperature,
+        alpha=args.alpha,
+    )
+    logger.info("Training the student...")
+    trainer.train()
+
+    # A plain model directory: SentimentInferenceEngine(args.output_dir) loads it as is
+    logger.info(f"Saving the student to {output_dir}")
+    student.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+
+    report = compare_on_test_set(
+        args.teacher_path, output_dir, args.test_data, args.teacher_batch_size, args.max_length, args.device
+    )
+    report.update({
+        'teacher_path': args.teacher_path,
+        'layer_map': layer_map,
+        'corpus_texts': len(dataset),
+        'temperature': args.temperature,
+        'alpha': args.alpha,
+    })
+    with open(output_dir / REPORT_FILE, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"Teacher ({report['teacher_layers']} layers): accuracy {report['teacher_accuracy']:.4f}, "
+          f"{report['teacher_sentences_per_sec']:.1f} sent/s")
+    print(f"Student ({report['student_layers']} layers): accuracy {report['student_accuracy']:.4f}, "
+          f"{report['student_sentences_per_sec']:.1f} sent/s")
+    print(f"Agreement {report['agreement']:.4f}, speedup {report['speedup']:.2f}x "
+          f"(report in {output_dir / REPORT_FILE})")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -4,19 +4,26 @@ Downstream dataset utilities for sentiment analysis tasks.
 
 This module provides data loading and processing utilities for sentiment analysis,
 supporting both CSV and text file formats with proper tokenization and label mapping.
+CSV data can also be tokenized once into an on-disk token cache that later runs
+memory-map instead of re-tokenizing every batch.
 """
 
+import hashlib
+import json
 import logging
+import os
 import random
+import shutil
+import tempfile
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import pandas as pd
 import torch
 from sklearn.preprocessing import LabelEncoder
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -25,6 +32,9 @@ logger = logging.getLogger(__name__)
 DEFAULT_SENTIMENT_LABELS = {0: "负面", 1: "正面"}
 DEFAULT_TEXT_SEPARATOR = "    "
 DEFAULT_ENCODING = "utf-8"
+TOKEN_CACHE_FORMAT = 1
+TOKEN_CACHE_CHUNK_SIZE = 10000
+DEFAULT_BUCKET_BATCHES = 50
 
 
 @dataclass
@@ -248,6 +258,309 @@ class SentimentDatasetFromCSV(Dataset):
         return label2id, id2label
 
 
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Hash of everything that determines a tokenizer's ids.
+
+    Fast tokenizers are hashed from their serialized pipeline (without the
+    truncation and padding state left behind by earlier calls), slow ones from
+    their class, vocabulary and lower-casing flag.
+    """
+    if getattr(tokenizer, 'is_fast', False):
+        spec = json.loads(tokenizer.backend_tokenizer.to_str())
+        spec.pop('truncation', None)
+        spec.pop('padding', None)
+    else:
+        spec = {
+            'class': type(tokenizer).__name__,
+            'do_lower_case': getattr(tokenizer, 'do_lower_case', None),
+            'vocab': sorted(tokenizer.get_vocab().items(), key=lambda item: item[1]),
+        }
+    payload = json.dumps(spec, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(payload).hexdigest()
+
+
+def _file_digest(path: Path) -> str:
+    """SHA-1 of a file's contents."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass
+class TokenizedRecord:
+    """Token ids of one text (without padding) and its integer label."""
+    input_ids: np.ndarray
+    label: int
+
+
+class TokenizedSentimentDataset(Dataset):
+    """
+    Sentiment dataset backed by a memory-mapped token cache.
+
+    A CSV is tokenized once (truncated to max_length, unpadded) and stored as
+    one flat int32 buffer of token ids, an int64 offsets array with the start
+    of every text (plus the end of the last one) and an int64 labels array.
+    The cache directory name combines the CSV name with a hash of its
+    contents, the tokenizer fingerprint and max_length, so a changed file,
+    vocabulary or length gets a new cache while repeated runs and sweeps
+    reuse the existing one. Items are TokenizedRecord views into the buffer;
+    use TokenizedDataCollator to pad them into batches.
+    """
+
+    TOKENS_FILE = 'input_ids.int32.bin'
+    OFFSETS_FILE = 'offsets.int64.bin'
+    LABELS_FILE = 'labels.int64.bin'
+    META_FILE = 'meta.json'
+
+    def __init__(self, cache_path: Union[str, Path]):
+        """
+        Open an existing token cache.
+
+        Args:
+            cache_path: Cache directory written by from_csv
+
+        Raises:
+            FileNotFoundError: If the cache directory is incomplete
+        """
+        self.cache_path = Path(cache_path)
+        meta_path = self.cache_path / self.META_FILE
+        if not meta_path.exists():
+            raise FileNotFoundError(f"Token cache not found: {self.cache_path}")
+        with open(meta_path, encoding='utf-8') as f:
+            self.meta = json.load(f)
+
+        num_records = self.meta['num_records']
+        self.offsets = self._open_array(self.OFFSETS_FILE, np.int64, num_records + 1)
+        self.labels = self._open_array(self.LABELS_FILE, np.int64, num_records)
+        self.token_ids = self._open_array(self.TOKENS_FILE, np.int32, self.meta['num_tokens'])
+        logger.info(f"Opened token cache with {num_records} samples and {self.meta['num_tokens']} tokens "
+                    f"from {self.cache_path}")
+
+    def _open_array(self, filename: str, dtype, length: int) -> np.ndarray:
+        """Memory-map one cache array (np.memmap cannot map an empty file)."""
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.cache_path / filename, dtype=dtype, mode='r', shape=(length,))
+
+    @classmethod
+    def cache_key(cls, csv_path: Union[str, Path], tokenizer, max_length: int) -> str:
+        """Name of the cache directory for a CSV, tokenizer and max_length."""
+        csv_path = Path(csv_path)
+        payload = f"{TOKEN_CACHE_FORMAT}\0{_file_digest(csv_path)}\0{tokenizer_fingerprint(tokenizer)}\0{max_length}"
+        return f"{csv_path.stem}-{hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]}"
+
+    @classmethod
+    def from_csv(
+        cls,
+        csv_path: Union[str, Path],
+        tokenizer,
+        max_length: Optional[int],
+        cache_dir: Union[str, Path],
+        chunk_size: int = TOKEN_CACHE_CHUNK_SIZE
+    ) -> 'TokenizedSentimentDataset':
+        """
+        Open the token cache of a CSV, building it first if needed.
+
+        Args:
+            csv_path: CSV file with 'text' and 'label' columns
+            tokenizer: Tokenizer instance
+            max_length: Truncation length (defaults to the tokenizer's max length)
+            cache_dir: Directory holding the token caches
+            chunk_size: Texts tokenized per call while building
+
+        Returns:
+            TokenizedSentimentDataset over the cached tokens
+        """
+        max_length = max_length or getattr(tokenizer, 'model_max_length', 512)
+        cache_dir = Path(cache_dir)
+        cache_path = cache_dir / cls.cache_key(csv_path, tokenizer, max_length)
+        if (cache_path / cls.META_FILE).exists():
+            logger.info(f"Reusing token cache {cache_path}")
+            return cls(cache_path)
+
+        records = SentimentDatasetFromCSV(csv_path).records
+        labels = np.empty(len(records), dtype=np.int64)
+        for i, record in enumerate(records):
+            try:
+                labels[i] = int(record.label)
+            except (ValueError, TypeError) as e:
+                raise ValueError(f"Invalid label '{record.label}': {e}")
+
+        logger.info(f"Tokenizing {len(records)} samples from {csv_path} into {cache_path}")
+        cls.write_cache(
+            cache_path, [record.text for record in records], labels, tokenizer, max_length,
+            chunk_size=chunk_size, meta={'source': str(csv_path)}
+        )
+        return cls(cache_path)
+
+    @classmethod
+    def write_cache(
+        cls,
+        cache_path: Union[str, Path],
+        texts: List[str],
+        labels: np.ndarray,
+        tokenizer,
+        max_length: int,
+        chunk_size: int = TOKEN_CACHE_CHUNK_SIZE,
+        meta: Optional[Dict] = None,
+        extra_arrays: Optional[Dict[str, np.ndarray]] = None
+    ) -> None:
+        """
+        Tokenize texts into a new cache directory.
+
+        Args:
+            cache_path: Directory to create
+            texts: Texts to tokenize
+            labels: Integer label of every text
+            tokenizer: Tokenizer instance
+            max_length: Truncation length
+            chunk_size: Texts tokenized per call
+            meta: Extra entries for meta.json
+            extra_arrays: Further per-text arrays to store, {filename: array}
+        """
+        cache_path = Path(cache_path)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Built in a temporary directory and renamed, so a crashed or concurrent
+        # build (e.g. several torchrun ranks) never leaves a partial cache behind
+        build_path = Path(tempfile.mkdtemp(prefix=f".{cache_path.name}-", dir=cache_path.parent))
+        try:
+            offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+            with open(build_path / cls.TOKENS_FILE, 'wb') as tokens_file:
+                for start in range(0, len(texts), chunk_size):
+                    encoded = tokenizer(
+                        texts[start:start + chunk_size], truncation=True, max_length=max_length
+                    )['input_ids']
+                    lengths = np.fromiter((len(ids) for ids in encoded), dtype=np.int64, count=len(encoded))
+                    offsets[start + 1:start + 1 + len(encoded)] = offsets[start] + np.cumsum(lengths)
+                    np.fromiter(
+                        (token for ids in encoded for token in ids), dtype=np.int32, count=int(lengths.sum())
+                    ).tofile(tokens_file)
+            offsets.tofile(build_path / cls.OFFSETS_FILE)
+            np.asarray(labels, dtype=np.int64).tofile(build_path / cls.LABELS_FILE)
+            for filename, array in (extra_arrays or {}).items():
+                np.ascontiguousarray(array).tofile(build_path / filename)
+            cache_meta = {
+                'format': TOKEN_CACHE_FORMAT,
+                'tokenizer': getattr(tokenizer, 'name_or_path', ''),
+                'max_length': max_length,
+                'num_records': len(texts),
+                'num_tokens': int(offsets[-1]),
+                **(meta or {}),
+            }
+            with open(build_path / cls.META_FILE, 'w', encoding='utf-8') as f:
+                json.dump(cache_meta, f, ensure_ascii=False, indent=2)
+            try:
+                os.rename(build_path, cache_path)
+            except OSError:
+                if not (cache_path / cls.META_FILE).exists():
+                    raise
+                logger.info(f"Token cache {cache_path} was built concurrently; using that one")
+        finally:
+            shutil.rmtree(build_path, ignore_errors=True)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Token count of every sample."""
+        return np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        """Return the size of the dataset."""
+        return len(self.labels)
+
+    def __getitem__(self, idx: int) -> TokenizedRecord:
+        """Get a single sample by index."""
+        if idx >= len(self.labels):
+            raise IndexError(f"Index {idx} out of range for dataset of size {len(self.labels)}")
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return TokenizedRecord(input_ids=self.token_ids[start:end], label=int(self.labels[idx]))
+
+    def get_label_mappings(self) -> Tuple[Dict[str, int], Dict[int, str]]:
+        """
+        Get label-to-ID and ID-to-label mappings for sentiment analysis.
+
+        Returns:
+            Tuple of (label2id, id2label) dictionaries
+        """
+        id2label = DEFAULT_SENTIMENT_LABELS.copy()
+        label2id = {label: id_ for id_, label in id2label.items()}
+
+        logger.info(f"Using default sentiment label mappings: {id2label}")
+        return label2id, id2label
+
+
+class LengthGroupedSampler(Sampler):
+    """
+    Sampler that puts samples of similar length into the same batch.
+
+    Every epoch the indices are shuffled, cut into buckets of
+    bucket_batches * batch_size samples and sorted by length inside each
+    bucket; the resulting batches are then shuffled, so batches stay random
+    while each one pads little. The batch holding the longest sample comes
+    first so that out-of-memory errors show up at the first step, and the only
+    incomplete batch stays last so that a DataLoader cutting the index stream
+    every batch_size samples sees the same batches.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        bucket_batches: int = DEFAULT_BUCKET_BATCHES,
+        seed: int = 0
+    ):
+        """
+        Initialize the sampler.
+
+        Args:
+            lengths: Token count of every sample
+            batch_size: Samples per batch
+            bucket_batches: Batches per length bucket; larger buckets pad less but shuffle less
+            seed: Base seed, combined with the epoch
+
+        Raises:
+            ValueError: If batch_size or bucket_batches is not positive
+        """
+        if batch_size < 1 or bucket_batches < 1:
+            raise ValueError("batch_size and bucket_batches must be positive")
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Select the epoch whose order the next iteration yields."""
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def __iter__(self) -> Iterator[int]:
+        rng = np.random.default_rng([self.seed, self.epoch])
+        # Without set_epoch calls, every iteration still gets a new order
+        self.epoch += 1
+
+        order = rng.permutation(len(self.lengths))
+        bucket_size = self.batch_size * self.bucket_batches
+        for start in range(0, len(order), bucket_size):
+            bucket = order[start:start + bucket_size]
+            order[start:start + bucket_size] = bucket[np.argsort(-self.lengths[bucket], kind='stable')]
+
+        batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        last = batches.pop() if batches and len(batches[-1]) < self.batch_size else None
+        batches = [batches[k] for k in rng.permutation(len(batches))]
+        if batches:
+            longest = max(range(len(batches)), key=lambda k: self.lengths[batches[k]].max())
+            batches[0], batches[longest] = batches[longest], batches[0]
+        if last is not None:
+            batches.append(last)
+        for batch in batches:
+            yield from batch.tolist()
+
+
 class SentimentDataCollator:
     """
     Data collator for sentiment analysis tasks.
@@ -260,7 +573,8 @@ class SentimentDataCollator:
         tokenizer, 
         max_length: Optional[int] = None,
         padding: Union[bool, str] = True,
-        truncation: bool = True
+        truncation: bool = True,
+        pad_to_multiple_of: Optional[int] = None
     ) -> None:
         """
         Initialize the data collator.
@@ -270,11 +584,13 @@ class SentimentDataCollator:
             max_length: Maximum sequence length (defaults to tokenizer's max length)
             padding: Padding strategy
             truncation: Whether to truncate sequences
+            pad_to_multiple_of: Round the padded length up to a multiple of this
         """
         self.tokenizer = tokenizer
         self.max_length = max_length or getattr(tokenizer, 'model_max_length', 512)
         self.padding = padding
         self.truncation = truncation
+        self.pad_to_multiple_of = pad_to_multiple_of
 
     def __call__(self, records: List[TextLabelRecord]) -> Dict[str, torch.Tensor]:
         """
@@ -314,6 +630,7 @@ class SentimentDataCollator:
                 padding=self.padding,
                 max_length=self.max_length,
                 truncation=self.truncation,
+                pad_to_multiple_of=self.pad_to_multiple_of,
                 return_tensors='pt',
             )
         except Exception as e:
@@ -329,6 +646,77 @@ class SentimentDataCollator:
         }
 
 
+class TokenizedDataCollator:
+    """
+    Data collator for TokenizedSentimentDataset.
+
+    Pads pre-tokenized records to the longest one in the batch; the batches
+    match what SentimentDataCollator produces for the same texts.
+    """
+
+    def __init__(
+        self,
+        pad_token_id: int = 0,
+        padding_side: str = 'right',
+        pad_to_multiple_of: Optional[int] = None
+    ) -> None:
+        """
+        Initialize the data collator.
+
+        Args:
+            pad_token_id: Id used for padding positions
+            padding_side: 'right' or 'left'
+            pad_to_multiple_of: Round the padded length up to a multiple of this
+        """
+        if padding_side not in ('right', 'left'):
+            raise ValueError(f"padding_side must be 'right' or 'left', got {padding_side!r}")
+        self.pad_token_id = pad_token_id
+        self.padding_side = padding_side
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, pad_to_multiple_of: Optional[int] = None) -> 'TokenizedDataCollator':
+        """Collator padding the way the given tokenizer does."""
+        return cls(
+            pad_token_id=tokenizer.pad_token_id,
+            padding_side=tokenizer.padding_side,
+            pad_to_multiple_of=pad_to_multiple_of
+        )
+
+    def __call__(self, records: List[TokenizedRecord]) -> Dict[str, torch.Tensor]:
+        """
+        Pad a batch of records.
+
+        Args:
+            records: List of TokenizedRecord objects
+
+        Returns:
+            Dictionary containing input_ids, attention_mask and labels tensors
+
+        Raises:
+            ValueError: If records list is empty
+        """
+        if not records:
+            raise ValueError("Cannot process empty batch")
+
+        max_len = max(len(record.input_ids) for record in records)
+        if self.pad_to_multiple_of:
+            max_len = -(-max_len // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        input_ids = np.full((len(records), max_len), self.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(records), max_len), dtype=np.int64)
+        for row, record in enumerate(records):
+            length = len(record.input_ids)
+            span = slice(0, length) if self.padding_side == 'right' else slice(max_len - length, max_len)
+            input_ids[row, span] = record.input_ids
+            attention_mask[row, span] = 1
+
+        return {
+            'input_ids': torch.from_numpy(input_ids),
+            'attention_mask': torch.from_numpy(attention_mask),
+            'labels': torch.tensor([record.label for record in records], dtype=torch.long)
+        }
+
+
 # Backward compatibility aliases
 SentimentDataset2 = SentimentDatasetFromCSV
 sentiment2_collator = SentimentDataCollator
@@ -339,6 +727,11 @@ __all__ = [
     'SentimentDatasetFromTxt',
     'SentimentDatasetFromCSV', 
     'SentimentDataCollator',
+    'TokenizedRecord',
+    'TokenizedSentimentDataset',
+    'TokenizedDataCollator',
+    'tokenizer_fingerprint',
+    'LengthGroupedSampler',
     'SentimentDataset2',  # Deprecated
     'sentiment2_collator',  # Deprecated
 ]
@@ -3,13 +3,20 @@ Fine-tuning script for sentiment classification using BERT-based models.
 
 This script provides a professional framework for fine-tuning transformer models
 on sentiment analysis tasks with comprehensive evaluation and logging capabilities.
+Evaluation runs either inside the training loop or, with --async_eval, in a
+separate worker process that scores weight snapshots while training goes on.
 """
 
 import argparse
 import csv
 import logging
+import multiprocessing as mp
 import os
+import queue
 import random
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Dict, Optional, Tuple, Union
@@ -17,14 +24,24 @@ from typing import Dict, Optional, Tuple, Union
 import numpy as np
 import torch
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
+from torch.utils.data import DataLoader, Dataset
 from transformers import (
+    BertConfig,
     BertForSequenceClassification,
-    BertTokenizer,
     Trainer,
+    TrainerCallback,
     TrainingArguments,
 )
 
-from downstream_dataset import SentimentDataset2, sentiment2_collator
+from downstream_dataset import (
+    DEFAULT_BUCKET_BATCHES,
+    LengthGroupedSampler,
+    SentimentDataset2,
+    TokenizedDataCollator,
+    TokenizedSentimentDataset,
+    sentiment2_collator,
+)
+from tokenization import load_tokenizer
 
 # Configure logging
 logging.basicConfig(
@@ -37,6 +54,13 @@ logger = logging.getLogger(__name__)
 DEFAULT_MODEL_NAME = "valuesimplex-ai-lab/FinBERT2-base"
 DEFAULT_SEED = 42
 DEFAULT_MAX_LENGTH = 510
+RESULTS_FIELDNAMES = [
+    'experimentname', 'currentsteps', 'accuracy', 'precision', 'recall', 'f1',
+    'elapsed_seconds', 'padding_ratio'
+]
+SNAPSHOT_DIRNAME = "eval_snapshots"
+# Metrics the asynchronous evaluation worker computes
+SNAPSHOT_METRICS = ('accuracy', 'precision', 'recall', 'f1', 'loss')
 
 
 @dataclass
@@ -57,12 +81,27 @@ class FineTuningConfig:
     learning_rate: float = 5e-5
     weight_decay: float = 0.01
     max_length: int = DEFAULT_MAX_LENGTH
+    use_fast_tokenizer: bool = True
+    # Tokenize the CSVs once into memory-mapped token caches under this directory
+    token_cache_dir: Optional[str] = None
+    # Batch samples of similar length together and round padded lengths up to a multiple
+    group_by_length: bool = False
+    length_bucket_batches: int = DEFAULT_BUCKET_BATCHES
+    pad_to_multiple_of: Optional[int] = None
+    
+    # Asynchronous evaluation of weight snapshots in a worker process
+    async_eval: bool = False
+    eval_device: str = "cpu"
+    eval_threads: Optional[int] = None
+    max_pending_snapshots: int = 2
     
     # Evaluation and logging
     logging_steps: int = 1
     eval_steps: int = 10
     save_steps: int = 100000
     metric_for_best_model: str = "f1"
+    # None follows TrainingArguments: lower is better for losses, higher otherwise
+    greater_is_better: Optional[bool] = None
     
     # Other settings
     seed: int = DEFAULT_SEED
@@ -75,20 +114,135 @@ class FineTuningConfig:
             raise ValueError("Batch sizes must be positive")
         if not (0 < self.learning_rate < 1):
             raise ValueError("Learning rate must be between 0 and 1")
+        if self.length_bucket_batches <= 0:
+            raise ValueError("Length bucket size must be positive")
+        if self.pad_to_multiple_of is not None and self.pad_to_multiple_of <= 0:
+            raise ValueError("pad_to_multiple_of must be positive")
+        if self.max_pending_snapshots <= 0:
+            raise ValueError("max_pending_snapshots must be positive")
+    
+    @property
+    def metric_greater_is_better(self) -> bool:
+        """Whether a higher metric_for_best_model is better."""
+        if self.greater_is_better is not None:
+            return self.greater_is_better
+        return not self.metric_for_best_model.endswith('loss')
+
+
+def classification_metrics(labels, predictions) -> Dict[str, float]:
+    """Accuracy and weighted precision, recall and F1 of class predictions."""
+    return {
+        'accuracy': accuracy_score(labels, predictions),
+        'precision': precision_score(labels, predictions, average='weighted'),
+        'recall': recall_score(labels, predictions, average='weighted'),
+        'f1': f1_score(labels, predictions, average='weighted')
+    }
+
+
+def upgrade_results_header(csv_path: Path, fieldnames) -> None:
+    """Rewrite a results CSV written with fewer columns so new rows line up with its header."""
+    if not csv_path.exists():
+        return
+    with open(csv_path, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        rows = list(reader)
+        header = reader.fieldnames or []
+    if not header or list(header) == list(fieldnames):
+        return
+    logger.info(f"Adding columns {[name for name in fieldnames if name not in header]} to {csv_path}")
+    with open(csv_path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def append_results_row(csv_path: Union[str, Path], metrics: Dict) -> None:
+    """Append one evaluation to the results CSV, writing the header for a new file."""
+    csv_path = Path(csv_path)
+    upgrade_results_header(csv_path, RESULTS_FIELDNAMES)
+    file_exists = csv_path.exists()
+    
+    with open(csv_path, 'a', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=RESULTS_FIELDNAMES)
+        if not file_exists:
+            writer.writeheader()
+        writer.writerow(metrics)
+
+
+class PaddingStatsCallback(TrainerCallback):
+    """
+    Tracks the share of padding positions in the training batches of each epoch.
+
+    PaddingAwareTrainer adds every batch's token counts; the ratio of the
+    current epoch is logged when the epoch ends.
+    """
+    
+    def __init__(self):
+        self.real_tokens = 0
+        self.padded_tokens = 0
+    
+    def add_batch(self, attention_mask: torch.Tensor) -> None:
+        """Count the real and padded positions of one batch."""
+        self.real_tokens += int(attention_mask.sum())
+        self.padded_tokens += attention_mask.numel()
+    
+    @property
+    def padding_ratio(self) -> Optional[float]:
+        """Fraction of positions in this epoch's batches that are padding."""
+        if not self.padded_tokens:
+            return None
+        return 1.0 - self.real_tokens / self.padded_tokens
+    
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.real_tokens = 0
+        self.padded_tokens = 0
+    
+    def on_epoch_end(self, args, state, control, **kwargs):
+        if self.padding_ratio is not None:
+            logger.info(f"Epoch {state.epoch:.0f}: padding ratio {self.padding_ratio:.4f} "
+                        f"({self.padded_tokens - self.real_tokens}/{self.padded_tokens} positions)")
+
+
+class PaddingAwareTrainer(Trainer):
+    """Trainer with an optional custom train sampler that reports training batch padding."""
+    
+    def __init__(self, *args, train_sampler=None, padding_stats: Optional[PaddingStatsCallback] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_sampler = train_sampler
+        self.padding_stats = padding_stats
+        if padding_stats is not None:
+            self.add_callback(padding_stats)
+    
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.train_sampler is not None:
+            return self.train_sampler
+        return super()._get_train_sampler(*args, **kwargs)
+    
+    def training_step(self, model, inputs, *args, **kwargs):
+        if self.padding_stats is not None and inputs.get('attention_mask') is not None:
+            self.padding_stats.add_batch(inputs['attention_mask'])
+        return super().training_step(model, inputs, *args, **kwargs)
 
 
 class SentimentFinetuner:
     """Professional sentiment analysis fine-tuning framework."""
     
-    def __init__(self, config: FineTuningConfig):
+    def __init__(self, config: FineTuningConfig, base_model=None, tokenizer=None):
         """
         Initialize the fine-tuner.
         
         Args:
             config: Fine-tuning configuration
+            base_model: Already loaded model of config.model_name to train in place
+                (used by sweeps); its classifier head is re-initialized from config.seed
+            tokenizer: Already loaded tokenizer of config.model_name
         """
         self.config = config
+        self.base_model = base_model
+        self.tokenizer = tokenizer
         self.eval_counter = 0
+        self.padding_stats = PaddingStatsCallback()
+        self.train_start_time = None
         
         # Set up paths
         self.experiment_name = self._generate_experiment_name()
@@ -121,10 +275,20 @@ class SentimentFinetuner:
         
         logger.info(f"Set random seed to {seed} for reproducibility")
     
-    def load_datasets(self) -> Tuple[SentimentDataset2, SentimentDataset2]:
+    def load_tokenizer(self):
+        """Load the tokenizer of the configured model."""
+        if self.tokenizer is not None:
+            return self.tokenizer
+        logger.info(f"Loading tokenizer from {self.config.model_name}")
+        return load_tokenizer(self.config.model_name, use_fast=self.config.use_fast_tokenizer)
+    
+    def load_datasets(self, tokenizer=None) -> Tuple[Dataset, Dataset]:
         """
         Load training and testing datasets.
         
+        Args:
+            tokenizer: Tokenizer for the token caches; required if token_cache_dir is set
+        
         Returns:
             Tuple of (train_dataset, test_dataset)
             
@@ -140,49 +304,112 @@ class SentimentFinetuner:
             raise FileNotFoundError(f"Test data not found: {test_path}")
         
         logger.info(f"Loading training dataset from {train_path}")
-        train_dataset = SentimentDataset2(train_path)
+        train_dataset = self.load_dataset(train_path, tokenizer)
         
         logger.info(f"Loading test dataset from {test_path}")
-        test_dataset = SentimentDataset2(test_path)
+        test_dataset = self.load_dataset(test_path, tokenizer)
         
         logger.info(f"Loaded {len(train_dataset)} training and {len(test_dataset)} test samples")
         return train_dataset, test_dataset
     
-    def setup_model_and_tokenizer(self, num_classes: int, label_mappings: Tuple[Dict, Dict]):
+    def load_dataset(self, path: Path, tokenizer=None) -> Dataset:
+        """Load one CSV, through its token cache if token_cache_dir is set."""
+        if self.config.token_cache_dir:
+            if tokenizer is None:
+                raise ValueError("A tokenizer is required to build the token caches")
+            return TokenizedSentimentDataset.from_csv(
+                path, tokenizer, self.config.max_length, self.config.token_cache_dir
+            )
+        return SentimentDataset2(path)
+    
+    def setup_model_and_tokenizer(self, num_classes: int, label_mappings: Tuple[Dict, Dict], tokenizer=None):
         """
         Set up model and tokenizer.
         
         Args:
             num_classes: Number of classification classes
             label_mappings: Tuple of (label2id, id2label) mappings
+            tokenizer: Already loaded tokenizer (loaded here if None)
             
         Returns:
             Tuple of (model, tokenizer, data_collator)
         """
         label2id, id2label = label_mappings
         
-        logger.info(f"Loading tokenizer from {self.config.model_name}")
-        tokenizer = BertTokenizer.from_pretrained(self.config.model_name)
-        
-        logger.info(f"Loading model from {self.config.model_name}")
-        model = BertForSequenceClassification.from_pretrained(
-            self.config.model_name,
-            problem_type="single_label_classification",
-            num_labels=num_classes,
-            id2label=id2label,
-            label2id=label2id
-        )
+        if tokenizer is None:
+            tokenizer = self.load_tokenizer()
         
-        data_collator = sentiment2_collator(
-            tokenizer=tokenizer,
-            max_length=self.config.max_length
-        )
+        if self.base_model is not None:
+            model = self.base_model
+            if model.config.id2label != id2label:
+                raise ValueError(f"Base model labels {model.config.id2label} do not match {id2label}")
+            # Same initialization as from_pretrained gives a new head, drawn from this run's seed
+            torch.nn.init.normal_(model.classifier.weight, std=model.config.initializer_range)
+            torch.nn.init.zeros_(model.classifier.bias)
+        else:
+            logger.info(f"Loading model from {self.config.model_name}")
+            model = BertForSequenceClassification.from_pretrained(
+                self.config.model_name,
+                problem_type="single_label_classification",
+                num_labels=num_classes,
+                id2label=id2label,
+                label2id=label2id
+            )
+        
+        data_collator = self.create_data_collator(tokenizer)
         
         logger.info(f"Model setup complete with {num_classes} classes")
         return model, tokenizer, data_collator
     
+    def create_data_collator(self, tokenizer):
+        """Create the collator matching the dataset mode."""
+        if self.config.token_cache_dir:
+            # The datasets are already tokenized and truncated; only pad
+            return TokenizedDataCollator.from_tokenizer(
+                tokenizer, pad_to_multiple_of=self.config.pad_to_multiple_of
+            )
+        return sentiment2_collator(
+            tokenizer=tokenizer,
+            max_length=self.config.max_length,
+            pad_to_multiple_of=self.config.pad_to_multiple_of
+        )
+    
+    def create_train_sampler(self, train_dataset: Dataset, tokenizer) -> Optional[LengthGroupedSampler]:
+        """
+        Create the length-grouped train sampler if group_by_length is set.
+        
+        Args:
+            train_dataset: Training dataset
+            tokenizer: Tokenizer, used to measure texts when the dataset is not pre-tokenized
+            
+        Returns:
+            LengthGroupedSampler, or None for the Trainer's random sampler
+        """
+        if not self.config.group_by_length:
+            return None
+        
+        if isinstance(train_dataset, TokenizedSentimentDataset):
+            lengths = train_dataset.lengths
+        else:
+            texts = [record.text for record in train_dataset.records]
+            lengths = [
+                len(ids) for ids in
+                tokenizer(texts, truncation=True, max_length=self.config.max_length)['input_ids']
+            ]
+        logger.info(f"Grouping training batches by length in buckets of "
+                    f"{self.config.length_bucket_batches} batches")
+        return LengthGroupedSampler(
+            lengths,
+            batch_size=self.config.train_batch_size,
+            bucket_batches=self.config.length_bucket_batches,
+            seed=self.config.seed
+        )
+    
     def create_training_arguments(self) -> TrainingArguments:
         """Create training arguments configuration."""
+        # With async_eval the Trainer never evaluates; SnapshotEvaluationCallback
+        # handles evaluation and best-model selection instead
+        in_loop_eval = not self.config.async_eval
         return TrainingArguments(
             output_dir=str(self.output_dir),
             num_train_epochs=self.config.num_epochs,
@@ -194,9 +421,10 @@ class SentimentFinetuner:
             eval_steps=self.config.eval_steps,
             save_steps=self.config.save_steps,
             save_strategy="steps",
-            eval_strategy="steps",
-            load_best_model_at_end=True,
+            eval_strategy="steps" if in_loop_eval else "no",
+            load_best_model_at_end=in_loop_eval,
             metric_for_best_model=self.config.metric_for_best_model,
+            greater_is_better=self.config.metric_greater_is_better,
             seed=self.config.seed
         )
     
@@ -216,35 +444,21 @@ class SentimentFinetuner:
         # Convert predictions to class labels (same as original code)
         predictions = torch.argmax(torch.tensor(predictions), dim=1)
         
-        # Compute metrics
-        accuracy = accuracy_score(labels, predictions)
-        precision = precision_score(labels, predictions, average='weighted')
-        recall = recall_score(labels, predictions, average='weighted')
-        f1 = f1_score(labels, predictions, average='weighted')
-        
         current_steps = self.eval_counter * self.config.eval_steps
         
         metrics = {
             'experimentname': self.experiment_name,
             'currentsteps': current_steps,
-            'accuracy': accuracy,
-            'precision': precision,
-            'recall': recall,
-            'f1': f1
+            **classification_metrics(labels, predictions),
+            # Wall-clock time since training started, to weigh speed-ups against convergence
+            'elapsed_seconds': time.perf_counter() - self.train_start_time if self.train_start_time else None,
+            # Padding share of the current epoch's training batches so far
+            'padding_ratio': self.padding_stats.padding_ratio
         }
         
         # Original logic: only write CSV on main process in distributed training
         if self.training_args.local_rank in (0, -1):
-            # CSV writing logic (same as original)
-            csv_path = Path(self.config.results_csv_path)
-            file_exists = csv_path.exists()
-            fieldnames = ['experimentname', 'currentsteps', 'accuracy', 'precision', 'recall', 'f1']
-            
-            with open(csv_path, 'a', newline='') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                if not file_exists:
-                    writer.writeheader()
-                writer.writerow(metrics)
+            append_results_row(self.config.results_csv_path, metrics)
         
         return metrics
     
@@ -256,14 +470,15 @@ class SentimentFinetuner:
         # Setup reproducibility
         self.setup_reproducibility()
         
-        # Load datasets
-        train_dataset, test_dataset = self.load_datasets()
+        # Load datasets (the token caches need the tokenizer first)
+        tokenizer = self.load_tokenizer() if self.config.token_cache_dir else None
+        train_dataset, test_dataset = self.load_datasets(tokenizer)
         label2id, id2label = train_dataset.get_label_mappings()
         num_classes = len(label2id)
         
         # Setup model and tokenizer
         model, tokenizer, data_collator = self.setup_model_and_tokenizer(
-            num_classes, (label2id, id2label)
+            num_classes, (label2id, id2label), tokenizer
         )
         
         # Create training arguments
@@ -273,7 +488,7 @@ class SentimentFinetuner:
         self.training_args = training_args
         
         # Initialize trainer
-        trainer = Trainer(
+        trainer = PaddingAwareTrainer(
             model=model,
             tokenizer=tokenizer,
             args=training_args,
@@ -281,20 +496,244 @@ class SentimentFinetuner:
             train_dataset=train_dataset,
             eval_dataset=test_dataset,
             compute_metrics=self.compute_metrics,
+            train_sampler=self.create_train_sampler(train_dataset, tokenizer),
+            padding_stats=self.padding_stats,
         )
+        if self.config.async_eval:
+            trainer.add_callback(SnapshotEvaluationCallback(self, self.output_dir / SNAPSHOT_DIRNAME))
         
         # Start training
         logger.info("Starting training...")
+        self.train_start_time = time.perf_counter()
         trainer.train()
         
-        # Save model and tokenizer
-        logger.info(f"Saving model and tokenizer to {self.output_dir}")
-        tokenizer.save_pretrained(self.output_dir)
-        model.save_pretrained(self.output_dir)
+        # Save model and tokenizer; with async_eval only the main process holds the best snapshot
+        if trainer.is_world_process_zero():
+            logger.info(f"Saving model and tokenizer to {self.output_dir}")
+            tokenizer.save_pretrained(self.output_dir)
+            model.save_pretrained(self.output_dir)
         
         logger.info("Training completed successfully!")
 
 
+class SnapshotEvaluationCallback(TrainerCallback):
+    """
+    Moves evaluation out of the training loop into a worker process.
+
+    Every eval_steps steps the weights are copied to CPU and a background
+    thread writes them to snapshot_dir and queues them for
+    run_snapshot_evaluator, so a step only pays for the copy. If
+    max_pending_snapshots snapshots are still unscored, the snapshot is
+    skipped instead of waiting. The worker appends the metrics to the results
+    CSV and reports them back; at the end of training the callback waits for
+    the outstanding evaluations and loads the best snapshot into the model,
+    as load_best_model_at_end does for in-loop evaluation, following
+    metric_greater_is_better. Only the main process takes snapshots and
+    loads the best one, so only the main process may save the final model.
+    
+    Raises:
+        ValueError: If metric_for_best_model is not one of SNAPSHOT_METRICS
+    """
+    
+    def __init__(self, finetuner: 'SentimentFinetuner', snapshot_dir: Path):
+        metric_name = finetuner.config.metric_for_best_model.removeprefix('eval_')
+        if metric_name not in SNAPSHOT_METRICS:
+            raise ValueError(f"async_eval computes {SNAPSHOT_METRICS}, "
+                             f"not metric_for_best_model={finetuner.config.metric_for_best_model!r}")
+        self.finetuner = finetuner
+        self.config = finetuner.config
+        self.snapshot_dir = Path(snapshot_dir)
+        self.best = None
+        self.pending = 0
+        self.skipped = 0
+        self._process = None
+        self._jobs = None
+        self._results = None
+        self._writer = None
+        self._worker_failed = False
+    
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        if not state.is_world_process_zero:
+            return
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        model.config.save_pretrained(self.snapshot_dir)
+        
+        # spawn: the worker must not inherit the trainer's CUDA context
+        ctx = mp.get_context('spawn')
+        self._jobs = ctx.Queue()
+        self._results = ctx.Queue()
+        self._process = ctx.Process(
+            target=run_snapshot_evaluator,
+            args=(self.config, self.finetuner.experiment_name, str(self.snapshot_dir), self._jobs, self._results)
+        )
+        self._process.start()
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        logger.info(f"Started evaluation worker (pid {self._process.pid}) on {self.config.eval_device}")
+    
+    def on_step_end(self, args, state, control, model=None, **kwargs):
+        if self._process is None or self._worker_failed:
+            return
+        self._collect_results(block=False)
+        if self._worker_failed or state.global_step % self.config.eval_steps != 0:
+            return
+        if self.pending >= self.config.max_pending_snapshots:
+            self.skipped += 1
+            logger.warning(f"Skipping evaluation at step {state.global_step}: "
+                           f"{self.pending} snapshots are still being evaluated")
+            return
+        
+        weights = {name: tensor.detach().to('cpu', copy=True) for name, tensor in model.state_dict().items()}
+        start_time = self.finetuner.train_start_time
+        job = {
+            'step': state.global_step,
+            'path': str(self.snapshot_dir / f"step-{state.global_step}.pt"),
+            'elapsed_seconds': time.perf_counter() - start_time if start_time else None,
+            'padding_ratio': self.finetuner.padding_stats.padding_ratio,
+        }
+        self.pending += 1
+        self._writer.submit(self._write_snapshot, weights, job)
+    
+    def _write_snapshot(self, weights: Dict[str, torch.Tensor], job: Dict) -> None:
+        """
+        Save a snapshot atomically and hand it to the worker.
+        
+        A failed save is reported through the results queue like a failed
+        evaluation, so _collect_results logs it and releases its pending slot.
+        """
+        tmp_path = job['path'] + '.tmp'
+        try:
+            torch.save(weights, tmp_path)
+            os.replace(tmp_path, job['path'])
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self._results.put({'step': job['step'], 'error': f"Saving the snapshot failed: {type(e).__name__}: {e}"})
+            return
+        self._jobs.put(job)
+    
+    def _collect_results(self, block: bool) -> None:
+        """Process the worker's reports; with block, wait until all pending snapshots are scored."""
+        while self.pending > 0:
+            try:
+                result = self._results.get(timeout=5) if block else self._results.get_nowait()
+            except queue.Empty:
+                if not self._process.is_alive():
+                    logger.error(f"Evaluation worker exited (code {self._process.exitcode}) "
+                                 f"with {self.pending} snapshots unscored")
+                    self.pending = 0
+                    self._worker_failed = True
+                    return
+                if block:
+                    continue
+                return
+            self.pending -= 1
+            if 'error' in result:
+                logger.error(f"Evaluation of step {result['step']} failed: {result['error']}")
+                continue
+            metrics = result['metrics']
+            logger.info(f"Step {result['step']}: accuracy={metrics['accuracy']:.4f} f1={metrics['f1']:.4f} "
+                        f"loss={metrics['loss']:.4f}"
+                        + (" (new best)" if result['is_best'] else ""))
+            if result['is_best']:
+                self.best = result
+    
+    def on_train_end(self, args, state, control, model=None, **kwargs):
+        if self._process is None:
+            return
+        self._writer.shutdown(wait=True)
+        self._jobs.put(None)
+        if not self._worker_failed:
+            self._collect_results(block=True)
+        self._process.join()
+        if self.skipped:
+            logger.warning(f"Skipped {self.skipped} evaluations because the worker fell behind")
+        
+        if self.best is not None:
+            logger.info(f"Loading best snapshot from step {self.best['step']} "
+                        f"({self.config.metric_for_best_model}={self.best['score']:.4f})")
+            model.load_state_dict(torch.load(self.best['path'], map_location='cpu'))
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
+
+def run_snapshot_evaluator(
+    config: FineTuningConfig,
+    experiment_name: str,
+    snapshot_dir: str,
+    jobs,
+    results
+) -> None:
+    """
+    Worker process of SnapshotEvaluationCallback.
+    
+    Scores each queued snapshot on the test set, appends the metrics to the
+    results CSV and reports them back together with the mean test loss. Only
+    the best snapshot so far is kept on disk. Stops at a None job.
+    
+    Args:
+        config: Fine-tuning configuration of the training run
+        experiment_name: Name written to the results CSV
+        snapshot_dir: Directory with the model config and the snapshots
+        jobs: Queue of snapshot jobs
+        results: Queue for the per-snapshot reports
+    """
+    if config.eval_threads:
+        torch.set_num_threads(config.eval_threads)
+    finetuner = SentimentFinetuner(config)
+    tokenizer = finetuner.load_tokenizer()
+    test_dataset = finetuner.load_dataset(Path(config.test_data_path), tokenizer)
+    loader = DataLoader(
+        test_dataset, batch_size=config.eval_batch_size, collate_fn=finetuner.create_data_collator(tokenizer)
+    )
+    device = torch.device(config.eval_device)
+    model = BertForSequenceClassification(BertConfig.from_pretrained(snapshot_dir)).to(device).eval()
+    metric_name = config.metric_for_best_model.removeprefix('eval_')
+    best = None
+    
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        try:
+            model.load_state_dict(torch.load(job['path'], map_location=device))
+            predictions, labels = [], []
+            loss_sum = 0.0
+            with torch.inference_mode():
+                for batch in loader:
+                    labels.append(batch['labels'])
+                    batch = {k: v.to(device) for k, v in batch.items() if v is not None}
+                    outputs = model(**batch)
+                    loss_sum += outputs.loss.item() * len(labels[-1])
+                    predictions.append(outputs.logits.argmax(dim=-1).cpu())
+            metrics = {
+                'experimentname': experiment_name,
+                'currentsteps': job['step'],
+                **classification_metrics(torch.cat(labels).numpy(), torch.cat(predictions).numpy()),
+                'elapsed_seconds': job['elapsed_seconds'],
+                'padding_ratio': job['padding_ratio'],
+            }
+            append_results_row(config.results_csv_path, metrics)
+            metrics['loss'] = loss_sum / len(test_dataset)
+            
+            score = metrics[metric_name]
+            if best is None:
+                is_best = True
+            elif config.metric_greater_is_better:
+                is_best = score > best['score']
+            else:
+                is_best = score < best['score']
+            if is_best:
+                if best is not None:
+                    os.remove(best['path'])
+                best = {'path': job['path'], 'score': score}
+            else:
+                os.remove(job['path'])
+            results.put({
+                'step': job['step'], 'metrics': metrics, 'is_best': is_best, 'path': job['path'], 'score': score
+            })
+        except Exception as e:
+            results.put({'step': job['step'], 'error': f"{type(e).__name__}: {e}"})
+
+
 def parse_arguments() -> argparse.Namespace:
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(
@@ -342,6 +781,46 @@ def parse_arguments() -> argparse.Namespace:
         type=int,
         help='Random seed for reproducibility'
     )
+    parser.add_argument(
+        '--slow_tokenizer',
+        action='store_true',
+        help='Use the pure-Python BertTokenizer instead of the fast tokenizer'
+    )
+    parser.add_argument(
+        '--token_cache_dir',
+        type=str,
+        help='Tokenize the datasets once into memory-mapped caches in this directory and reuse them'
+    )
+    parser.add_argument(
+        '--group_by_length',
+        action='store_true',
+        help='Batch training samples of similar length together (shuffled within length buckets)'
+    )
+    parser.add_argument(
+        '--length_bucket_batches',
+        type=int,
+        help='Batches per length bucket for --group_by_length'
+    )
+    parser.add_argument(
+        '--pad_to_multiple_of',
+        type=int,
+        help='Round padded batch lengths up to a multiple of this (e.g. 8 for tensor cores)'
+    )
+    parser.add_argument(
+        '--async_eval',
+        action='store_true',
+        help='Evaluate weight snapshots in a separate worker process instead of pausing training'
+    )
+    parser.add_argument(
+        '--eval_device',
+        type=str,
+        help='Device of the evaluation worker, e.g. cpu or cuda:1'
+    )
+    parser.add_argument(
+        '--eval_threads',
+        type=int,
+        help='torch threads of the evaluation worker'
+    )
     
     return parser.parse_args()
 
@@ -370,6 +849,22 @@ def main():
         config.learning_rate = args.learning_rate
     if args.seed:
         config.seed = args.seed
+    if args.slow_tokenizer:
+        config.use_fast_tokenizer = False
+    if args.token_cache_dir:
+        config.token_cache_dir = args.token_cache_dir
+    if args.group_by_length:
+        config.group_by_length = True
+    if args.length_bucket_batches:
+        config.length_bucket_batches = args.length_bucket_batches
+    if args.pad_to_multiple_of:
+        config.pad_to_multiple_of = args.pad_to_multiple_of
+    if args.async_eval:
+        config.async_eval = True
+    if args.eval_device:
+        config.eval_device = args.eval_device
+    if args.eval_threads:
+        config.eval_threads = args.eval_threads
     
     logger.info(f"Using model: {config.model_name}")
     
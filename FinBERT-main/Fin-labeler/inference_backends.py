@@ -0,0 +1,345 @@
+"""
+CPU inference backends for the FinBERT2 sequence classifier.
+
+This module lets SentimentInferenceEngine run the same fine-tuned model as
+eager fp32 PyTorch, as a dynamically int8-quantized PyTorch model, or as an
+exported ONNX Runtime graph, and provides a parity check against fp32.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Constants
+BACKEND_CHOICES = ('fp32', 'int8', 'onnx')
+DEFAULT_BACKEND = 'fp32'
+DEFAULT_ONNX_OPSET = 17
+ONNX_INPUT_NAMES = ('input_ids', 'attention_mask', 'token_type_ids')
+
+
+def quantize_dynamic_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Quantize every nn.Linear of a model to int8 with dynamic activation scales.
+
+    Args:
+        model: fp32 model on CPU
+
+    Returns:
+        Quantized model in evaluation mode
+    """
+    quantized = torch.ao.quantization.quantize_dynamic(
+        model.to('cpu').eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return quantized.eval()
+
+
+class _ClassifierExportWrapper(torch.nn.Module):
+    """Exposes (logits, hidden_states[hidden_layer]) with positional inputs for ONNX export."""
+
+    def __init__(self, model: torch.nn.Module, hidden_layer: int):
+        super().__init__()
+        self.model = model
+        self.hidden_layer = hidden_layer
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            output_hidden_states=True
+        )
+        return outputs.logits, outputs.hidden_states[self.hidden_layer]
+
+
+def export_classifier_onnx(
+    model: torch.nn.Module,
+    tokenizer,
+    onnx_path: Union[str, Path],
+    hidden_layer: int,
+    opset: int = DEFAULT_ONNX_OPSET
+) -> Path:
+    """
+    Export a sequence classifier to ONNX with dynamic batch and sequence axes.
+
+    The graph outputs the logits and the hidden states of `hidden_layer` only.
+
+    Args:
+        model: fp32 AutoModelForSequenceClassification
+        tokenizer: Tokenizer used to build the example input
+        onnx_path: Destination file
+        hidden_layer: Hidden-state layer to expose
+        opset: ONNX opset version
+
+    Returns:
+        Path of the exported graph
+    """
+    onnx_path = Path(onnx_path)
+    onnx_path.parent.mkdir(parents=True, exist_ok=True)
+    # Written next to the destination and renamed, so a reader never sees a partial graph
+    tmp_path = onnx_path.with_name(f'{onnx_path.name}.{os.getpid()}.tmp')
+
+    # The exporter follows the wrapper's training flag, so it must be in eval mode too
+    wrapper = _ClassifierExportWrapper(model.to('cpu').eval(), hidden_layer).eval()
+    example = tokenizer(["示例文本", "样例"], padding=True, return_tensors="pt")
+    example_inputs = tuple(
+        example.get(name, torch.zeros_like(example['input_ids'])) for name in ONNX_INPUT_NAMES
+    )
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in ONNX_INPUT_NAMES}
+    dynamic_axes['logits'] = {0: 'batch'}
+    dynamic_axes['hidden_state'] = {0: 'batch', 1: 'sequence'}
+
+    logger.info(f"Exporting ONNX graph to {onnx_path}")
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                wrapper,
+                example_inputs,
+                str(tmp_path),
+                input_names=list(ONNX_INPUT_NAMES),
+                output_names=['logits', 'hidden_state'],
+                dynamic_axes=dynamic_axes,
+                opset_version=opset,
+                dynamo=False
+            )
+        os.replace(tmp_path, onnx_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return onnx_path
+
+
+class OnnxSequenceClassifier:
+    """
+    Callable stand-in for AutoModelForSequenceClassification backed by ONNX Runtime.
+
+    Calls return an object with `logits` and, when requested, `hidden_states`:
+    a tuple indexed like the PyTorch one in which only the exported layer is set.
+    """
+
+    def __init__(
+        self,
+        onnx_path: Union[str, Path],
+        hidden_layer: int,
+        num_hidden_layers: int,
+        num_threads: Optional[int] = None
+    ):
+        """
+        Initialize the ONNX Runtime session.
+
+        Args:
+            onnx_path: Path of a graph written by export_classifier_onnx
+            hidden_layer: Layer whose hidden states the graph outputs
+            num_hidden_layers: Number of encoder layers of the original model
+            num_threads: Intra-op threads (defaults to torch.get_num_threads())
+        """
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        self.session = ort.InferenceSession(
+            str(onnx_path), options, providers=['CPUExecutionProvider']
+        )
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.hidden_layer = hidden_layer
+        self.num_hidden_layers = num_hidden_layers
+
+    def __call__(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        token_type_ids=None,
+        output_hidden_states: bool = False,
+        **kwargs
+    ) -> SimpleNamespace:
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        feed = {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'token_type_ids': token_type_ids,
+        }
+        feed = {
+            name: value.detach().cpu().numpy().astype(np.int64)
+            for name, value in feed.items() if name in self.input_names
+        }
+        logits, hidden_state = self.session.run(['logits', 'hidden_state'], feed)
+
+        hidden_states = None
+        if output_hidden_states:
+            hidden_states = [None] * (self.num_hidden_layers + 1)
+            hidden_states[self.hidden_layer] = torch.from_numpy(hidden_state)
+            hidden_states = tuple(hidden_states)
+        return SimpleNamespace(logits=torch.from_numpy(logits), hidden_states=hidden_states)
+
+    def eval(self) -> 'OnnxSequenceClassifier':
+        return self
+
+    def to(self, device) -> 'OnnxSequenceClassifier':
+        if torch.device(device).type != 'cpu':
+            raise ValueError("The ONNX backend only runs on CPU")
+        return self
+
+
+def model_fingerprint(model_path: Union[str, Path]) -> str:
+    """Identifies a model directory by its path and the size and mtime of its weight files."""
+    model_path = Path(model_path).resolve()
+    weights = sorted(model_path.glob('*.safetensors')) + sorted(model_path.glob('*.bin'))
+    stamps = [f"{path.name}:{path.stat().st_size}:{path.stat().st_mtime_ns}" for path in weights]
+    return hashlib.sha1('\0'.join([str(model_path)] + stamps).encode('utf-8')).hexdigest()
+
+
+def default_onnx_path(model_path: Union[str, Path], hidden_layer: int) -> Path:
+    """
+    Return where the ONNX graph of a model is cached by default.
+
+    The file name carries the model's weight fingerprint, so retraining into
+    the same directory leads to a fresh export instead of the stale graph.
+    """
+    model_path = Path(model_path)
+    name = f'model_layer{hidden_layer}-{model_fingerprint(model_path)[:12]}.onnx'
+    if model_path.is_dir():
+        return model_path / 'onnx' / name
+    return Path('onnx_models') / model_path.name / name
+
+
+def prepare_backend(
+    model: torch.nn.Module,
+    tokenizer,
+    backend: str,
+    device: torch.device,
+    model_path: Union[str, Path],
+    hidden_layer: int,
+    onnx_path: Optional[Union[str, Path]] = None
+):
+    """
+    Convert a loaded fp32 classifier to the requested backend.
+
+    Args:
+        model: fp32 model in evaluation mode
+        tokenizer: Matching tokenizer (needed for ONNX export)
+        backend: One of BACKEND_CHOICES
+        device: Target device; int8 and onnx require CPU
+        model_path: Model path, used for the default ONNX location
+        hidden_layer: Hidden-state layer the ONNX graph must expose
+        onnx_path: Explicit ONNX file (exported if it doesn't exist; unlike
+            the default location it is not re-exported when the weights change)
+
+    Returns:
+        A model-like callable for the chosen backend
+
+    Raises:
+        ValueError: If the backend is unknown or unsupported on the device
+    """
+    if backend not in BACKEND_CHOICES:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {BACKEND_CHOICES}")
+    if backend == 'fp32':
+        return model
+    if device.type != 'cpu':
+        raise ValueError(f"The {backend} backend only runs on CPU, got device {device}")
+
+    if backend == 'int8':
+        logger.info("Applying dynamic int8 quantization to Linear layers")
+        return quantize_dynamic_int8(model)
+
+    default_path = onnx_path is None
+    onnx_path = Path(onnx_path) if onnx_path else default_onnx_path(model_path, hidden_layer)
+    if not onnx_path.exists():
+        export_classifier_onnx(model, tokenizer, onnx_path, hidden_layer)
+        if default_path:
+            # Graphs exported from earlier weights of the same model
+            for stale in onnx_path.parent.glob(f'model_layer{hidden_layer}-*.onnx'):
+                if stale != onnx_path:
+                    stale.unlink(missing_ok=True)
+    logger.info(f"Loading ONNX Runtime session from {onnx_path}")
+    return OnnxSequenceClassifier(onnx_path, hidden_layer, model.config.num_hidden_layers)
+
+
+def check_parity(
+    model_path: Union[str, Path],
+    texts: List[str],
+    backends: Sequence[str] = ('int8', 'onnx'),
+    batch_size: int = 32,
+    **engine_kwargs
+) -> Dict[str, Dict[str, float]]:
+    """
+    Compare backends against eager fp32 on the same texts.
+
+    Args:
+        model_path: Path to the fine-tuned model
+        texts: Texts to classify
+        backends: Backends to compare with fp32
+        batch_size: Inference batch size
+        **engine_kwargs: Additional arguments for SentimentInferenceEngine
+
+    Returns:
+        {backend: {'label_agreement', 'cls_cosine_mean', 'cls_cosine_min', 'prob_max_abs_diff'}}
+    """
+    from sequence_inference import SentimentInferenceEngine
+
+    def run(backend: str):
+        engine = SentimentInferenceEngine(model_path, device='cpu', backend=backend, **engine_kwargs)
+        labels, probs, vectors = [], [], []
+        for i in range(0, len(texts), batch_size):
+            batch_labels, batch_probs, batch_vectors = engine.infer_batch_sequencecls(texts[i:i + batch_size])
+            labels.extend(batch_labels)
+            probs.extend(batch_probs)
+            vectors.extend(batch_vectors)
+        return labels, np.asarray(probs, dtype=np.float32), torch.tensor(vectors, dtype=torch.float32)
+
+    reference_labels, reference_probs, reference_vectors = run('fp32')
+    report = {}
+    for backend in backends:
+        labels, probs, vectors = run(backend)
+        cosine = F.cosine_similarity(vectors, reference_vectors, dim=-1)
+        report[backend] = {
+            'label_agreement': float(np.mean([a == b for a, b in zip(labels, reference_labels)])),
+            'cls_cosine_mean': float(cosine.mean()),
+            'cls_cosine_min': float(cosine.min()),
+            'prob_max_abs_diff': float(np.abs(probs - reference_probs).max()),
+        }
+        logger.info(f"{backend} vs fp32: {report[backend]}")
+    return report
+
+
+def main():
+    """Run the backend parity check on a labelled CSV."""
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(
+        description='Compare int8 / ONNX inference backends against fp32',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--model_path', type=str, required=True, help='Path to the fine-tuned model')
+    parser.add_argument('--data', type=str, default='SC_2/test_SC_2.csv', help="CSV with a 'text' column")
+    parser.add_argument('--backends', nargs='+', choices=BACKEND_CHOICES[1:], default=list(BACKEND_CHOICES[1:]),
+                        help='Backends to compare with fp32')
+    parser.add_argument('--limit', type=int, default=None, help='Only use the first N texts')
+    parser.add_argument('--batch_size', type=int, default=32, help='Inference batch size')
+    args = parser.parse_args()
+
+    texts = pd.read_csv(args.data)['text'].dropna().astype(str).tolist()
+    if args.limit:
+        texts = texts[:args.limit]
+    report = check_parity(args.model_path, texts, args.backends, args.batch_size)
+    for backend, metrics in report.items():
+        print(f"{backend}: " + ", ".join(f"{name}={value:.4f}" for name, value in metrics.items()))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
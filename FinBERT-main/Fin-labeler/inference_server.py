@@ -0,0 +1,363 @@
+"""
+Asyncio micro-batching server around SentimentInferenceEngine.
+
+Concurrent requests are queued and flushed as one batch once max_batch_size
+texts are waiting or the oldest has waited max_wait_ms. Each batch runs as a
+single forward pass in a worker thread, and the results are fanned back out
+to the callers' futures. The server speaks a minimal HTTP/1.1 over localhost
+TCP or a Unix socket:
+
+    POST /predict  {"text": "..."} or {"texts": [...]}, optional "return_cls": true
+    GET  /stats    latency percentiles, the batch-size histogram and prediction cache counters
+    GET  /health
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from inference_backends import BACKEND_CHOICES, DEFAULT_BACKEND
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Constants
+DEFAULT_MAX_BATCH_SIZE = 32
+DEFAULT_MAX_WAIT_MS = 5.0
+DEFAULT_LATENCY_WINDOW = 10000
+LATENCY_PERCENTILES = (50, 90, 95, 99)
+MAX_BODY_BYTES = 16 * 1024 * 1024
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+                500: 'Internal Server Error'}
+
+
+class BatcherStats:
+    """
+    Latencies of the most recent requests and a histogram of flushed batch sizes.
+
+    Latency runs from submit() to the result being set, i.e. queueing plus
+    inference.
+    """
+
+    def __init__(self, latency_window: int = DEFAULT_LATENCY_WINDOW):
+        self.latencies_ms = deque(maxlen=latency_window)
+        self.batch_sizes = Counter()
+        self.requests = 0
+        self.errors = 0
+
+    def record_batch(self, size: int) -> None:
+        self.batch_sizes[size] += 1
+
+    def record_latency(self, seconds: float) -> None:
+        self.requests += 1
+        self.latencies_ms.append(seconds * 1000.0)
+
+    def snapshot(self) -> Dict:
+        """Return the counters as a JSON-serializable dict."""
+        latencies = np.asarray(self.latencies_ms, dtype=np.float64)
+        latency = {'count': int(latencies.size)}
+        if latencies.size:
+            latency.update({f'p{q}': float(np.percentile(latencies, q)) for q in LATENCY_PERCENTILES})
+            latency.update({'mean': float(latencies.mean()), 'max': float(latencies.max())})
+        num_batches = sum(self.batch_sizes.values())
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': num_batches,
+            'mean_batch_size': (sum(k * v for k, v in self.batch_sizes.items()) / num_batches
+                                if num_batches else 0.0),
+            'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            'latency_ms': latency,
+        }
+
+
+class MicroBatcher:
+    """
+    Collects texts submitted from many coroutines into batched engine calls.
+
+    The engine runs on a single worker thread, so the event loop keeps
+    accepting requests while a batch is being computed and the next batch
+    fills up in the meantime.
+    """
+
+    def __init__(
+        self,
+        engine,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+        stats: Optional[BatcherStats] = None
+    ):
+        """
+        Initialize the batcher.
+
+        Args:
+            engine: SentimentInferenceEngine (anything with infer_batch and hidden_layer)
+            max_batch_size: Flush as soon as this many texts are queued
+            max_wait_ms: Flush once the oldest queued text has waited this long
+            stats: Counters to update (a new BatcherStats by default)
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.stats = stats or BatcherStats()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+
+    async def start(self) -> None:
+        """Start the batching loop on the running event loop."""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Cancel the batching loop and shut down the worker thread."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, text: str, return_cls: bool = False) -> Dict:
+        """
+        Queue one text and wait for its prediction.
+
+        Returns:
+            {'label', 'probs'} plus 'cls_vector' when return_cls is set
+
+        Raises:
+            ValueError: If the text is empty
+        """
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError("Text must be a non-empty string")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, return_cls, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self) -> List[Tuple]:
+        """Wait for a first item, then gather more until the batch is full or the wait expires."""
+        batch = [await self._queue.get()]
+        deadline = batch[0][3] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                # Take whatever is already queued without waiting any longer
+                while len(batch) < self.max_batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            texts = [item[0] for item in batch]
+            layers = [self.engine.hidden_layer] if any(item[1] for item in batch) else []
+            self.stats.record_batch(len(batch))
+            try:
+                result = await loop.run_in_executor(self._executor, self.engine.infer_batch, texts, layers)
+            except Exception as e:
+                logger.error(f"Batch of {len(batch)} failed: {e}")
+                self.stats.errors += len(batch)
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            now = time.perf_counter()
+            labels = result.labels
+            for i, (_, return_cls, future, submitted) in enumerate(batch):
+                prediction = {'label': labels[i], 'probs': result.probs[i].tolist()}
+                if return_cls:
+                    prediction['cls_vector'] = result.cls_vectors[self.engine.hidden_layer][i].tolist()
+                self.stats.record_latency(now - submitted)
+                # The caller may have gone away (e.g. a dropped connection)
+                if not future.done():
+                    future.set_result(prediction)
+
+
+class InferenceHTTPServer:
+    """Minimal HTTP/1.1 front end (keep-alive, JSON bodies) for a MicroBatcher."""
+
+    def __init__(self, batcher: MicroBatcher):
+        self.batcher = batcher
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                except ValueError:
+                    await self._respond(writer, 400, {'error': 'Malformed request line'}, keep_alive=False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                # Digits only: int() would also take signs, spaces and underscores
+                raw_length = headers.get('content-length', '') or '0'
+                if not (raw_length.isascii() and raw_length.isdigit()):
+                    await self._respond(writer, 400, {'error': 'Invalid Content-Length'}, keep_alive=False)
+                    break
+                length = int(raw_length)
+                if length > MAX_BODY_BYTES:
+                    await self._respond(writer, 413, {'error': 'Request body too large'}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                status, payload = await self._dispatch(method, path.split('?', 1)[0], body)
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, body: bytes) -> Tuple[int, Dict]:
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/stats':
+            stats = self.batcher.stats.snapshot()
+            get_cache_stats = getattr(self.batcher.engine, 'get_cache_stats', None)
+            if get_cache_stats is not None and get_cache_stats() is not None:
+                stats['cache'] = get_cache_stats()
+            return 200, stats
+        if method != 'POST' or path != '/predict':
+            return 404, {'error': f'No route for {method} {path}'}
+
+        try:
+            request = json.loads(body or b'{}')
+            single = 'text' in request
+            texts = [request['text']] if single else request['texts']
+            if not isinstance(texts, list) or not texts:
+                raise ValueError("'texts' must be a non-empty list")
+            return_cls = bool(request.get('return_cls', False))
+            predictions = await asyncio.gather(*(self.batcher.submit(t, return_cls) for t in texts))
+        except KeyError as e:
+            return 400, {'error': f"Missing field {e}, expected 'text' or 'texts'"}
+        except (TypeError, ValueError) as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            logger.error(f"Prediction failed: {e}")
+            return 500, {'error': str(e)}
+        return 200, predictions[0] if single else {'predictions': predictions}
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, payload: Dict, keep_alive: bool) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        head = (
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+
+async def serve(
+    engine,
+    host: str = '127.0.0.1',
+    port: int = 8000,
+    unix_socket: Optional[str] = None,
+    max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    max_wait_ms: float = DEFAULT_MAX_WAIT_MS
+) -> None:
+    """
+    Serve an engine until cancelled.
+
+    Args:
+        engine: SentimentInferenceEngine to batch requests for
+        host: TCP host (ignored with unix_socket)
+        port: TCP port (ignored with unix_socket)
+        unix_socket: Path of a Unix socket to listen on instead of TCP
+        max_batch_size: Flush as soon as this many texts are queued
+        max_wait_ms: Flush once the oldest queued text has waited this long
+    """
+    batcher = MicroBatcher(engine, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    await batcher.start()
+    http = InferenceHTTPServer(batcher)
+    if unix_socket:
+        server = await asyncio.start_unix_server(http.handle_connection, path=unix_socket)
+        logger.info(f"Serving on unix socket {unix_socket}")
+    else:
+        server = await asyncio.start_server(http.handle_connection, host=host, port=port)
+        logger.info(f"Serving on http://{host}:{port}")
+    logger.info(f"Micro-batching: max_batch_size={max_batch_size}, max_wait_ms={max_wait_ms}")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+        logger.info(f"Final stats: {json.dumps(batcher.stats.snapshot())}")
+
+
+def main():
+    """Load the engine and serve it over HTTP."""
+    from sequence_inference import SentimentInferenceEngine
+
+    parser = argparse.ArgumentParser(
+        description='Serve SentimentInferenceEngine with dynamic micro-batching',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--model_path', type=str, required=True, help='Path to the fine-tuned model')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='TCP host to bind')
+    parser.add_argument('--port', type=int, default=8000, help='TCP port to bind')
+    parser.add_argument('--unix_socket', type=str, default=None, help='Listen on this Unix socket instead of TCP')
+    parser.add_argument('--max_batch_size', type=int, default=DEFAULT_MAX_BATCH_SIZE,
+                        help='Flush a batch as soon as this many texts are queued')
+    parser.add_argument('--max_wait_ms', type=float, default=DEFAULT_MAX_WAIT_MS,
+                        help='Flush once the oldest queued text has waited this long')
+    parser.add_argument('--device', type=str, default=None, help='Device (auto-detected if omitted)')
+    parser.add_argument('--backend', choices=BACKEND_CHOICES, default=DEFAULT_BACKEND, help='Inference backend')
+    parser.add_argument('--cache_size', type=int, default=0,
+                        help='Cache the predictions of up to this many distinct texts (0 disables)')
+    args = parser.parse_args()
+
+    engine = SentimentInferenceEngine(
+        args.model_path, device=args.device, backend=args.backend, cache_size=args.cache_size
+    )
+    try:
+        asyncio.run(serve(
+            engine,
+            host=args.host,
+            port=args.port,
+            unix_socket=args.unix_socket,
+            max_batch_size=args.max_batch_size,
+            max_wait_ms=args.max_wait_ms
+        ))
+    except KeyboardInterrupt:
+        logger.info("Server stopped")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -0,0 +1,109 @@
+"""
+Bounded in-memory LRU cache of per-text predictions.
+
+SentimentInferenceEngine looks every text of a batch up here, sends only the
+misses to the model and merges the results back in input order. Keys combine
+the engine's model identity with the text after whitespace normalization, so
+reposted headlines that differ only in spacing share one entry, and one cache
+can be shared by several engines.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+# Constants
+DEFAULT_CACHE_SIZE = 10000
+
+
+def normalize_text(text: str) -> str:
+    """
+    Collapse whitespace runs to single spaces and strip the ends.
+
+    The BERT tokenizer only uses whitespace to split words, so texts that
+    normalize to the same string are tokenized identically.
+    """
+    return ' '.join(text.split())
+
+
+class PredictionCache:
+    """
+    Thread-safe LRU mapping (model identity, normalized text) to one text's prediction.
+
+    An entry is a dict with 'label_id', 'logits', 'probs', 'num_windows' and
+    'cls' ({layer: vector}). A lookup only hits if the entry holds the CLS
+    vectors of every requested layer; recomputed entries keep the layers
+    stored before. hits / misses count lookups, evictions count entries
+    dropped to stay within max_entries.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_CACHE_SIZE):
+        """
+        Initialize an empty cache.
+
+        Args:
+            max_entries: Maximum number of texts kept
+
+        Raises:
+            ValueError: If max_entries is not positive
+        """
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: 'OrderedDict[Tuple[Hashable, str], Dict]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_id: Hashable, text: str) -> Tuple[Hashable, str]:
+        """Cache key of a text for a given model identity."""
+        return model_id, normalize_text(text)
+
+    def get_many(self, keys: List[Tuple[Hashable, str]], layers: Sequence[int]) -> List[Optional[Dict]]:
+        """Return the entry of every key, or None where it is missing or lacks a layer."""
+        entries = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and all(layer in entry['cls'] for layer in layers):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    entries.append(entry)
+                else:
+                    self.misses += 1
+                    entries.append(None)
+        return entries
+
+    def put_many(self, keys: List[Tuple[Hashable, str]], entries: List[Dict]) -> None:
+        """Store entries, evicting the least recently used ones beyond max_entries."""
+        with self._lock:
+            for key, entry in zip(keys, entries):
+                previous = self._entries.pop(key, None)
+                if previous is not None:
+                    entry = {**entry, 'cls': {**previous['cls'], **entry['cls']}}
+                self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop all entries; the counters are kept."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, float]:
+        """Return the counters, the hit rate and the current size."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+        }
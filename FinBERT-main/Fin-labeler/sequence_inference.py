@@ -5,14 +5,22 @@ This module provides a professional framework for performing batch inference
 on sentiment analysis tasks using pre-trained BERT models.
 """
 
+import contextlib
+import copy
 import logging
+import threading
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
 import torch.nn.functional as F
-from transformers import AutoModelForSequenceClassification, BertTokenizer
+from transformers import AutoModelForSequenceClassification
+
+from inference_backends import BACKEND_CHOICES, DEFAULT_BACKEND, prepare_backend
+from prediction_cache import PredictionCache
+from tokenization import load_tokenizer
 
 # Configure logging
 logging.basicConfig(
@@ -26,6 +34,228 @@ DEFAULT_MAX_LENGTH = 512
 DEFAULT_CLS_INDEX = 0
 DEFAULT_HIDDEN_LAYER = 12
 DEFAULT_SENTIMENT_LABELS = {0: '负面', 1: '正面'}
+DEFAULT_LONG_TEXT_STRIDE = 128
+DEFAULT_WINDOW_BATCH_SIZE = 32
+WINDOW_AGGREGATIONS = ('mean', 'max', 'length_weighted')
+CONCURRENCY_MODES = ('lock', 'threads')
+
+
+@dataclass
+class InferenceResult:
+    """
+    Output of one batch as contiguous numpy arrays.
+    
+    label_ids (batch,) int64 are codes into label_names; logits and softmax
+    probs are float32 (batch, num_labels); cls_vectors holds float32
+    (batch, hidden_size) CLS vectors per requested layer. In long-text mode
+    num_windows holds the number of windows each text was split into.
+    Python lists are only built on request (`labels`, `to_lists`), and
+    `to_arrow` hands the buffers to pyarrow without per-element work.
+    """
+    label_ids: np.ndarray
+    label_names: List[str]
+    logits: np.ndarray
+    probs: np.ndarray
+    cls_vectors: Dict[int, np.ndarray] = field(default_factory=dict)
+    num_windows: Optional[np.ndarray] = None
+    
+    def __post_init__(self):
+        self.label_ids = np.ascontiguousarray(self.label_ids, dtype=np.int64)
+        self.logits = np.ascontiguousarray(self.logits, dtype=np.float32)
+        self.probs = np.ascontiguousarray(self.probs, dtype=np.float32)
+        self.cls_vectors = {
+            layer: np.ascontiguousarray(vectors, dtype=np.float32) for layer, vectors in self.cls_vectors.items()
+        }
+    
+    def __len__(self) -> int:
+        return len(self.label_ids)
+    
+    @property
+    def labels(self) -> List[str]:
+        """Predicted label names, converted from label_ids on each access."""
+        return np.asarray(self.label_names, dtype=object)[self.label_ids].tolist()
+    
+    def to_lists(self, layer: int) -> Tuple[List[str], List[List[float]], List[List[float]]]:
+        """Return (labels, probs, CLS vectors of `layer`) as nested Python lists."""
+        return self.labels, self.probs.tolist(), self.cls_vectors[layer].tolist()
+    
+    def to_arrow(self, layers: Optional[Sequence[int]] = None):
+        """
+        Return the result as a pyarrow Table.
+        
+        Columns: label (dictionary-encoded over label_names), prob_<label> per
+        class, cls_<layer> as fixed-size float32 lists for each of `layers`
+        (default: all stored layers) and num_windows in long-text mode.
+        """
+        import pyarrow as pa
+        
+        columns = {
+            'label': pa.DictionaryArray.from_arrays(
+                pa.array(self.label_ids.astype(np.int32)), pa.array(self.label_names, type=pa.string())
+            )
+        }
+        # One transpose makes every class column contiguous
+        for name, column in zip(self.label_names, np.ascontiguousarray(self.probs.T)):
+            columns[f'prob_{name}'] = pa.array(column)
+        for layer in (self.cls_vectors if layers is None else layers):
+            vectors = self.cls_vectors[layer]
+            columns[f'cls_{layer}'] = pa.FixedSizeListArray.from_arrays(pa.array(vectors.reshape(-1)), vectors.shape[1])
+        if self.num_windows is not None:
+            columns['num_windows'] = pa.array(self.num_windows)
+        return pa.table(columns)
+
+
+def _hidden_state_modules(model) -> Optional[List[torch.nn.Module]]:
+    """
+    Return the modules whose outputs are hidden_states[0..num_hidden_layers]
+    (the embeddings, then every encoder layer), or None if the model does not
+    expose them, e.g. the ONNX Runtime backend.
+    """
+    base_model = getattr(model, 'base_model', None)
+    embeddings = getattr(base_model, 'embeddings', None)
+    encoder_layers = getattr(getattr(base_model, 'encoder', None), 'layer', None)
+    if embeddings is None or encoder_layers is None:
+        return None
+    return [embeddings, *encoder_layers]
+
+
+def forward_with_cls_layers(
+    model,
+    inputs: Dict[str, torch.Tensor],
+    layers: Sequence[int],
+    cls_index: int = DEFAULT_CLS_INDEX
+) -> Tuple[torch.Tensor, Dict[int, torch.Tensor]]:
+    """
+    Run a single forward pass and return the logits and the CLS vectors of the
+    requested layers.
+
+    Layers are indexed like `hidden_states` (0 is the embedding output). Rather
+    than output_hidden_states=True, which keeps all num_hidden_layers + 1
+    hidden-state tensors alive, forward hooks copy out just the CLS rows of
+    the requested layers. A model without accessible layers (the ONNX
+    backend) falls back to its own hidden_states, which must include them.
+    Hooks are attached for the duration of the call only and ignore forward
+    passes run by other threads on the same model.
+
+    Args:
+        model: Sequence classification model or backend stand-in
+        inputs: Tokenized batch on the model's device
+        layers: Hidden-state layers to return
+        cls_index: Position of the CLS token
+
+    Returns:
+        Tuple of (logits, {layer: CLS vectors})
+
+    Raises:
+        ValueError: If the backend does not provide a requested layer
+    """
+    layers = list(dict.fromkeys(layers))
+    cls_vectors = {}
+
+    modules = _hidden_state_modules(model)
+    if modules is None:
+        outputs = model(**inputs, output_hidden_states=bool(layers))
+        for layer in layers:
+            states = outputs.hidden_states[layer] if outputs.hidden_states is not None else None
+            if states is None:
+                raise ValueError(f"Hidden layer {layer} is not available from this backend")
+            cls_vectors[layer] = states[:, cls_index, :]
+        return outputs.logits, cls_vectors
+
+    caller = threading.get_ident()
+
+    def capture(layer):
+        def hook(module, args, output):
+            if threading.get_ident() != caller:
+                return
+            hidden_states = output[0] if isinstance(output, tuple) else output
+            cls_vectors[layer] = hidden_states[:, cls_index, :].clone()
+        return hook
+
+    handles = [modules[layer].register_forward_hook(capture(layer)) for layer in layers]
+    try:
+        logits = model(**inputs).logits
+    finally:
+        for handle in handles:
+            handle.remove()
+    return logits, cls_vectors
+
+
+def truncate_encoder(model, num_layers: int) -> torch.nn.Module:
+    """
+    Return the base encoder of a classifier cut after its first num_layers layers.
+    
+    The result shares its parameters with `model` (nothing is copied) and has no
+    pooler, so its last_hidden_state equals hidden_states[num_layers] of the
+    full model at roughly num_layers / num_hidden_layers of the cost.
+    
+    Args:
+        model: Sequence classification model with base_model.encoder.layer
+        num_layers: Number of encoder layers to keep (0 keeps the embeddings only)
+        
+    Returns:
+        Truncated encoder module in evaluation mode
+        
+    Raises:
+        ValueError: If the model does not expose its encoder layers
+    """
+    base_model = getattr(model, 'base_model', None)
+    encoder = getattr(base_model, 'encoder', None)
+    if getattr(encoder, 'layer', None) is None:
+        raise ValueError("Layer truncation needs a PyTorch model with base_model.encoder.layer")
+    
+    # Shallow copies with their own submodule tables, so the original keeps every layer
+    truncated_encoder = copy.copy(encoder)
+    truncated_encoder._modules = dict(encoder._modules)
+    truncated_encoder.layer = torch.nn.ModuleList(list(encoder.layer)[:num_layers])
+    truncated = copy.copy(base_model)
+    truncated._modules = dict(base_model._modules)
+    truncated.encoder = truncated_encoder
+    truncated.pooler = None
+    return truncated.eval()
+
+
+def split_into_windows(token_ids: List[int], window_tokens: int, stride: int) -> List[List[int]]:
+    """
+    Split token ids into windows of at most window_tokens ids, each overlapping
+    the previous one by stride ids. A text that fits yields a single window.
+    """
+    step = window_tokens - stride
+    return [token_ids[start:start + window_tokens] for start in range(0, max(len(token_ids) - stride, 1), step)]
+
+
+def aggregate_windows(
+    values: torch.Tensor,
+    owners: torch.Tensor,
+    num_texts: int,
+    lengths: torch.Tensor,
+    aggregation: str = 'mean'
+) -> torch.Tensor:
+    """
+    Combine per-window rows (logits or CLS vectors) into one row per text.
+
+    Args:
+        values: (num_windows, dim) window rows
+        owners: (num_windows,) index of the text each window belongs to
+        num_texts: Number of texts
+        lengths: (num_windows,) token count of each window
+        aggregation: 'mean', 'max' (element-wise) or 'length_weighted' (mean
+            weighted by window token count)
+
+    Returns:
+        (num_texts, dim) aggregated rows
+    """
+    if aggregation not in WINDOW_AGGREGATIONS:
+        raise ValueError(f"Unknown window aggregation '{aggregation}', expected one of {WINDOW_AGGREGATIONS}")
+    dim = values.shape[1]
+    if aggregation == 'max':
+        index = owners.unsqueeze(-1).expand(-1, dim)
+        return values.new_full((num_texts, dim), float('-inf')).scatter_reduce(0, index, values, 'amax')
+
+    weights = lengths.to(values.dtype) if aggregation == 'length_weighted' else torch.ones_like(values[:, 0])
+    totals = values.new_zeros(num_texts).index_add(0, owners, weights)
+    sums = values.new_zeros((num_texts, dim)).index_add(0, owners, values * weights.unsqueeze(-1))
+    return sums / totals.unsqueeze(-1)
 
 
 class SentimentInferenceEngine:
@@ -34,6 +264,9 @@ class SentimentInferenceEngine:
     
     This class provides batch inference capabilities for sentiment classification
     with support for extracting both predictions and hidden representations.
+    
+    An engine keeps all of its state on the instance, so several engines can
+    coexist and one engine can be called from a thread pool (see `concurrency`).
     """
     
     def __init__(
@@ -42,8 +275,18 @@ class SentimentInferenceEngine:
         device: Optional[str] = None,
         max_length: int = DEFAULT_MAX_LENGTH,
         cls_index: int = DEFAULT_CLS_INDEX,
-        hidden_layer: int = DEFAULT_HIDDEN_LAYER,
-        id2label: Optional[Dict[int, str]] = None
+        hidden_layer: Optional[int] = None,
+        id2label: Optional[Dict[int, str]] = None,
+        backend: str = DEFAULT_BACKEND,
+        onnx_path: Optional[Union[str, Path]] = None,
+        long_text_stride: Optional[int] = None,
+        window_aggregation: str = 'mean',
+        window_batch_size: int = DEFAULT_WINDOW_BATCH_SIZE,
+        concurrency: str = 'lock',
+        threads_per_call: Optional[int] = None,
+        cache_size: int = 0,
+        prediction_cache: Optional[PredictionCache] = None,
+        use_fast_tokenizer: bool = True
     ):
         """
         Initialize the inference engine.
@@ -53,25 +296,77 @@ class SentimentInferenceEngine:
             device: Device to run inference on (auto-detected if None)
             max_length: Maximum sequence length for tokenization
             cls_index: Index of the CLS token (default: 0)
-            hidden_layer: Layer index for hidden state extraction (default: 12)
+            hidden_layer: Layer index for hidden state extraction (default: 12,
+                or the last layer of shallower models such as distilled students)
             id2label: Label mapping dictionary (default: sentiment labels)
+            backend: Inference backend, one of 'fp32', 'int8' (dynamic int8
+                quantization) or 'onnx' (ONNX Runtime); int8 and onnx run on CPU
+            onnx_path: ONNX graph to load, exported there if missing
+                (default: <model_path>/onnx/)
+            long_text_stride: If set, infer_batch runs in long-text mode (see
+                infer_batch_long) with windows overlapping by this many tokens
+                instead of truncating at max_length
+            window_aggregation: How window logits and CLS vectors are combined
+                per text: 'mean', 'max' or 'length_weighted'
+            window_batch_size: Windows per forward pass in long-text mode
+            concurrency: How calls from several threads share the model:
+                'lock' runs one forward pass at a time; 'threads' runs them
+                concurrently, each with torch limited to threads_per_call
+                intra-op threads
+            threads_per_call: torch.set_num_threads budget applied in every
+                calling thread in 'threads' mode (default: leave unchanged).
+                With OpenMP builds of torch the setting is per thread, so
+                workers x threads_per_call should not exceed the core count
+            cache_size: If positive, infer_batch keeps the predictions of up to
+                this many distinct (whitespace-normalized) texts in an LRU cache
+            prediction_cache: Cache to use instead, e.g. one shared by several
+                engines; entries are keyed by model_identity
+            use_fast_tokenizer: Use the Rust-backed fast tokenizer when the
+                model provides one (check with tokenization.py)
         
         Raises:
-            ValueError: If model_path is empty or invalid
+            ValueError: If model_path is empty or invalid, the backend, window
+                aggregation or concurrency mode is unknown
             FileNotFoundError: If model_path doesn't exist
         """
         if not model_path:
             raise ValueError("Model path cannot be empty")
+        if backend not in BACKEND_CHOICES:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {BACKEND_CHOICES}")
+        if window_aggregation not in WINDOW_AGGREGATIONS:
+            raise ValueError(
+                f"Unknown window aggregation '{window_aggregation}', expected one of {WINDOW_AGGREGATIONS}"
+            )
+        if concurrency not in CONCURRENCY_MODES:
+            raise ValueError(f"Unknown concurrency mode '{concurrency}', expected one of {CONCURRENCY_MODES}")
             
         self.model_path = Path(model_path)
         self.max_length = max_length
         self.cls_index = cls_index
         self.hidden_layer = hidden_layer
         self.id2label = id2label or DEFAULT_SENTIMENT_LABELS.copy()
+        # Class i of the logits is named label_names[i]
+        self.label_names = [self.id2label[i] for i in range(len(self.id2label))]
+        self.backend = backend
+        self.onnx_path = onnx_path
+        self.long_text_stride = long_text_stride
+        self.window_aggregation = window_aggregation
+        self.window_batch_size = window_batch_size
+        self.concurrency = concurrency
+        self.threads_per_call = threads_per_call
+        self._forward_lock = threading.Lock()
+        self._thread_state = threading.local()
+        if prediction_cache is None and cache_size > 0:
+            prediction_cache = PredictionCache(cache_size)
+        self.prediction_cache = prediction_cache
+        self.use_fast_tokenizer = use_fast_tokenizer
+        self._owner_thread = threading.get_ident()
+        self._truncated_encoders = {}
         
-        # Auto-detect device if not specified
+        # Auto-detect device if not specified; the int8 and ONNX backends are CPU-only
         if device is None:
-            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            use_cuda = torch.cuda.is_available() and backend == DEFAULT_BACKEND
+            self.device = torch.device("cuda" if use_cuda else "cpu")
         else:
             self.device = torch.device(device)
             
@@ -80,13 +375,14 @@ class SentimentInferenceEngine:
         # Initialize model and tokenizer
         self.tokenizer = None
         self.model = None
+        self.num_hidden_layers = None
         self._load_model_and_tokenizer()
         
     def _load_model_and_tokenizer(self) -> None:
         """Load pre-trained model and tokenizer."""
         try:
             logger.info(f"Loading tokenizer from {self.model_path}")
-            self.tokenizer = BertTokenizer.from_pretrained(self.model_path)
+            self.tokenizer = load_tokenizer(self.model_path, use_fast=self.use_fast_tokenizer)
             
             logger.info(f"Loading model from {self.model_path}")
             self.model = AutoModelForSequenceClassification.from_pretrained(
@@ -95,6 +391,20 @@ class SentimentInferenceEngine:
             
             # Set model to evaluation mode
             self.model.eval()
+            self.num_hidden_layers = self.model.config.num_hidden_layers
+            self.hidden_size = self.model.config.hidden_size
+            if self.hidden_layer is None:
+                self.hidden_layer = min(DEFAULT_HIDDEN_LAYER, self.num_hidden_layers)
+            
+            self.model = prepare_backend(
+                self.model,
+                self.tokenizer,
+                self.backend,
+                self.device,
+                self.model_path,
+                self.hidden_layer,
+                onnx_path=self.onnx_path
+            )
             
             logger.info("Model and tokenizer loaded successfully")
             
@@ -102,6 +412,360 @@ class SentimentInferenceEngine:
             logger.error(f"Failed to load model from {self.model_path}: {e}")
             raise
     
+    def _local_tokenizer(self):
+        """
+        Return the tokenizer for the calling thread.
+        
+        A fast tokenizer keeps padding/truncation state in its Rust object and
+        can fail when several threads use it at once, so every thread besides
+        the one that created the engine works on its own copy.
+        """
+        if not self.tokenizer.is_fast or threading.get_ident() == self._owner_thread:
+            return self.tokenizer
+        tokenizer = getattr(self._thread_state, 'tokenizer', None)
+        if tokenizer is None:
+            tokenizer = copy.deepcopy(self.tokenizer)
+            self._thread_state.tokenizer = tokenizer
+        return tokenizer
+    
+    def _check_inputs(self, texts: List[str], layers: Optional[Sequence[int]]) -> List[int]:
+        """Validate a batch request and return the layers to extract."""
+        if not texts:
+            raise ValueError("Input texts cannot be empty")
+            
+        if not all(isinstance(text, str) and text.strip() for text in texts):
+            raise ValueError("All texts must be non-empty strings")
+        return self._check_layers(layers)
+    
+    def _check_layers(self, layers: Optional[Sequence[int]]) -> List[int]:
+        """Return the layers to extract, defaulting to hidden_layer."""
+        layers = [self.hidden_layer] if layers is None else list(layers)
+        num_layers = self.num_hidden_layers
+        invalid = [layer for layer in layers if not -(num_layers + 1) <= layer <= num_layers]
+        if invalid:
+            raise ValueError(f"Hidden layers {invalid} out of range for a {num_layers}-layer model")
+        return layers
+    
+    @contextlib.contextmanager
+    def _forward_context(self):
+        """Apply the engine's concurrency mode (and no_grad) around a forward pass."""
+        if self.concurrency == 'lock':
+            with self._forward_lock, torch.no_grad():
+                yield
+            return
+        
+        if self.threads_per_call and not getattr(self._thread_state, 'threads_set', False):
+            torch.set_num_threads(self.threads_per_call)
+            self._thread_state.threads_set = True
+        with torch.no_grad():
+            yield
+    
+    def _forward(
+        self,
+        inputs: Dict[str, torch.Tensor],
+        layers: Sequence[int]
+    ) -> Tuple[torch.Tensor, Dict[int, torch.Tensor]]:
+        """Run forward_with_cls_layers under the engine's concurrency mode."""
+        with self._forward_context():
+            return forward_with_cls_layers(self.model, inputs, layers, self.cls_index)
+    
+    def _truncated_encoder(self, num_layers: int) -> Optional[torch.nn.Module]:
+        """Return the encoder cut after num_layers layers (built once), or None for the ONNX backend."""
+        if _hidden_state_modules(self.model) is None:
+            return None
+        encoder = self._truncated_encoders.get(num_layers)
+        if encoder is None:
+            with self._forward_lock:
+                encoder = self._truncated_encoders.get(num_layers)
+                if encoder is None:
+                    logger.info(f"Building a {num_layers}-layer truncated encoder")
+                    encoder = truncate_encoder(self.model, num_layers)
+                    self._truncated_encoders[num_layers] = encoder
+        return encoder
+    
+    def _build_result(
+        self,
+        logits: torch.Tensor,
+        cls_vectors: Dict[int, torch.Tensor],
+        num_windows: Optional[np.ndarray] = None
+    ) -> InferenceResult:
+        """Turn logits and CLS vectors into an InferenceResult of numpy arrays."""
+        probs = F.softmax(logits.float(), dim=-1)
+        return InferenceResult(
+            label_ids=logits.argmax(dim=-1).cpu().numpy(),
+            label_names=self.label_names,
+            logits=logits.float().cpu().numpy(),
+            probs=probs.cpu().numpy(),
+            cls_vectors={layer: vectors.float().cpu().numpy() for layer, vectors in cls_vectors.items()},
+            num_windows=num_windows
+        )
+    
+    @property
+    def model_identity(self) -> Tuple:
+        """Model and settings that determine a text's prediction; part of every cache key."""
+        return (
+            str(self.model_path.resolve()), self.backend, self.max_length, self.cls_index,
+            self.long_text_stride, self.window_aggregation
+        )
+    
+    def _infer_cached(self, texts: List[str], layers: List[int]) -> InferenceResult:
+        """Serve cached texts from prediction_cache and run the model on the rest."""
+        cache = self.prediction_cache
+        keys = [cache.make_key(self.model_identity, text) for text in texts]
+        entries = cache.get_many(keys, layers)
+        
+        # Texts missing from the cache, each normalized text sent to the model once
+        missing = {}
+        for i, (key, entry) in enumerate(zip(keys, entries)):
+            if entry is None:
+                missing.setdefault(key, i)
+        if missing:
+            result = self._infer_uncached([texts[i] for i in missing.values()], layers)
+            computed = [
+                {
+                    'label_id': result.label_ids[row],
+                    'logits': result.logits[row],
+                    'probs': result.probs[row],
+                    'num_windows': None if result.num_windows is None else int(result.num_windows[row]),
+                    'cls': {layer: vectors[row] for layer, vectors in result.cls_vectors.items()},
+                }
+                for row in range(len(missing))
+            ]
+            cache.put_many(list(missing), computed)
+            computed = dict(zip(missing, computed))
+            entries = [computed[key] if entry is None else entry for key, entry in zip(keys, entries)]
+        
+        num_windows = None
+        if self.long_text_stride is not None:
+            num_windows = np.array([entry['num_windows'] for entry in entries])
+        return InferenceResult(
+            label_ids=np.array([entry['label_id'] for entry in entries]),
+            label_names=self.label_names,
+            logits=np.stack([entry['logits'] for entry in entries]),
+            probs=np.stack([entry['probs'] for entry in entries]),
+            cls_vectors={layer: np.stack([entry['cls'][layer] for entry in entries]) for layer in layers},
+            num_windows=num_windows
+        )
+    
+    def get_cache_stats(self) -> Optional[Dict[str, float]]:
+        """Return the prediction cache counters, or None without a cache."""
+        return self.prediction_cache.stats() if self.prediction_cache is not None else None
+    
+    def infer_batch(
+        self,
+        texts: List[str],
+        layers: Optional[Sequence[int]] = None
+    ) -> InferenceResult:
+        """
+        Classify a batch in a single forward pass.
+        
+        In long-text mode (long_text_stride set) this delegates to infer_batch_long.
+        With a prediction cache only the texts not seen before are sent to the
+        model, and cached and new results are merged in input order.
+        
+        Args:
+            texts: List of input texts to classify
+            layers: Hidden-state layers whose CLS vectors to return
+                (default: [hidden_layer]; an empty list returns none)
+            
+        Returns:
+            InferenceResult with labels, logits, probabilities and CLS vectors
+            
+        Raises:
+            ValueError: If texts are empty or a layer is out of range
+        """
+        if self.prediction_cache is not None:
+            return self._infer_cached(texts, self._check_inputs(texts, layers))
+        return self._infer_uncached(texts, layers)
+    
+    def _infer_uncached(self, texts: List[str], layers: Optional[Sequence[int]]) -> InferenceResult:
+        """Run the model on every text (infer_batch without the prediction cache)."""
+        if self.long_text_stride is not None:
+            return self.infer_batch_long(texts, layers=layers)
+        layers = self._check_inputs(texts, layers)
+        
+        inputs = self._local_tokenizer()(
+            texts,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=self.max_length
+        ).to(self.device)
+        
+        logits, cls_vectors = self._forward(inputs, layers)
+        return self._build_result(logits, cls_vectors)
+    
+    def infer_batch_long(
+        self,
+        texts: List[str],
+        layers: Optional[Sequence[int]] = None,
+        stride: Optional[int] = None,
+        aggregation: Optional[str] = None
+    ) -> InferenceResult:
+        """
+        Classify texts of any length with overlapping max_length windows.
+        
+        Each text is split into windows of max_length tokens (special tokens
+        included) that overlap by `stride` tokens. The windows of all texts are
+        sorted by length and batched together, window_batch_size at a time.
+        Window logits and CLS vectors are then aggregated per text, and the
+        probabilities are the softmax of the aggregated logits. A text that fits
+        in max_length gives the same result as infer_batch without long-text mode.
+        
+        Args:
+            texts: List of input texts to classify
+            layers: Hidden-state layers whose CLS vectors to return
+                (default: [hidden_layer])
+            stride: Overlap between windows in tokens
+                (default: long_text_stride, or DEFAULT_LONG_TEXT_STRIDE)
+            aggregation: 'mean', 'max' or 'length_weighted' (default: window_aggregation)
+            
+        Returns:
+            InferenceResult with per-text num_windows
+            
+        Raises:
+            ValueError: If texts are empty, a layer is out of range or the stride
+                does not leave room for new tokens in every window
+        """
+        layers = self._check_inputs(texts, layers)
+        if stride is None:
+            stride = self.long_text_stride if self.long_text_stride is not None else DEFAULT_LONG_TEXT_STRIDE
+        aggregation = aggregation or self.window_aggregation
+        tokenizer = self._local_tokenizer()
+        window_tokens = self.max_length - tokenizer.num_special_tokens_to_add(pair=False)
+        if not 0 <= stride < window_tokens:
+            raise ValueError(f"Stride must be in [0, {window_tokens}), got {stride}")
+        
+        windows, owners = [], []
+        token_ids = tokenizer(texts, add_special_tokens=False, verbose=False)['input_ids']
+        for text_index, ids in enumerate(token_ids):
+            for chunk in split_into_windows(ids, window_tokens, stride):
+                windows.append([tokenizer.cls_token_id] + chunk + [tokenizer.sep_token_id])
+                owners.append(text_index)
+        owners = torch.tensor(owners)
+        lengths = torch.tensor([len(window) for window in windows])
+        
+        window_logits = [None] * len(windows)
+        window_cls = {layer: [None] * len(windows) for layer in layers}
+        # Windows of all texts share the batches; sorting by length keeps padding low
+        order = sorted(range(len(windows)), key=lambda k: len(windows[k]))
+        for start in range(0, len(order), self.window_batch_size):
+            batch = order[start:start + self.window_batch_size]
+            inputs = tokenizer.pad(
+                [{'input_ids': windows[k]} for k in batch], padding=True, return_tensors="pt"
+            ).to(self.device)
+            logits, cls_vectors = self._forward(inputs, layers)
+            logits = logits.float().cpu()
+            for row, k in enumerate(batch):
+                window_logits[k] = logits[row]
+                for layer in layers:
+                    window_cls[layer][k] = cls_vectors[layer][row].float().cpu()
+        
+        logits = aggregate_windows(torch.stack(window_logits), owners, len(texts), lengths, aggregation)
+        cls_vectors = {
+            layer: aggregate_windows(torch.stack(rows), owners, len(texts), lengths, aggregation)
+            for layer, rows in window_cls.items()
+        }
+        num_windows = np.bincount(owners.numpy(), minlength=len(texts))
+        return self._build_result(logits, cls_vectors, num_windows)
+
+    def extract_features(self, texts: List[str], layer: Optional[int] = None) -> np.ndarray:
+        """
+        Return the CLS vectors of one hidden layer without computing logits.
+        
+        Only the first `layer` encoder layers are run, on an encoder truncated
+        once per layer and cached (weights are shared with the full model), so
+        layer 6 of a 12-layer model costs about half a full pass. Texts are
+        truncated at max_length. The ONNX backend has no separable layers: it
+        runs the full exported graph and only provides hidden_layer, the layer
+        the graph was exported with.
+        
+        Args:
+            texts: List of input texts
+            layer: Hidden-state layer as in `hidden_states` (default: hidden_layer)
+            
+        Returns:
+            (batch, hidden_size) float32 CLS vectors
+            
+        Raises:
+            ValueError: If texts are empty, the layer is out of range, or the
+                backend is onnx and the layer is not hidden_layer
+        """
+        layer = self._check_inputs(texts, [self.hidden_layer if layer is None else layer])[0]
+        num_layers = layer % (self.num_hidden_layers + 1)
+        encoder = self._truncated_encoder(num_layers)
+        if encoder is None:
+            if num_layers != self.hidden_layer % (self.num_hidden_layers + 1):
+                raise ValueError(f"The {self.backend} backend only provides hidden layer {self.hidden_layer}, "
+                                 f"the layer its graph was exported with; got layer {layer}")
+            return self.infer_batch(texts, layers=[layer]).cls_vectors[layer]
+        
+        inputs = self._local_tokenizer()(
+            texts,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=self.max_length
+        ).to(self.device)
+        with self._forward_context():
+            hidden_states = encoder(**inputs).last_hidden_state
+        return hidden_states[:, self.cls_index, :].float().cpu().numpy()
+    
+    def infer_encoded(
+        self,
+        input_ids: Union[Sequence[Sequence[int]], torch.Tensor, np.ndarray],
+        attention_mask: Optional[Union[Sequence[Sequence[int]], torch.Tensor, np.ndarray]] = None,
+        layers: Optional[Sequence[int]] = None
+    ) -> InferenceResult:
+        """
+        Classify inputs that were already tokenized upstream, e.g. to sort by length.
+
+        The ids must come from this model's tokenizer with special tokens and at
+        most max_length long. The prediction cache and long-text mode do not
+        apply here.
+
+        Args:
+            input_ids: Unpadded id lists (padded here), or a padded (batch, seq)
+                tensor or array
+            attention_mask: Matching mask; if omitted it is all ones for id
+                lists and marks non-padding ids of a padded tensor
+            layers: Hidden-state layers whose CLS vectors to return
+                (default: [hidden_layer])
+
+        Returns:
+            InferenceResult with labels, logits, probabilities and CLS vectors
+
+        Raises:
+            ValueError: If no inputs are given, a sequence exceeds max_length or
+                a layer is out of range
+        """
+        if len(input_ids) == 0:
+            raise ValueError("Input ids cannot be empty")
+        layers = self._check_layers(layers)
+
+        if isinstance(input_ids, (torch.Tensor, np.ndarray)):
+            input_ids = torch.as_tensor(input_ids, dtype=torch.long)
+            if attention_mask is None:
+                attention_mask = input_ids != self.tokenizer.pad_token_id
+            inputs = {'input_ids': input_ids, 'attention_mask': torch.as_tensor(attention_mask, dtype=torch.long)}
+        else:
+            if attention_mask is None:
+                features = [{'input_ids': list(ids)} for ids in input_ids]
+            else:
+                features = [
+                    {'input_ids': list(ids), 'attention_mask': list(mask)}
+                    for ids, mask in zip(input_ids, attention_mask)
+                ]
+            inputs = dict(self._local_tokenizer().pad(features, padding=True, return_tensors="pt"))
+
+        if inputs['input_ids'].shape[1] > self.max_length:
+            raise ValueError(
+                f"Input length {inputs['input_ids'].shape[1]} exceeds max_length {self.max_length}"
+            )
+        inputs = {name: tensor.to(self.device) for name, tensor in inputs.items()}
+        logits, cls_vectors = self._forward(inputs, layers)
+        return self._build_result(logits, cls_vectors)
+
     def infer_batch_sequencecls(
         self, 
         texts: List[str]
@@ -113,23 +777,11 @@ class SentimentInferenceEngine:
             texts: List of input texts to classify
             
         Returns:
-            Tuple containing (predicted_classes, softmax_probs, cls_vectors)
+            Tuple containing (predicted_classes, softmax_probs, cls_vectors),
+            with the CLS vectors taken from hidden_layer, as nested lists
+            (infer_batch returns the same as numpy arrays)
         """
-        if not texts:
-            raise ValueError("Input texts cannot be empty")
-            
-        if not all(isinstance(text, str) and text.strip() for text in texts):
-            raise ValueError("All texts must be non-empty strings")
-            
-        # Use global function with temporary global variable setup
-        global tokenizer, model, device
-        original_tokenizer, original_model, original_device = tokenizer, model, device
-        
-        try:
-            tokenizer, model, device = self.tokenizer, self.model, self.device
-            return infer_batch_sequencecls(texts)
-        finally:
-            tokenizer, model, device = original_tokenizer, original_model, original_device
+        return self.infer_batch(texts, layers=[self.hidden_layer]).to_lists(self.hidden_layer)
     
     def infer_single(self, text: str) -> Tuple[str, List[float], List[float]]:
         """
@@ -156,6 +808,10 @@ class SentimentInferenceEngine:
             'max_length': self.max_length,
             'cls_index': self.cls_index,
             'hidden_layer': self.hidden_layer,
+            'backend': self.backend,
+            'long_text_stride': self.long_text_stride,
+            'window_aggregation': self.window_aggregation,
+            'concurrency': self.concurrency,
             'num_labels': len(self.id2label),
             'labels': list(self.id2label.values())
         }
@@ -194,23 +850,19 @@ def infer_batch_sequencecls(texts):
     """
     Global function maintaining exact original logic for backward compatibility.
     
-    This function preserves the exact same processing logic as the original code.
+    This function preserves the same outputs as the original code, computed
+    in one forward pass instead of two.
     """
     inputs = tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=512).to(device)
-    input_ids = inputs['input_ids'].to(device)
-    attention_mask = inputs['attention_mask'].to(device)
     with torch.no_grad():
-        logits = model(**inputs).logits
-        softmax_probs = F.softmax(logits, dim=-1)
         # BERT中的第一个记（[CLS]）的索引为0
         cls_index = 0
-        # 获取BERT模型的输出
-        outputs = model(input_ids, attention_mask=attention_mask, output_hidden_states=True)
-        # 获取第n层的隐藏状态
+        # 第n层隐藏状态的CLS向量与logits在同一次前向中取得
         n=12
-        nlayers_states = outputs.hidden_states[n]
+        logits, layer_cls = forward_with_cls_layers(model, inputs, [n], cls_index)
+        softmax_probs = F.softmax(logits, dim=-1)
         # 提取CLS标记的向量
-        cls_vectors = nlayers_states[:, cls_index, :].detach().cpu().numpy()    
+        cls_vectors = layer_cls[n].detach().cpu().numpy()
         predicted_class_ids = logits.argmax(dim=-1).tolist()
     # 情感分类分类
     id2label = {0: '负面', 1: '正面'}
@@ -227,7 +879,7 @@ def main():
     modelpath = ""  
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(device)
-    tokenizer = BertTokenizer.from_pretrained(modelpath)
+    tokenizer = load_tokenizer(modelpath)
     model = AutoModelForSequenceClassification.from_pretrained(modelpath).to(device)
     texts = ["这是一个正面的评论", "这是一个负面的评论"]
     predicted_classes, softmax_probs, cls_vectors = infer_batch_sequencecls(texts)
@@ -0,0 +1,318 @@
+"""
+Hyperparameter sweep runner for SentimentFinetuner.
+
+The tokenizer, the token caches and the pretrained weights are loaded once in
+the sweep process. Every trial is a forked child that trains its copy-on-write
+view of those weights with its own torch thread budget, K trials at a time, so
+no trial reloads the model or re-tokenizes the data. Each trial writes its
+model, log and results CSV into its own directory; the sweep collects the best
+and final metrics and the wall time of every trial into one table.
+"""
+
+import argparse
+import dataclasses
+import itertools
+import json
+import logging
+import multiprocessing as mp
+import os
+import random
+import sys
+import time
+import typing
+from multiprocessing.connection import wait
+from pathlib import Path
+from typing import Dict, List
+
+import pandas as pd
+import torch
+from transformers import BertForSequenceClassification
+
+from downstream_dataset import TokenizedSentimentDataset
+from finetune_sentiment_classification import FineTuningConfig, SentimentFinetuner
+from tokenization import load_tokenizer
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Constants
+SEARCH_MODES = ('grid', 'random')
+# Loaded or built once for the whole sweep, or managed per trial by the runner
+SHARED_FIELDS = (
+    'model_name', 'use_fast_tokenizer', 'train_data_path', 'test_data_path',
+    'token_cache_dir', 'output_base_dir', 'results_csv_path'
+)
+RESULTS_FILENAME = 'sweep_results.csv'
+# Columns of a trial's results CSV that can rank its evaluations
+SCORE_COLUMNS = ('accuracy', 'precision', 'recall', 'f1')
+TRIAL_STATUS_FILENAME = 'trial.json'
+
+
+def parse_value(field_type, text: str):
+    """
+    Convert a command-line value to the type of a FineTuningConfig field.
+
+    Args:
+        field_type: Annotated type of the field (Optional[X] is treated as X)
+        text: Value as given on the command line
+
+    Returns:
+        The converted value; 'none' gives None for Optional fields
+    """
+    args = typing.get_args(field_type)
+    if type(None) in args:
+        if text.lower() == 'none':
+            return None
+        field_type = next(arg for arg in args if arg is not type(None))
+    if field_type is bool:
+        if text.lower() not in ('true', 'false', '1', '0'):
+            raise ValueError(f"Expected a boolean, got {text!r}")
+        return text.lower() in ('true', '1')
+    return field_type(text)
+
+
+def parse_search_space(specs: List[str]) -> Dict[str, list]:
+    """
+    Parse 'field=v1,v2,...' specifications into {field: [values]}.
+
+    Raises:
+        ValueError: If a specification is malformed or names a field that
+            is unknown or shared by all trials
+    """
+    fields = {f.name: f for f in dataclasses.fields(FineTuningConfig)}
+    space = {}
+    for spec in specs:
+        name, sep, values = spec.partition('=')
+        if not sep or not values:
+            raise ValueError(f"Expected field=v1,v2,..., got {spec!r}")
+        if name not in fields:
+            raise ValueError(f"Unknown FineTuningConfig field: {name}")
+        if name in SHARED_FIELDS:
+            raise ValueError(f"{name} is shared by all trials and cannot be swept")
+        space[name] = [parse_value(fields[name].type, value) for value in values.split(',')]
+    return space
+
+
+def generate_trials(space: Dict[str, list], search: str = 'grid', num_trials: int = None, seed: int = 0) -> List[Dict]:
+    """
+    Expand a search space into per-trial overrides.
+
+    Args:
+        space: {field: [values]}
+        search: 'grid' for every combination, 'random' for num_trials of them
+            drawn without replacement
+        num_trials: Number of trials for random search
+        seed: Seed of the random draw
+
+    Returns:
+        List of {field: value} dicts, one per trial
+    """
+    if search not in SEARCH_MODES:
+        raise ValueError(f"search must be one of {SEARCH_MODES}, got {search!r}")
+    names = list(space)
+    trials = [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    if search == 'random' and num_trials is not None and num_trials < len(trials):
+        trials = random.Random(seed).sample(trials, num_trials)
+    return trials
+
+
+def run_trial(trial_dir: Path, config: FineTuningConfig, base_model, tokenizer, threads: int) -> None:
+    """
+    Body of a forked trial process: train and record the outcome in trial.json.
+
+    Output is redirected to trial_dir/train.log so concurrent trials do not
+    interleave on the console.
+    """
+    log_file = open(trial_dir / 'train.log', 'a')
+    os.dup2(log_file.fileno(), sys.stdout.fileno())
+    os.dup2(log_file.fileno(), sys.stderr.fileno())
+    torch.set_num_threads(threads)
+
+    status = {'status': 'ok', 'error': None}
+    start = time.perf_counter()
+    try:
+        SentimentFinetuner(config, base_model=base_model, tokenizer=tokenizer).train()
+    except Exception as e:
+        logger.exception("Trial failed")
+        status = {'status': 'failed', 'error': f"{type(e).__name__}: {e}"}
+    status['wall_seconds'] = time.perf_counter() - start
+    with open(trial_dir / TRIAL_STATUS_FILENAME, 'w', encoding='utf-8') as f:
+        json.dump(status, f)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # Skip interpreter teardown (atexit handlers and finalizers inherited from the sweep process)
+    os._exit(0 if status['status'] == 'ok' else 1)
+
+
+def summarize_trial(trial_dir: Path, metric: str, greater_is_better: bool = True) -> Dict:
+    """Best and final metrics of a trial from its results CSV."""
+    csv_path = trial_dir / 'sentiment2.csv'
+    if not csv_path.exists():
+        return {'evaluations': 0}
+    results = pd.read_csv(csv_path)
+    if results.empty:
+        return {'evaluations': 0}
+    best = results.loc[results[metric].idxmax() if greater_is_better else results[metric].idxmin()]
+    final = results.iloc[-1]
+    return {
+        f'best_{metric}': best[metric],
+        'best_step': int(best['currentsteps']),
+        'final_accuracy': final['accuracy'],
+        'final_f1': final['f1'],
+        'evaluations': len(results),
+    }
+
+
+def run_sweep(
+    base_config: FineTuningConfig,
+    trials: List[Dict],
+    sweep_dir: str,
+    num_parallel: int = 1,
+    threads_per_trial: int = None
+) -> pd.DataFrame:
+    """
+    Run fine-tuning trials concurrently from one shared model load.
+
+    Args:
+        base_config: Settings shared by all trials
+        trials: Per-trial overrides of base_config fields
+        sweep_dir: Directory for the trials, the shared token cache and the results table
+        num_parallel: Trials running at the same time
+        threads_per_trial: torch threads per trial (default: CPU count / num_parallel)
+
+    Returns:
+        DataFrame with one row per trial: overrides, status, wall time and metrics
+
+    Raises:
+        ValueError: If a trial's metric_for_best_model is not a column of the results CSV
+    """
+    sweep_dir = Path(sweep_dir)
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+    threads_per_trial = threads_per_trial or max((os.cpu_count() or 1) // num_parallel, 1)
+    token_cache_dir = base_config.token_cache_dir or str(sweep_dir / 'token_cache')
+    configs = [
+        dataclasses.replace(
+            base_config, **overrides, token_cache_dir=token_cache_dir,
+            output_base_dir=str(sweep_dir / f'trial-{i:03d}'),
+            results_csv_path=str(sweep_dir / f'trial-{i:03d}' / 'sentiment2.csv')
+        )
+        for i, overrides in enumerate(trials)
+    ]
+    for config in configs:
+        metric = config.metric_for_best_model.removeprefix('eval_')
+        if metric not in SCORE_COLUMNS:
+            raise ValueError(f"Trials are ranked by the {SCORE_COLUMNS} columns of the results CSV, "
+                             f"not metric_for_best_model={config.metric_for_best_model!r}")
+
+    # Children inherit the OpenMP runtime; a parent that never started a thread
+    # team keeps it safe to fork, and loading the weights needs none
+    torch.set_num_threads(1)
+    tokenizer = load_tokenizer(base_config.model_name, use_fast=base_config.use_fast_tokenizer)
+    test_dataset = None
+    for max_length in sorted({config.max_length for config in configs}):
+        for path in (base_config.train_data_path, base_config.test_data_path):
+            test_dataset = TokenizedSentimentDataset.from_csv(path, tokenizer, max_length, token_cache_dir)
+    label2id, id2label = test_dataset.get_label_mappings()
+    logger.info(f"Loading base model from {base_config.model_name}")
+    base_model = BertForSequenceClassification.from_pretrained(
+        base_config.model_name,
+        problem_type="single_label_classification",
+        num_labels=len(label2id),
+        id2label=id2label,
+        label2id=label2id
+    )
+
+    logger.info(f"Running {len(configs)} trials, {num_parallel} at a time with {threads_per_trial} threads each")
+    ctx = mp.get_context('fork')
+    queued = list(range(len(configs)))
+    running = {}
+    started = {}
+    finished = {}
+    while queued or running:
+        while queued and len(running) < num_parallel:
+            i = queued.pop(0)
+            trial_dir = Path(configs[i].output_base_dir)
+            trial_dir.mkdir(parents=True, exist_ok=True)
+            process = ctx.Process(target=run_trial, args=(trial_dir, configs[i], base_model, tokenizer, threads_per_trial))
+            process.start()
+            running[process.sentinel] = (i, process)
+            started[i] = time.perf_counter()
+            logger.info(f"Started trial {i}: {trials[i]}")
+        for sentinel in wait(list(running)):
+            i, process = running.pop(sentinel)
+            process.join()
+            finished[i] = time.perf_counter() - started[i]
+            logger.info(f"Trial {i} finished in {finished[i]:.1f}s (exit code {process.exitcode})")
+
+    rows = []
+    for i, config in enumerate(configs):
+        trial_dir = Path(config.output_base_dir)
+        status_path = trial_dir / TRIAL_STATUS_FILENAME
+        if status_path.exists():
+            with open(status_path, encoding='utf-8') as f:
+                status = json.load(f)
+        else:
+            status = {'status': 'crashed', 'error': f"see {trial_dir / 'train.log'}"}
+        rows.append({
+            'trial': i,
+            **trials[i],
+            'status': status['status'],
+            'wall_seconds': finished[i],
+            **summarize_trial(
+                trial_dir, config.metric_for_best_model.removeprefix('eval_'), config.metric_greater_is_better
+            ),
+            'error': status['error'],
+        })
+
+    table = pd.DataFrame(rows)
+    table.to_csv(sweep_dir / RESULTS_FILENAME, index=False)
+    return table
+
+
+def main():
+    """Run a sweep from the command line."""
+    parser = argparse.ArgumentParser(
+        description='Grid or random hyperparameter sweep over FineTuningConfig fields',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--param', action='append', default=[], metavar='FIELD=V1,V2',
+                        help='FineTuningConfig field and the values to try (repeatable); '
+                             'a single value fixes the field for all trials')
+    parser.add_argument('--search', choices=SEARCH_MODES, default='grid', help='Search strategy')
+    parser.add_argument('--num_trials', type=int, default=None,
+                        help='Trials drawn from the grid for random search')
+    parser.add_argument('--sweep_seed', type=int, default=0, help='Seed of the random search draw')
+    parser.add_argument('--model_name', type=str, default=FineTuningConfig.model_name,
+                        help='Name or path of the pretrained model')
+    parser.add_argument('--train_data', type=str, default=FineTuningConfig.train_data_path,
+                        help='Path to training data CSV file')
+    parser.add_argument('--test_data', type=str, default=FineTuningConfig.test_data_path,
+                        help='Path to test data CSV file')
+    parser.add_argument('--sweep_dir', type=str, default='sweeps/sweep',
+                        help='Directory for trial outputs, the token cache and the results table')
+    parser.add_argument('--token_cache_dir', type=str, default=None,
+                        help='Shared token cache directory (default: <sweep_dir>/token_cache)')
+    parser.add_argument('--num_parallel', type=int, default=2, help='Trials running concurrently')
+    parser.add_argument('--threads_per_trial', type=int, default=None,
+                        help='torch threads per trial (default: CPU count / num_parallel)')
+    args = parser.parse_args()
+
+    space = parse_search_space(args.param)
+    trials = generate_trials(space, args.search, args.num_trials, args.sweep_seed)
+    base_config = FineTuningConfig(
+        model_name=args.model_name,
+        train_data_path=args.train_data,
+        test_data_path=args.test_data,
+        token_cache_dir=args.token_cache_dir
+    )
+    table = run_sweep(base_config, trials, args.sweep_dir, args.num_parallel, args.threads_per_trial)
+    print(table.drop(columns=['error']).to_string(index=False))
+    print(f"\nResults written to {Path(args.sweep_dir) / RESULTS_FILENAME}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -0,0 +1,122 @@
+"""
+Tokenizer loading for the FinBERT2 classifier.
+
+The Rust-backed fast tokenizer is used when the model ships one (a
+tokenizer.json, or a vocab.txt it can be converted from); the pure-Python
+BertTokenizer is the fallback and the reference for the parity check.
+"""
+
+import argparse
+import logging
+from pathlib import Path
+from typing import Dict, List, Union
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Constants
+DEFAULT_PARITY_MAX_LENGTH = 512
+
+
+def load_slow_tokenizer(model_path: Union[str, Path]):
+    """Load the pure-Python WordPiece BertTokenizer."""
+    try:
+        # transformers >= 5 made BertTokenizer the fast one and kept the Python one here
+        from transformers.models.bert.tokenization_bert_legacy import BertTokenizerLegacy as SlowBertTokenizer
+    except ImportError:
+        from transformers import BertTokenizer as SlowBertTokenizer
+    return SlowBertTokenizer.from_pretrained(str(model_path))
+
+
+def load_tokenizer(model_path: Union[str, Path], use_fast: bool = True):
+    """
+    Load the tokenizer of a model, preferring the fast implementation.
+
+    Args:
+        model_path: Model name or directory
+        use_fast: Use the fast tokenizer when available
+
+    Returns:
+        A fast tokenizer if use_fast and one can be built, else BertTokenizer
+    """
+    if use_fast:
+        from transformers import AutoTokenizer
+
+        try:
+            tokenizer = AutoTokenizer.from_pretrained(str(model_path), use_fast=True)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load a fast tokenizer from {model_path} ({e}); using BertTokenizer")
+        else:
+            if tokenizer.is_fast:
+                return tokenizer
+            logger.warning(f"No fast tokenizer available for {model_path}; using BertTokenizer")
+    return load_slow_tokenizer(model_path)
+
+
+def check_tokenizer_parity(
+    model_path: Union[str, Path],
+    texts: List[str],
+    max_length: int = DEFAULT_PARITY_MAX_LENGTH
+) -> Dict[str, object]:
+    """
+    Compare the token ids of the fast and slow tokenizers on the same texts.
+
+    Args:
+        model_path: Model name or directory
+        texts: Texts to tokenize
+        max_length: Truncation length, as used for inference
+
+    Returns:
+        {'texts', 'mismatches', 'agreement', 'examples'} where examples lists
+        up to five differing texts with both id sequences
+    """
+    fast = load_tokenizer(model_path, use_fast=True)
+    slow = load_slow_tokenizer(model_path)
+    if not fast.is_fast:
+        raise ValueError(f"No fast tokenizer available for {model_path}")
+
+    fast_ids = fast(texts, truncation=True, max_length=max_length)['input_ids']
+    slow_ids = slow(texts, truncation=True, max_length=max_length)['input_ids']
+    mismatches = [i for i, (a, b) in enumerate(zip(fast_ids, slow_ids)) if a != b]
+    report = {
+        'texts': len(texts),
+        'mismatches': len(mismatches),
+        'agreement': 1.0 - len(mismatches) / len(texts) if texts else 1.0,
+        'examples': [
+            {'text': texts[i], 'fast': fast_ids[i], 'slow': slow_ids[i]} for i in mismatches[:5]
+        ],
+    }
+    logger.info(f"Tokenizer parity: {report['texts'] - report['mismatches']}/{report['texts']} texts identical")
+    return report
+
+
+def main():
+    """Run the tokenizer parity check on a labelled CSV."""
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(
+        description='Compare fast and slow tokenizer ids',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--model_path', type=str, required=True, help='Model name or directory')
+    parser.add_argument('--data', type=str, default='SC_2/test_SC_2.csv', help="CSV with a 'text' column")
+    parser.add_argument('--limit', type=int, default=None, help='Only use the first N texts')
+    parser.add_argument('--max_length', type=int, default=DEFAULT_PARITY_MAX_LENGTH, help='Truncation length')
+    args = parser.parse_args()
+
+    texts = pd.read_csv(args.data)['text'].dropna().astype(str).tolist()
+    if args.limit:
+        texts = texts[:args.limit]
+    report = check_tokenizer_parity(args.model_path, texts, args.max_length)
+    print(f"{report['texts'] - report['mismatches']}/{report['texts']} texts tokenized identically "
+          f"(agreement={report['agreement']:.4f})")
+    for example in report['examples']:
+        print(f"  {example['text'][:60]!r}\n    fast: {example['fast'][:20]}\n    slow: {example['slow'][:20]}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -4,51 +4,825 @@ Date: 2025-11-13 14:55:56
 Description: 调用finbert模型，计算句子的embedding
 """
 
+import argparse
 import os
+import numpy as np
 import pandas as pd
 import torch
 from transformers import AutoTokenizer, AutoModel
 import re
+from collections import Counter
 from tqdm import tqdm
 
-def get_document_embedding(sentences: list, model, tokenizer, device, batch_size=32):
+from embedding_cache import DEFAULT_CACHE_MAX_MB, SentenceEmbeddingCache
+from embedding_store import BinaryEmbeddingStore, CSVEmbeddingStore
+from encoder_backends import BACKEND_CHOICES, DEFAULT_BACKEND, prepare_backend
+from pipeline import DEFAULT_QUEUE_SIZE, BackgroundProducer, PipelineStats
+from pooling import (DEFAULT_POOLINGS, POOLING_CHOICES, WINDOW_AGGREGATIONS, DocumentPooler, aggregate_windows,
+                     pack_features, sentence_features, unpack_features)
+
+MODEL_NAME = "valuesimplex-ai-lab/FinBERT2-base"
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_MAX_LENGTH = 512
+DEFAULT_GLOBAL_WINDOW = 4096
+
+
+def build_token_budget_batches(lengths: list, token_budget: int):
     """
-    Calculates the mean CLS embedding for a list of sentences.
+    Groups sentence indices into batches sorted by token length.
+
+    Each batch is capped so that (longest sentence in batch) * (batch size),
+    i.e. the padded tensor size, stays within token_budget. A single sentence
+    longer than the budget still gets a batch of its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    current = []
+    for idx in order:
+        # Lengths are ascending, so the candidate sentence sets the batch width
+        if current and lengths[idx] * (len(current) + 1) > token_budget:
+            batches.append(current)
+            current = []
+        current.append(idx)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def split_into_windows(token_ids: list, window_tokens: int, stride: int):
+    """
+    Splits a sentence's token ids into windows of at most window_tokens ids,
+    each overlapping the previous one by stride ids. Short sentences give a
+    single window.
+    """
+    step = window_tokens - stride
+    return [token_ids[start:start+window_tokens] for start in range(0, max(len(token_ids) - stride, 1), step)]
+
+
+def iter_window_batches(sentences: list, tokenizer, batch_size=DEFAULT_BATCH_SIZE, token_budget=None,
+                        max_length=DEFAULT_MAX_LENGTH, long_text_stride=0):
+    """
+    Long-text variant of iter_tokenized_batches: instead of truncating at
+    max_length, every sentence is cut into overlapping max_length windows
+    (see split_into_windows) and yields (indices, inputs, owners), where owners
+    maps each window row of inputs to its position in indices.
+
+    All windows of a sentence go into the same batch, so every batch can be
+    aggregated back to sentences on its own. batch_size and token_budget then
+    count window rows; a sentence with more windows gets a batch to itself.
+    """
+    window_tokens = max_length - tokenizer.num_special_tokens_to_add(pair=False)
+    if not 0 <= long_text_stride < window_tokens:
+        raise ValueError(f"long_text_stride must be in [0, {window_tokens}), got {long_text_stride}")
+
+    token_ids = tokenizer(sentences, add_special_tokens=False, verbose=False)['input_ids']
+    windows = [
+        [[tokenizer.cls_token_id] + chunk + [tokenizer.sep_token_id]
+         for chunk in split_into_windows(ids, window_tokens, long_text_stride)]
+        for ids in token_ids
+    ]
+    widths = [max(len(window) for window in sentence_windows) for sentence_windows in windows]
+
+    def make_batch(batch):
+        rows = [{'input_ids': window} for i in batch for window in windows[i]]
+        owners = torch.tensor([k for k, i in enumerate(batch) for _ in windows[i]])
+        return batch, tokenizer.pad(rows, padding=True, return_tensors="pt"), owners
+
+    if token_budget is None:
+        order = list(range(len(sentences)))
+    else:
+        order = sorted(range(len(sentences)), key=lambda i: widths[i])
+
+    batch, num_rows, width = [], 0, 0
+    for i in order:
+        rows, new_width = num_rows + len(windows[i]), max(width, widths[i])
+        full = rows > batch_size if token_budget is None else rows * new_width > token_budget
+        if batch and full:
+            yield make_batch(batch)
+            batch, rows, new_width = [], len(windows[i]), widths[i]
+        batch.append(i)
+        num_rows, width = rows, new_width
+    if batch:
+        yield make_batch(batch)
+
+
+def iter_tokenized_batches(sentences: list, tokenizer, batch_size=DEFAULT_BATCH_SIZE, token_budget=None,
+                           max_length=DEFAULT_MAX_LENGTH, long_text_stride=None):
+    """
+    Tokenizes the sentences and yields (indices, inputs, owners) one batch at a
+    time, where inputs is a padded BatchEncoding of CPU tensors. owners is None
+    unless long_text_stride is set (see iter_window_batches).
+
+    With token_budget=None sentences are cut into fixed groups of batch_size in
+    file order. Otherwise they are tokenized once, sorted by length and packed
+    into batches whose padded size stays within token_budget tokens, which keeps
+    one long table row from padding a whole batch of short sentences.
+    """
+    if not sentences:
+        return
+    if long_text_stride is not None:
+        yield from iter_window_batches(sentences, tokenizer, batch_size, token_budget, max_length, long_text_stride)
+        return
+
+    if token_budget is None:
+        for i in range(0, len(sentences), batch_size):
+            batch_sentences = sentences[i:i+batch_size]
+            inputs = tokenizer(
+                batch_sentences,
+                padding=True,
+                truncation=True,
+                return_tensors="pt",
+                max_length=max_length
+            )
+            yield list(range(i, i + len(batch_sentences))), inputs, None
+        return
+
+    encoded = tokenizer(sentences, truncation=True, max_length=max_length)
+    lengths = [len(ids) for ids in encoded['input_ids']]
+    for batch_indices in build_token_budget_batches(lengths, token_budget):
+        features = [{key: encoded[key][i] for key in encoded.keys()} for i in batch_indices]
+        yield batch_indices, tokenizer.pad(features, padding=True, return_tensors="pt"), None
+
+
+def encode_inputs(inputs, model, device, owners=None, window_aggregation='mean'):
+    """
+    Runs one tokenized batch through the encoder and returns its sentence
+    features, aggregating window rows per sentence when owners is given.
+    """
+    # Pinned inputs (see embed_pipelined) are copied to the GPU asynchronously
+    inputs = {name: tensor.to(device, non_blocking=True) for name, tensor in inputs.items()}
+    with torch.no_grad():
+        outputs = model(**inputs)
+    features = sentence_features(outputs.last_hidden_state, inputs['attention_mask'])
+    if owners is not None:
+        features = aggregate_windows(features, owners, int(owners.max()) + 1, window_aggregation)
+    return features
+
+
+def iter_encoded_batches(sentences: list, model, tokenizer, device, batch_size=DEFAULT_BATCH_SIZE,
+                         token_budget=None, max_length=DEFAULT_MAX_LENGTH, cache=None, long_text_stride=None,
+                         window_aggregation='mean'):
+    """
+    Encodes the sentences and yields (indices, features) one batch at a time.
+
+    indices are positions in `sentences`; features is the dict produced by
+    pooling.sentence_features ('cls', 'token_sum', 'length'). Batches are built
+    by iter_tokenized_batches; with long_text_stride, sentences longer than
+    max_length are encoded as overlapping windows whose features are combined
+    by pooling.aggregate_windows.
+
+    If a SentenceEmbeddingCache is given it is consulted before any batch is
+    built; only the misses reach the model and are then written back.
+    """
+    if cache is not None:
+        keys = [cache.make_key(sentence) for sentence in sentences]
+        cached = cache.get_many(keys)
+        hit_indices = [i for i, key in enumerate(keys) if key in cached]
+        for i in range(0, len(hit_indices), batch_size):
+            chunk = hit_indices[i:i+batch_size]
+            yield chunk, unpack_features(np.stack([cached[keys[j]] for j in chunk]))
+
+        miss_indices = [i for i, key in enumerate(keys) if key not in cached]
+        if not miss_indices:
+            return
+        miss_batches = iter_encoded_batches(
+            [sentences[i] for i in miss_indices], model, tokenizer, device,
+            batch_size=batch_size, token_budget=token_budget, max_length=max_length,
+            long_text_stride=long_text_stride, window_aggregation=window_aggregation
+        )
+        for local_indices, features in miss_batches:
+            indices = [miss_indices[i] for i in local_indices]
+            cache.put_many([keys[i] for i in indices], pack_features(features))
+            yield indices, features
+        return
+
+    # Use tqdm for progress bar on sentences, but keep it unobtrusive
+    with tqdm(total=len(sentences), desc="  - Sentences", leave=False, ncols=80) as progress:
+        for indices, inputs, owners in iter_tokenized_batches(
+            sentences, tokenizer, batch_size, token_budget, max_length, long_text_stride
+        ):
+            yield indices, encode_inputs(inputs, model, device, owners, window_aggregation)
+            progress.update(len(indices))
+
+
+def encode_sentences(sentences: list, model, tokenizer, device, batch_size=DEFAULT_BATCH_SIZE,
+                     token_budget=None, max_length=DEFAULT_MAX_LENGTH, cache=None, long_text_stride=None,
+                     window_aggregation='mean'):
+    """
+    Returns the CLS embeddings of the sentences as a (n_sentences, hidden) tensor,
+    in the same order as the input.
+    """
+    cls_embeddings = None
+    for indices, features in iter_encoded_batches(
+        sentences, model, tokenizer, device,
+        batch_size=batch_size, token_budget=token_budget, max_length=max_length, cache=cache,
+        long_text_stride=long_text_stride, window_aggregation=window_aggregation
+    ):
+        if cls_embeddings is None:
+            cls_embeddings = features['cls'].new_empty((len(sentences), features['cls'].shape[1]))
+        # Scatter the vectors back to their original sentence positions
+        cls_embeddings[torch.tensor(indices)] = features['cls']
+    return cls_embeddings
+
+
+def pool_document(sentences: list, model, tokenizer, device, batch_size=DEFAULT_BATCH_SIZE,
+                  token_budget=None, max_length=DEFAULT_MAX_LENGTH, cache=None, poolings=DEFAULT_POOLINGS,
+                  counts=None, long_text_stride=None, window_aggregation='mean'):
+    """
+    Encodes a document's sentences once and returns {pooling: vector} for every
+    requested pooling. Memory stays constant in the number of sentences.
+
+    counts, if given, is the number of occurrences of each sentence (see
+    dedupe_sentences); every sentence is encoded once and weighted by it.
     """
     if not sentences:
         return None
-    
-    all_cls_embeddings = []
-    # Use tqdm for progress bar on sentence batches, but keep it unobtrusive
-    for i in tqdm(range(0, len(sentences), batch_size), desc="  - Sentences", leave=False, ncols=80):
-        batch_sentences = sentences[i:i+batch_size]
-        
-        inputs = tokenizer(
-            batch_sentences, 
-            padding=True, 
-            truncation=True, 
-            return_tensors="pt", 
-            max_length=512
-        ).to(device)
-        
-        with torch.no_grad():
-            outputs = model(**inputs)
-        
-        cls_embeddings = outputs.last_hidden_state[:, 0, :].cpu()
-        all_cls_embeddings.append(cls_embeddings)
-
-    if not all_cls_embeddings:
+
+    pooler = DocumentPooler(poolings)
+    for indices, features in iter_encoded_batches(
+        sentences, model, tokenizer, device,
+        batch_size=batch_size, token_budget=token_budget, max_length=max_length, cache=cache,
+        long_text_stride=long_text_stride, window_aggregation=window_aggregation
+    ):
+        if counts is not None:
+            features = dict(features, count=torch.tensor([counts[i] for i in indices]))
+        pooler.update(features)
+    return pooler.result()
+
+
+def get_document_embedding(sentences: list, model, tokenizer, device, batch_size=DEFAULT_BATCH_SIZE,
+                           token_budget=None, max_length=DEFAULT_MAX_LENGTH, cache=None, dedup=True,
+                           long_text_stride=None, window_aggregation='mean'):
+    """
+    Calculates the mean CLS embedding for a list of sentences.
+
+    With dedup, repeated sentences are encoded once and counted with their
+    multiplicity, which leaves the mean unchanged.
+    """
+    counts = None
+    if dedup:
+        sentences, counts = dedupe_sentences(sentences)
+    pooled = pool_document(
+        sentences, model, tokenizer, device,
+        batch_size=batch_size, token_budget=token_budget, max_length=max_length, cache=cache, counts=counts,
+        long_text_stride=long_text_stride, window_aggregation=window_aggregation
+    )
+    if pooled is None:
+        return None
+    return pooled['cls_mean']
+
+
+def list_documents(input_csv_dir):
+    """
+    Lists the sentence CSVs in input_csv_dir, sorted by filename.
+
+    Returns a list of dicts with year, company_code, company_name and file_path.
+    """
+    documents = []
+    csv_files = sorted([f for f in os.listdir(input_csv_dir) if f.endswith('.csv')])
+    for filename in csv_files:
+        # Parse filename: 2018_000001_平安银行.csv
+        match = re.match(r'(\d{4})_(\w+)_([\w\W]+).csv', filename)
+        if not match:
+            tqdm.write(f"Warning: Skipping file with unexpected name format: {filename}")
+            continue
+
+        year, company_code, company_name = match.groups()
+        documents.append({
+            'year': year,
+            'company_code': company_code,
+            'company_name': company_name,
+            'file_path': os.path.join(input_csv_dir, filename),
+        })
+    return documents
+
+
+def load_sentences(document):
+    """
+    Reads the sentences of one document CSV. Returns None if there are none.
+    """
+    filename = os.path.basename(document['file_path'])
+    df = pd.read_csv(document['file_path'])
+    if 'sentence' not in df.columns or df['sentence'].isnull().all():
+        tqdm.write(f"Warning: No sentences found in {filename}. Skipping.")
         return None
-        
-    all_cls_embeddings_tensor = torch.cat(all_cls_embeddings, dim=0)
-    document_embedding = torch.mean(all_cls_embeddings_tensor, dim=0)
-    
-    return document_embedding.numpy()
+    return df['sentence'].dropna().tolist()
+
+
+def dedupe_sentences(sentences):
+    """
+    Collapses exact repeats (page headers, "单位：元", disclaimers) within one
+    document. Returns (unique sentences in first-occurrence order, counts).
+    """
+    occurrences = Counter(sentences)
+    unique = list(occurrences)
+    return unique, [occurrences[sentence] for sentence in unique]
+
+
+def load_document_sentences(document, dedup=True):
+    """
+    Reads a document's sentences and, with dedup, collapses repeats and logs
+    the dedup ratio. Returns (sentences, counts); counts is None without dedup
+    and both are None if the document has no sentences.
+    """
+    sentences = load_sentences(document)
+    if not sentences or not dedup:
+        return sentences, None
+
+    unique, counts = dedupe_sentences(sentences)
+    ratio = 1 - len(unique) / len(sentences)
+    tqdm.write(f"  - {os.path.basename(document['file_path'])}: {len(unique)}/{len(sentences)} "
+               f"unique sentences, dedup ratio {ratio:.1%}")
+    return unique, counts
+
+
+def update_document_poolers(open_documents, batch_doc_ids, features, counts=None):
+    """
+    Splits one encoded batch into per-document segments and feeds each segment
+    to its document's pooler.
+
+    open_documents maps doc_id -> {'document', 'pooler', 'remaining'};
+    batch_doc_ids gives the doc_id of every row in the batch and counts, if
+    given, the occurrences of every row's sentence in its document. Documents
+    whose last sentence was in this batch are removed and returned as
+    (document, {pooling: vector}) pairs.
+    """
+    if counts is not None:
+        features = dict(features, count=torch.as_tensor(counts))
+    finished = []
+    for doc_id in dict.fromkeys(batch_doc_ids):
+        segment = torch.tensor([d == doc_id for d in batch_doc_ids])
+        state = open_documents[doc_id]
+        state['pooler'].update({name: value[segment] for name, value in features.items()})
+        state['remaining'] -= int(segment.sum())
+        if state['remaining'] == 0:
+            del open_documents[doc_id]
+            finished.append((state['document'], state['pooler'].result()))
+    return finished
+
+
+def embed_corpus(documents, model, tokenizer, device, batch_size=DEFAULT_BATCH_SIZE,
+                 token_budget=None, max_length=DEFAULT_MAX_LENGTH, window_size=DEFAULT_GLOBAL_WINDOW,
+                 cache=None, poolings=DEFAULT_POOLINGS, dedup=True, long_text_stride=None, window_aggregation='mean'):
+    """
+    Streams the sentences of all documents through one shared batch stream.
+
+    Sentences are tagged with their (year, company_code) document id and buffered
+    into windows of window_size sentences, which are encoded together so batches
+    stay full across document boundaries. Every finished batch is split into
+    per-document segments that update that document's DocumentPooler; once all
+    sentences of a document have been encoded, (document, {pooling: vector}) is
+    yielded. Documents are yielded in input order and match pool_document.
+    With dedup, each document contributes its unique sentences with counts.
+    A document that cannot be read or whose sentences fail to encode is
+    skipped, like in embed_documents; after a failed batch the rest of the
+    window is encoded again one document at a time.
+    """
+    if token_budget is None:
+        # Keep the window a whole number of batches so only the final batch is partial
+        window_size = max(window_size // batch_size, 1) * batch_size
+
+    open_documents = {}
+    buffer_sentences = []
+    buffer_doc_ids = []
+    buffer_counts = []
+
+    def encode_buffered(positions, finished, done):
+        # Encodes the buffered sentences at the given positions into their documents' poolers
+        for indices, features in iter_encoded_batches(
+            [buffer_sentences[p] for p in positions], model, tokenizer, device,
+            batch_size=batch_size, token_budget=token_budget, max_length=max_length, cache=cache,
+            long_text_stride=long_text_stride, window_aggregation=window_aggregation
+        ):
+            batch_positions = [positions[i] for i in indices]
+            batch_doc_ids = [buffer_doc_ids[p] for p in batch_positions]
+            batch_counts = [buffer_counts[p] for p in batch_positions]
+            finished.extend(update_document_poolers(open_documents, batch_doc_ids, features, batch_counts))
+            done.update(batch_positions)
+
+    def flush():
+        finished = []
+        done = set()
+        try:
+            encode_buffered(list(range(len(buffer_sentences))), finished, done)
+        except Exception:
+            # Retry the sentences not encoded yet one document at a time, skipping the documents that fail
+            pending = {}
+            for p, doc_id in enumerate(buffer_doc_ids):
+                if p not in done:
+                    pending.setdefault(doc_id, []).append(p)
+            for doc_id, positions in pending.items():
+                try:
+                    encode_buffered(positions, finished, done)
+                except Exception as e:
+                    state = open_documents.pop(doc_id)
+                    tqdm.write(f"Error processing file {os.path.basename(state['document']['file_path'])}: {e}")
+        buffer_sentences.clear()
+        buffer_doc_ids.clear()
+        buffer_counts.clear()
+        # Report documents in input order even though token-budget batches are length-sorted
+        finished.sort(key=lambda item: item[0]['order'])
+        return finished
+
+    for order, document in enumerate(documents):
+        filename = os.path.basename(document['file_path'])
+        try:
+            sentences, counts = load_document_sentences(document, dedup)
+        except Exception as e:
+            tqdm.write(f"Error processing file {filename}: {e}")
+            continue
+        if not sentences:
+            continue
+        if counts is None:
+            counts = [1] * len(sentences)
+
+        doc_id = (document['year'], document['company_code'])
+        open_documents[doc_id] = {
+            'document': dict(document, order=order),
+            'pooler': DocumentPooler(poolings),
+            'remaining': len(sentences),
+        }
+        for sentence, count in zip(sentences, counts):
+            if doc_id not in open_documents:
+                # Skipped after a failed flush
+                break
+            buffer_sentences.append(sentence)
+            buffer_doc_ids.append(doc_id)
+            buffer_counts.append(count)
+            if len(buffer_sentences) >= window_size:
+                yield from flush()
+
+    if buffer_sentences:
+        yield from flush()
+
+
+def embed_documents(documents, model, tokenizer, device, batch_size=DEFAULT_BATCH_SIZE,
+                    token_budget=None, max_length=DEFAULT_MAX_LENGTH, cache=None, poolings=DEFAULT_POOLINGS,
+                    dedup=True, long_text_stride=None, window_aggregation='mean'):
+    """
+    Embeds the documents one CSV at a time, yielding (document, {pooling: vector}).
+    """
+    for document in documents:
+        filename = os.path.basename(document['file_path'])
+        try:
+            sentences, counts = load_document_sentences(document, dedup)
+            if not sentences:
+                continue
+
+            # Pool the whole document in a single encoder pass
+            pooled = pool_document(
+                sentences, model, tokenizer, device,
+                batch_size=batch_size, token_budget=token_budget, max_length=max_length,
+                cache=cache, poolings=poolings, counts=counts,
+                long_text_stride=long_text_stride, window_aggregation=window_aggregation
+            )
+        except Exception as e:
+            tqdm.write(f"Error processing file {filename}: {e}")
+            continue
+
+        if pooled is not None:
+            yield document, pooled
+
+
+def produce_tokenized_batches(documents, tokenizer, batch_size=DEFAULT_BATCH_SIZE, token_budget=None,
+                              max_length=DEFAULT_MAX_LENGTH, window_size=None, cache=None, pin_memory=False,
+                              dedup=True, long_text_stride=None):
+    """
+    Producer side of embed_pipelined: reads the CSVs, looks the sentences up in
+    the cache and tokenizes the rest, without touching the model.
+
+    Yields 5-tuples (kind, ids, counts, payload, extra):
+    - ('document', doc_id, None, document, n_sentences) before a document's sentences
+    - ('features', doc_ids, counts, features, None) for a batch of cache hits
+    - ('inputs', doc_ids, counts, (inputs, owners), cache_keys) for a tokenized
+      batch to encode; owners maps window rows to sentences (see iter_window_batches)
+    - ('window', None, None, None, None) after the last batch of every window
+    doc_ids and counts give the document of each batch row and how often its
+    sentence occurs there (always 1 without dedup). With window_size=None every
+    document is its own window, as in embed_documents; otherwise windows span
+    documents, as in embed_corpus.
+    """
+    buffer_sentences = []
+    buffer_doc_ids = []
+    buffer_counts = []
+
+    def flush():
+        positions = list(range(len(buffer_sentences)))
+        keys = None
+        if cache is not None:
+            keys = [cache.make_key(sentence) for sentence in buffer_sentences]
+            cached = cache.get_many(keys)
+            hits = [i for i in positions if keys[i] in cached]
+            for start in range(0, len(hits), batch_size):
+                chunk = hits[start:start+batch_size]
+                features = unpack_features(np.stack([cached[keys[i]] for i in chunk]))
+                batch_counts = [buffer_counts[i] for i in chunk]
+                yield 'features', [buffer_doc_ids[i] for i in chunk], batch_counts, features, None
+            positions = [i for i in positions if keys[i] not in cached]
+
+        for local_indices, inputs, owners in iter_tokenized_batches(
+            [buffer_sentences[i] for i in positions], tokenizer, batch_size, token_budget, max_length, long_text_stride
+        ):
+            indices = [positions[i] for i in local_indices]
+            if pin_memory:
+                inputs = {name: tensor.pin_memory() for name, tensor in inputs.items()}
+            batch_keys = [keys[i] for i in indices] if keys is not None else None
+            batch_counts = [buffer_counts[i] for i in indices]
+            yield 'inputs', [buffer_doc_ids[i] for i in indices], batch_counts, (inputs, owners), batch_keys
+        yield 'window', None, None, None, None
+        buffer_sentences.clear()
+        buffer_doc_ids.clear()
+        buffer_counts.clear()
+
+    for order, document in enumerate(documents):
+        filename = os.path.basename(document['file_path'])
+        try:
+            sentences, counts = load_document_sentences(document, dedup)
+        except Exception as e:
+            tqdm.write(f"Error processing file {filename}: {e}")
+            continue
+        if not sentences:
+            continue
+        if counts is None:
+            counts = [1] * len(sentences)
+
+        doc_id = (document['year'], document['company_code'])
+        yield 'document', doc_id, None, dict(document, order=order), len(sentences)
+        for sentence, count in zip(sentences, counts):
+            if doc_id not in open_documents:
+                # Skipped after a failed flush
+                break
+            buffer_sentences.append(sentence)
+            buffer_doc_ids.append(doc_id)
+            buffer_counts.append(count)
+            if window_size is not None and len(buffer_sentences) >= window_size:
+                yield from flush()
+        if window_size is None:
+            yield from flush()
+
+    if buffer_sentences:
+        yield from flush()
+
+
+def embed_pipelined(documents, model, tokenizer, device, batch_size=DEFAULT_BATCH_SIZE,
+                    token_budget=None, max_length=DEFAULT_MAX_LENGTH, cache=None, poolings=DEFAULT_POOLINGS,
+                    global_batching=False, window_size=DEFAULT_GLOBAL_WINDOW, queue_size=DEFAULT_QUEUE_SIZE,
+                    stats=None, dedup=True, long_text_stride=None, window_aggregation='mean'):
+    """
+    Same results as embed_documents (or embed_corpus with global_batching), but
+    CSV reading, cache lookups and tokenization run in a background thread
+    (produce_tokenized_batches) that stays up to queue_size batches ahead. The
+    calling thread only moves batches to the device, runs the encoder and pools.
+
+    Pass a pipeline.PipelineStats as `stats` to read the queue depth and the
+    time either side spent waiting on the other.
+    """
+    if not global_batching:
+        window_size = None
+    elif token_budget is None:
+        # Keep the window a whole number of batches so only the final batch is partial
+        window_size = max(window_size // batch_size, 1) * batch_size
+
+    batches = produce_tokenized_batches(
+        documents, tokenizer, batch_size=batch_size, token_budget=token_budget, max_length=max_length,
+        window_size=window_size, cache=cache, pin_memory=torch.device(device).type == 'cuda', dedup=dedup,
+        long_text_stride=long_text_stride
+    )
+    open_documents = {}
+    finished = []
+    for kind, ids, counts, payload, extra in BackgroundProducer(batches, maxsize=queue_size, stats=stats):
+        if kind == 'document':
+            open_documents[ids] = {'document': payload, 'pooler': DocumentPooler(poolings), 'remaining': extra}
+        elif kind == 'window':
+            # Report documents in input order even though token-budget batches are length-sorted
+            finished.sort(key=lambda item: item[0]['order'])
+            yield from finished
+            finished = []
+        else:
+            if kind == 'inputs':
+                inputs, owners = payload
+                features = encode_inputs(inputs, model, device, owners, window_aggregation)
+                if extra is not None:
+                    cache.put_many(extra, pack_features(features))
+            else:
+                features = payload
+            finished.extend(update_document_poolers(open_documents, ids, features, counts))
+
+
+def add_embedding_arguments(parser):
+    """Adds the options that control how documents are encoded and pooled."""
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help='Sentences per batch in the fixed-size batching mode'
+    )
+    parser.add_argument(
+        '--token_budget',
+        type=int,
+        default=None,
+        help='Enable length-bucketed batching capped at this many padded tokens per batch'
+    )
+    parser.add_argument(
+        '--max_length',
+        type=int,
+        default=DEFAULT_MAX_LENGTH,
+        help='Maximum tokens per sentence; longer sentences are truncated'
+    )
+    parser.add_argument(
+        '--long_text_stride',
+        type=int,
+        default=None,
+        help='Instead of truncating at --max_length, encode long sentences as windows overlapping by this many tokens'
+    )
+    parser.add_argument(
+        '--window_aggregation',
+        choices=WINDOW_AGGREGATIONS,
+        default='mean',
+        help='With --long_text_stride, how window CLS vectors are combined per sentence'
+    )
+    parser.add_argument(
+        '--global_batching',
+        action='store_true',
+        help='Batch sentences across all reports instead of one CSV at a time'
+    )
+    parser.add_argument(
+        '--no_dedup',
+        action='store_true',
+        help='Encode repeated sentences of a report every time instead of once with a count weight'
+    )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Read and tokenize CSVs in a background thread while the main thread runs the encoder'
+    )
+    parser.add_argument(
+        '--prefetch_batches',
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help='With --pipeline, how many tokenized batches the producer may run ahead'
+    )
+    parser.add_argument(
+        '--embedding_cache',
+        type=str,
+        default=None,
+        help='Path of a SQLite sentence embedding cache; unchanged sentences are not re-encoded'
+    )
+    parser.add_argument(
+        '--cache_max_mb',
+        type=int,
+        default=DEFAULT_CACHE_MAX_MB,
+        help='Evict least recently used cache entries beyond this size'
+    )
+    parser.add_argument(
+        '--poolings',
+        nargs='+',
+        choices=POOLING_CHOICES,
+        default=list(DEFAULT_POOLINGS),
+        help='Document poolings computed in the same encoder pass and stored side by side'
+    )
+    parser.add_argument(
+        '--backend',
+        choices=BACKEND_CHOICES,
+        default=DEFAULT_BACKEND,
+        help='Encoder backend: eager fp32, dynamic int8 quantized PyTorch, or ONNX Runtime (CPU only)'
+    )
+
+
+def add_output_arguments(parser):
+    """Adds the options that control where results are stored."""
+    parser.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='Discard the stored embeddings and recompute every report instead of resuming'
+    )
+    parser.add_argument(
+        '--store',
+        choices=['binary', 'csv'],
+        default='binary',
+        help='binary: float32 matrix + key index in finbert_embeddings/; csv: wide finbert_embeddings.csv'
+    )
+    parser.add_argument(
+        '--export_csv',
+        action='store_true',
+        help='With the binary store, also write finbert_embeddings.csv at the end of the run'
+    )
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Generate FinBERT document embeddings for the sentence CSVs',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    add_embedding_arguments(parser)
+    add_output_arguments(parser)
+    return parser.parse_args()
+
+
+def load_encoder(device, backend=DEFAULT_BACKEND):
+    """Loads the FinBERT tokenizer and encoder in evaluation mode on the given backend."""
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    model = AutoModel.from_pretrained(MODEL_NAME).to(device)
+    model.eval() # Set model to evaluation mode
+    return tokenizer, prepare_backend(model, tokenizer, backend, device, MODEL_NAME)
+
+
+def open_cache(args):
+    """Opens the sentence cache selected by --embedding_cache, or returns None."""
+    if not args.embedding_cache:
+        return None
+    # fp32, int8 and ONNX vectors of the same sentence differ, so the backend is always part of the key
+    variant = f"backend:{args.backend}"
+    if args.long_text_stride is not None:
+        variant += f"\0windows:{args.long_text_stride}:{args.window_aggregation}"
+    return SentenceEmbeddingCache(
+        args.embedding_cache, MODEL_NAME, args.max_length, max_bytes=args.cache_max_mb * 1024 * 1024,
+        variant=variant
+    )
+
+
+def open_store(args, base_dir):
+    """Opens the output store selected by --store. Returns (store, location)."""
+    if args.store == 'binary':
+        location = os.path.join(base_dir, 'finbert_embeddings')
+        return BinaryEmbeddingStore(location), location
+    location = os.path.join(base_dir, 'finbert_embeddings.csv')
+    return CSVEmbeddingStore(location), location
+
+
+def embed(documents, model, tokenizer, device, args, cache=None, pipeline_stats=None):
+    """
+    Runs embed_pipelined, embed_corpus or embed_documents with the options parsed
+    from the command line. pipeline_stats is filled in with --pipeline.
+    """
+    embed_kwargs = dict(
+        batch_size=args.batch_size, token_budget=args.token_budget, max_length=args.max_length,
+        cache=cache, poolings=args.poolings, dedup=not args.no_dedup,
+        long_text_stride=args.long_text_stride, window_aggregation=args.window_aggregation
+    )
+    if args.pipeline:
+        return embed_pipelined(
+            documents, model, tokenizer, device, global_batching=args.global_batching,
+            queue_size=args.prefetch_batches, stats=pipeline_stats, **embed_kwargs
+        )
+    if args.global_batching:
+        return embed_corpus(documents, model, tokenizer, device, **embed_kwargs)
+    return embed_documents(documents, model, tokenizer, device, **embed_kwargs)
+
+
+def prepare_store(store, location, documents, args):
+    """
+    Applies --rebuild, checks the stored poolings and encoding settings
+    (backend, max_length, long-text windows) and drops documents that are
+    already stored. Returns the documents left to process, or None on a
+    mismatch.
+    """
+    if args.rebuild:
+        store.clear()
+        print(f"Cleared existing results at {location} (--rebuild).")
+
+    stored_poolings = store.poolings()
+    if stored_poolings and stored_poolings != args.poolings:
+        print(f"Error: {location} holds poolings {stored_poolings}, but {args.poolings} were requested.")
+        print("Use --rebuild to recompute the store with the new poolings.")
+        return None
+
+    settings = {
+        'backend': args.backend,
+        'max_length': args.max_length,
+        'long_text_stride': args.long_text_stride,
+        'window_aggregation': args.window_aggregation if args.long_text_stride is not None else None,
+    }
+    if stored_poolings:
+        # Stores written before a setting was recorded hold fp32 vectors of texts truncated at DEFAULT_MAX_LENGTH
+        stored_settings = {
+            'backend': DEFAULT_BACKEND, 'max_length': DEFAULT_MAX_LENGTH,
+            'long_text_stride': None, 'window_aggregation': None,
+            **store.settings()
+        }
+        for name, value in settings.items():
+            if stored_settings[name] != value:
+                print(f"Error: {location} was computed with --{name} {stored_settings[name]}, "
+                      f"but {value} was requested.")
+                print(f"Use --rebuild to recompute the store with the new --{name}.")
+                return None
+    store.set_settings(settings)
+
+    # Resume: skip reports whose embeddings were committed by an earlier run
+    completed_keys = store.completed_keys()
+    if completed_keys:
+        documents = [d for d in documents if (d['year'], d['company_code']) not in completed_keys]
+        print(f"Skipping {len(completed_keys)} reports already in {location}; {len(documents)} left.")
+    return documents
+
 
 def main():
     """
     Main function to process CSVs and generate embeddings.
     """
+    args = parse_arguments()
+
     # --- 1. Setup ---
     base_dir = os.path.dirname(os.path.abspath(__file__))
     input_csv_dir = os.path.join(base_dir, 'csv_output')
@@ -60,13 +834,12 @@ def main():
         return
 
     # --- 2. Load Model ---
-    print("Loading FinBERT model and tokenizer (valuesimplex-ai-lab/FinBERT2-base)...")
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"Using device: {device}")
+    print(f"Loading FinBERT model and tokenizer ({MODEL_NAME})...")
+    # The int8 and ONNX backends are CPU-only
+    device = "cuda" if torch.cuda.is_available() and args.backend == DEFAULT_BACKEND else "cpu"
+    print(f"Using device: {device} (backend: {args.backend})")
     try:
-        tokenizer = AutoTokenizer.from_pretrained("valuesimplex-ai-lab/FinBERT2-base")
-        model = AutoModel.from_pretrained("valuesimplex-ai-lab/FinBERT2-base").to(device)
-        model.eval() # Set model to evaluation mode
+        tokenizer, model = load_encoder(device, backend=args.backend)
     except Exception as e:
         print(f"Error loading model: {e}")
         print("\nPlease ensure you have an internet connection and required libraries.")
@@ -74,64 +847,42 @@ def main():
         return
 
     # --- 3. Process Files ---
-    all_results = []
-    csv_files = sorted([f for f in os.listdir(input_csv_dir) if f.endswith('.csv')])
-    
-    print(f"\nFound {len(csv_files)} CSV files to process in '{input_csv_dir}'.")
+    documents = list_documents(input_csv_dir)
 
-    # Use tqdm for progress bar on files
-    for filename in tqdm(csv_files, desc="Processing Files", ncols=100):
-        # Parse filename: 2018_000001_平安银行.csv
-        match = re.match(r'(\d{4})_(\w+)_([\w\W]+).csv', filename)
-        if not match:
-            tqdm.write(f"Warning: Skipping file with unexpected name format: {filename}")
-            continue
-        
-        year, company_code, company_name = match.groups()
-        
-        file_path = os.path.join(input_csv_dir, filename)
-        
-        try:
-            df = pd.read_csv(file_path)
-            if 'sentence' not in df.columns or df['sentence'].isnull().all():
-                tqdm.write(f"Warning: No sentences found in {filename}. Skipping.")
-                continue
+    print(f"\nFound {len(documents)} CSV files to process in '{input_csv_dir}'.")
 
-            sentences = df['sentence'].dropna().tolist()
-            
-            # Get the average embedding for the whole document
-            doc_embedding = get_document_embedding(sentences, model, tokenizer, device)
-
-            if doc_embedding is not None:
-                result = {
-                    'year': year,
-                    'company_code': company_code,
-                    'company_name': company_name,
-                }
-                # Add embedding vectors to the result dictionary
-                for i, val in enumerate(doc_embedding):
-                    result[f'vec_{i}'] = val
-                all_results.append(result)
+    store, store_location = open_store(args, base_dir)
+    documents = prepare_store(store, store_location, documents, args)
+    if documents is None:
+        return
 
-        except Exception as e:
-            tqdm.write(f"Error processing file {filename}: {e}")
+    cache = open_cache(args)
+    pipeline_stats = PipelineStats(args.prefetch_batches) if args.pipeline else None
+    embeddings = embed(documents, model, tokenizer, device, args, cache=cache, pipeline_stats=pipeline_stats)
 
     # --- 4. Save Results ---
-    if not all_results:
-        print("\nNo embeddings were generated. Exiting.")
-        return
+    # Each finished report is committed right away, so a crash loses at most the current one
+    num_written = 0
+    # Use tqdm for progress bar on files
+    for document, pooled in tqdm(embeddings, total=len(documents), desc="Processing Files", ncols=100):
+        store.append(document['year'], document['company_code'], document['company_name'], pooled)
+        num_written += 1
+
+    if pipeline_stats is not None:
+        print(f"\nPipeline: {pipeline_stats.summary()}")
+    if cache is not None:
+        print(f"\nEmbedding cache: {cache.hits} hits, {cache.misses} misses")
+        cache.close()
+
+    if num_written == 0:
+        print("\nNo new embeddings were generated.")
+    else:
+        print(f"\nSuccessfully appended {num_written} embeddings to {store_location}")
 
-    print("\nSaving aggregated embeddings to CSV...")
-    final_df = pd.DataFrame(all_results)
-    
-    # Dynamically get the number of vector columns from the last processed embedding
-    if 'doc_embedding' in locals() and doc_embedding is not None:
-        vec_cols = [f'vec_{i}' for i in range(len(doc_embedding))]
-        info_cols = ['year', 'company_code', 'company_name']
-        final_df = final_df[info_cols + vec_cols]
-
-    final_df.to_csv(output_file, index=False, encoding='utf-8-sig')
-    print(f"Successfully saved results to {output_file}")
+    if args.store == 'binary' and args.export_csv:
+        store.export_csv(output_file)
+        print(f"Exported {len(store)} embeddings to {output_file}")
+    store.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,297 @@
+"""
+Author: Peter Li
+Date: 2025-12-01 10:12:47
+Description: 离线推理基准：用仓库自带词表构建随机权重的 FinBERT 结构模型，扫描批大小、序列长度、线程数与后端，输出吞吐、延迟分位数与峰值内存（JSON）
+"""
+
+import argparse
+import glob
+import itertools
+import json
+import multiprocessing as mp
+import os
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from encoder_backends import BACKEND_CHOICES
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BASE_DIR)
+FIN_LABELER_DIR = os.path.join(REPO_DIR, 'FinBERT-main', 'Fin-labeler')
+SPM_VOCAB_PATH = os.path.join(REPO_DIR, 'FinBERT-main', 'FinBERT2', 'pretrain_wordpiece_tokenizer', 'unigram_all.vocab')
+SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+# 'base' has the shape of FinBERT2-base; 'tiny' is for quick smoke runs
+MODEL_PRESETS = {
+    'tiny': {'hidden_size': 128, 'num_hidden_layers': 2, 'num_attention_heads': 2, 'intermediate_size': 512},
+    'base': {'hidden_size': 768, 'num_hidden_layers': 12, 'num_attention_heads': 12, 'intermediate_size': 3072},
+}
+TARGETS = ('engine', 'document')
+MAX_POSITIONS = 512
+# How often the parent checks that a configuration's process is still alive
+RESULT_POLL_SECONDS = 5.0
+
+
+def build_wordpiece_vocab(spm_vocab_path=SPM_VOCAB_PATH):
+    """
+    Turns the SentencePiece vocab of the FinBERT2 tokenizer work into a WordPiece
+    vocab: '▁' word-start markers are dropped and ASCII pieces also get a '##'
+    continuation entry. Only the vocabulary matters here, the weights are random.
+    """
+    vocab = dict.fromkeys(SPECIAL_TOKENS)
+    with open(spm_vocab_path, encoding='utf-8') as f:
+        for line in f:
+            piece = line.split('\t', 1)[0]
+            if piece in ('<unk>', '<s>', '</s>'):
+                continue
+            word = piece.lstrip('▁').lower()
+            if not word or any(c.isspace() for c in word):
+                continue
+            vocab[word] = None
+            if not piece.startswith('▁') and word.isascii():
+                vocab['##' + word] = None
+    return list(vocab)
+
+
+def build_random_model(model_dir, preset='base', seed=0):
+    """Saves a randomly initialised BertForSequenceClassification and its tokenizer to model_dir."""
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizer
+
+    os.makedirs(model_dir, exist_ok=True)
+    vocab = build_wordpiece_vocab()
+    vocab_file = os.path.join(model_dir, 'vocab.txt')
+    with open(vocab_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(vocab) + '\n')
+    BertTokenizer(vocab_file).save_pretrained(model_dir)
+
+    torch.manual_seed(seed)
+    config = BertConfig(
+        vocab_size=len(vocab), max_position_embeddings=MAX_POSITIONS, num_labels=2,
+        id2label={0: '负面', 1: '正面'}, label2id={'负面': 0, '正面': 1}, **MODEL_PRESETS[preset]
+    )
+    BertForSequenceClassification(config).eval().save_pretrained(model_dir)
+    return model_dir
+
+
+def load_corpus_text():
+    """Concatenated sentences from csv_output/, or the labelled FinBERT test set if there are none."""
+    sentences = []
+    for path in sorted(glob.glob(os.path.join(BASE_DIR, 'csv_output', '*.csv'))):
+        sentences.extend(pd.read_csv(path)['sentence'].dropna().astype(str).tolist())
+    if not sentences:
+        test_csv = os.path.join(FIN_LABELER_DIR, 'SC_2', 'test_SC_2.csv')
+        sentences = pd.read_csv(test_csv)['text'].dropna().astype(str).tolist()
+    return ''.join(sentences)
+
+
+def make_texts(corpus, seq_len, count):
+    """
+    Cuts `count` texts of seq_len characters from the corpus. Chinese text is
+    about one token per character, so with truncation at seq_len every input
+    is (close to) seq_len tokens long.
+    """
+    step = max(len(corpus) // max(count, 1), 1)
+    texts = []
+    for k in range(count):
+        start = (k * step) % max(len(corpus) - seq_len, 1)
+        texts.append(corpus[start:start + seq_len])
+    return texts
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process (ru_maxrss is KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_config(model_dir, config, corpus, warmup, iterations, result_queue):
+    """
+    Runs one configuration in a fresh process and reports its timings.
+
+    engine: SentimentInferenceEngine.infer_batch on batch_size texts per call.
+    document: get_document_embedding on document_sentences sentences per call,
+    encoded batch_size at a time.
+    """
+    torch.set_num_threads(config['threads'])
+    torch.set_num_interop_threads(1)
+    result = dict(config)
+    try:
+        if config['target'] == 'engine':
+            sys.path.insert(0, FIN_LABELER_DIR)
+            from sequence_inference import SentimentInferenceEngine
+            from transformers import AutoConfig
+
+            # CLS vectors from the last layer, whatever the preset's depth
+            num_layers = AutoConfig.from_pretrained(model_dir).num_hidden_layers
+            engine = SentimentInferenceEngine(
+                model_dir, device='cpu', backend=config['backend'], max_length=config['seq_len'],
+                hidden_layer=num_layers
+            )
+            call_size = config['batch_size']
+
+            def run(texts):
+                engine.infer_batch(texts)
+        else:
+            from transformers import AutoModel, AutoTokenizer
+
+            from analyze_sentiment import get_document_embedding
+            from encoder_backends import prepare_backend
+
+            tokenizer = AutoTokenizer.from_pretrained(model_dir)
+            model = AutoModel.from_pretrained(model_dir).eval()
+            model = prepare_backend(model, tokenizer, config['backend'], 'cpu', model_dir,
+                                    onnx_path=os.path.join(model_dir, 'onnx', 'encoder.onnx'))
+            call_size = config['document_sentences']
+
+            def run(texts):
+                get_document_embedding(texts, model, tokenizer, 'cpu', batch_size=config['batch_size'],
+                                       max_length=config['seq_len'], dedup=False)
+
+        texts = make_texts(corpus, config['seq_len'], call_size * (warmup + iterations))
+        calls = [texts[k * call_size:(k + 1) * call_size] for k in range(warmup + iterations)]
+        for batch in calls[:warmup]:
+            run(batch)
+        latencies = []
+        for batch in calls[warmup:]:
+            start = time.perf_counter()
+            run(batch)
+            latencies.append(time.perf_counter() - start)
+
+        latencies_ms = np.array(latencies) * 1000.0
+        result.update({
+            'sentences_per_sec': call_size * iterations / sum(latencies),
+            'latency_p50_ms': float(np.percentile(latencies_ms, 50)),
+            'latency_p99_ms': float(np.percentile(latencies_ms, 99)),
+            'latency_mean_ms': float(latencies_ms.mean()),
+        })
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['peak_rss_mb'] = peak_rss_mb()
+    result_queue.put(result)
+
+
+def wait_for_result(process, result_queue, config):
+    """
+    Waits for the result of a configuration's process. If the process dies
+    without reporting (OOM kill, crash in a native kernel), returns an error
+    row for the configuration instead of blocking forever.
+    """
+    while True:
+        try:
+            return result_queue.get(timeout=RESULT_POLL_SECONDS)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        # The result may have reached the pipe just before the process exited
+        try:
+            return result_queue.get(timeout=1.0)
+        except queue.Empty:
+            return dict(config, error=f"process died with exit code {process.exitcode}", peak_rss_mb=None)
+
+
+def git_commit():
+    """Returns the current commit hash, or None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Offline CPU benchmark of the sentiment engine and document embedding on a random FinBERT',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--preset', choices=sorted(MODEL_PRESETS), default='base',
+                        help='Model shape: base matches FinBERT2-base, tiny is for smoke runs')
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=list(TARGETS), help='What to benchmark')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 8, 32], help='Batch sizes to sweep')
+    parser.add_argument('--seq_lens', nargs='+', type=int, default=[64, 128, 512], help='Sequence lengths to sweep')
+    parser.add_argument('--threads', nargs='+', type=int, default=[1, max(os.cpu_count() or 1, 1)],
+                        help='torch.set_num_threads values to sweep')
+    parser.add_argument('--backends', nargs='+', choices=BACKEND_CHOICES, default=['fp32'],
+                        help='Backends to sweep')
+    parser.add_argument('--document_sentences', type=int, default=64,
+                        help='Sentences per document for the document target')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed calls per configuration')
+    parser.add_argument('--iterations', type=int, default=10, help='Timed calls per configuration')
+    parser.add_argument('--model_dir', type=str, default=None,
+                        help='Where to build the random model (a temporary directory by default)')
+    parser.add_argument('--output', type=str, default=os.path.join(BASE_DIR, 'benchmark_results.json'),
+                        help='JSON file for the results')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Builds the random model once and runs every configuration of the sweep in its own process.
+    """
+    args = parse_arguments()
+    if any(seq_len > MAX_POSITIONS for seq_len in args.seq_lens):
+        raise ValueError(f"Sequence lengths must be at most {MAX_POSITIONS}")
+
+    model_dir = args.model_dir or tempfile.mkdtemp(prefix='finbert_benchmark_')
+    print(f"Building a random '{args.preset}' model in {model_dir}...")
+    build_random_model(model_dir, args.preset)
+    corpus = load_corpus_text()
+
+    # Inherited by the workers: keeps the per-document progress bars of analyze_sentiment out of the report
+    os.environ['TQDM_DISABLE'] = '1'
+    # spawn gives every configuration a fresh torch runtime and its own peak RSS
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    results = []
+    sweep = itertools.product(args.targets, args.backends, args.threads, args.seq_lens, args.batch_sizes)
+    for target, backend, threads, seq_len, batch_size in sweep:
+        config = {
+            'target': target, 'backend': backend, 'threads': threads, 'seq_len': seq_len,
+            'batch_size': batch_size, 'document_sentences': args.document_sentences if target == 'document' else None,
+        }
+        process = ctx.Process(
+            target=run_config, args=(model_dir, config, corpus, args.warmup, args.iterations, result_queue)
+        )
+        process.start()
+        result = wait_for_result(process, result_queue, config)
+        process.join()
+        results.append(result)
+
+        label = f"{target:8s} {backend:4s} threads={threads:<2d} seq_len={seq_len:<3d} batch={batch_size:<3d}"
+        if 'error' in result:
+            print(f"  {label} failed: {result['error']}")
+        else:
+            print(f"  {label} {result['sentences_per_sec']:8.1f} sent/s  p50 {result['latency_p50_ms']:7.1f} ms  "
+                  f"p99 {result['latency_p99_ms']:7.1f} ms  peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'preset': args.preset,
+            'model_config': MODEL_PRESETS[args.preset],
+            'torch': torch.__version__,
+            'cpu_count': os.cpu_count(),
+            'warmup': args.warmup,
+            'iterations': args.iterations,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nWrote {len(results)} results to {args.output}")
+
+    if args.model_dir is None:
+        shutil.rmtree(model_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Author: Peter Li
+Date: 2025-11-20 10:12:31
+Description: 句子向量的磁盘缓存，按 (模型, max_length, 句子) 的哈希寻址，超出容量时按 LRU 淘汰
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_CACHE_MAX_MB = 2048
+# Part of every key, so rows written with a different feature layout are never read back
+CACHE_FORMAT = 'cls+token_sum+length'
+
+
+class SentenceEmbeddingCache:
+    """
+    On-disk cache mapping sha1(model id, max_length, variant, sentence) to its features.
+
+    Rows (the packed CLS vector, token-state sum and token count produced by
+    pooling.pack_features) are stored as float32 blobs in a SQLite file. Every
+    lookup refreshes the entry's access time, and once the stored rows exceed
+    max_bytes the least recently used entries are evicted. One instance may be
+    shared by the tokenizing producer thread and the encoding thread.
+    """
+
+    def __init__(self, path, model_id, max_length, max_bytes=DEFAULT_CACHE_MAX_MB * 1024 * 1024, variant=''):
+        self.path = path
+        self.model_id = model_id
+        self.max_length = max_length
+        # Any other setting that changes the features, e.g. long-text windowing
+        self.variant = variant
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        cache_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(cache_dir, exist_ok=True)
+        # Several sharded workers may share one cache file; wait on their write locks
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_access INTEGER NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings (last_access)")
+        self.conn.commit()
+        # Running estimate so put_many only scans the table when eviction may be needed
+        self._approx_bytes = self.total_bytes()
+
+    def make_key(self, sentence):
+        """Returns the content address of a sentence for this model, max_length and variant."""
+        settings = f"{self.max_length}\0{self.variant}" if self.variant else f"{self.max_length}"
+        payload = f"{CACHE_FORMAT}\0{self.model_id}\0{settings}\0{sentence}".encode('utf-8')
+        return hashlib.sha1(payload).hexdigest()
+
+    def get_many(self, keys):
+        """
+        Looks up keys and returns {key: float32 vector} for the ones present.
+        """
+        with self._lock:
+            found = {}
+            unique_keys = list(dict.fromkeys(keys))
+            # Stay below SQLite's bound-parameter limit
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i+500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+
+            if found:
+                now = time.time_ns()
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self.conn.commit()
+
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+            return found
+
+    def put_many(self, keys, vectors):
+        """
+        Stores vectors (an array with one row per key) and evicts if over capacity.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            now = time.time_ns()
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) VALUES (?, ?, ?, ?)",
+                [(key, vector.tobytes(), vector.nbytes, now) for key, vector in zip(keys, vectors)]
+            )
+            self.conn.commit()
+            self._approx_bytes += vectors.nbytes
+            if self._approx_bytes > self.max_bytes:
+                self.evict()
+
+    def total_bytes(self):
+        """Returns the number of vector bytes currently stored."""
+        with self._lock:
+            return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            self._approx_bytes = self.total_bytes()
+            excess = self._approx_bytes - self.max_bytes
+            if excess <= 0:
+                return 0
+
+            evicted = []
+            for key, size in self.conn.execute("SELECT key, size FROM embeddings ORDER BY last_access"):
+                if excess <= 0:
+                    break
+                evicted.append((key,))
+                excess -= size
+            self.conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+            self.conn.commit()
+            self._approx_bytes = self.total_bytes()
+            return len(evicted)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
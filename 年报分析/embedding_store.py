@@ -0,0 +1,297 @@
+"""
+Author: Peter Li
+Date: 2025-11-21 16:40:05
+Description: 文档向量的存储后端：float32 二进制矩阵（memmap 读取）+ 键索引，保留 CSV 导出
+"""
+
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+INFO_COLUMNS = ['year', 'company_code', 'company_name']
+
+
+def vector_columns(poolings, dim):
+    """
+    Column names for the pooled vectors written side by side.
+
+    A store holding only cls_mean keeps the original vec_0..vec_{dim-1} names.
+    """
+    if list(poolings) == ['cls_mean']:
+        return [f'vec_{i}' for i in range(dim)]
+    return [f'{pooling}_{i}' for pooling in poolings for i in range(dim)]
+
+
+def poolings_from_columns(columns):
+    """Inverse of vector_columns for a CSV header."""
+    vec_cols = [c for c in columns if c not in INFO_COLUMNS]
+    if not vec_cols:
+        return []
+    if vec_cols[0] == 'vec_0':
+        return ['cls_mean']
+    return list(dict.fromkeys(c.rsplit('_', 1)[0] for c in vec_cols))
+
+
+def _truncate_partial_line(path):
+    """Drops a trailing line left half-written by an interrupted append."""
+    with open(path, 'rb+') as f:
+        content = f.read()
+        if content and not content.endswith(b'\n'):
+            f.truncate(content.rfind(b'\n') + 1)
+
+
+def _read_settings(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_settings(path, settings):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(settings, f)
+
+
+class CSVEmbeddingStore:
+    """
+    The original wide CSV layout: year, company_code, company_name, vec_0..vec_{d-1}
+    (or <pooling>_0.. per pooling when several are stored).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.settings_path = f'{path}.settings.json'
+
+    def completed_keys(self):
+        """Returns the (year, company_code) keys already stored."""
+        if not os.path.exists(self.path):
+            return set()
+
+        _truncate_partial_line(self.path)
+        try:
+            df = pd.read_csv(self.path, usecols=['year', 'company_code'], dtype=str, encoding='utf-8-sig')
+        except pd.errors.EmptyDataError:
+            return set()
+        return set(zip(df['year'], df['company_code']))
+
+    def poolings(self):
+        """Returns the poolings stored in the file, or [] if it is empty."""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return []
+        return poolings_from_columns(pd.read_csv(self.path, nrows=0, encoding='utf-8-sig').columns)
+
+    def settings(self):
+        """Returns the run settings recorded with the file (e.g. the encoder backend), or {}."""
+        return _read_settings(self.settings_path)
+
+    def set_settings(self, settings):
+        _write_settings(self.settings_path, settings)
+
+    def append(self, year, company_code, company_name, pooled):
+        """Appends one document row ({pooling: vector}) and flushes it to disk."""
+        result = {'year': year, 'company_code': company_code, 'company_name': company_name}
+        dim = len(next(iter(pooled.values())))
+        values = np.concatenate([np.asarray(v, dtype=np.float32) for v in pooled.values()])
+        result.update(zip(vector_columns(pooled.keys(), dim), values))
+
+        write_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='', encoding='utf-8-sig') as f:
+            pd.DataFrame([result]).to_csv(f, header=write_header, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self):
+        for path in (self.path, self.settings_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        pass
+
+
+class BinaryEmbeddingStore:
+    """
+    Document embeddings as one contiguous float32 matrix plus a key index.
+
+    The directory holds vectors.f32 (one row per document, appended in commit
+    order; with several poolings their `dim`-wide vectors sit side by side),
+    index.csv (year, company_code, company_name, row), meta.json (dim,
+    poolings) and settings.json (run settings such as the encoder backend).
+    A vector is fsynced before its index line, so on open any rows past the
+    last committed index line are cut off. Readers get rows of a read-only
+    memmap, i.e. slices that do not copy the data.
+    """
+
+    VECTORS_FILE = 'vectors.f32'
+    INDEX_FILE = 'index.csv'
+    META_FILE = 'meta.json'
+    SETTINGS_FILE = 'settings.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, self.VECTORS_FILE)
+        self.index_path = os.path.join(directory, self.INDEX_FILE)
+        self.meta_path = os.path.join(directory, self.META_FILE)
+        self.settings_path = os.path.join(directory, self.SETTINGS_FILE)
+        os.makedirs(directory, exist_ok=True)
+
+        self.dim = None
+        self.stored_poolings = []
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            self.dim = meta['dim']
+            self.stored_poolings = meta.get('poolings', ['cls_mean'])
+
+        self.entries = []
+        self.row_of = {}
+        if os.path.exists(self.index_path):
+            _truncate_partial_line(self.index_path)
+            with open(self.index_path, newline='', encoding='utf-8') as f:
+                for year, company_code, company_name, row in csv.reader(f):
+                    self._add_entry(year, company_code, company_name, int(row))
+
+        # Drop vectors written by an interrupted append that never reached the index
+        if self.dim is not None and os.path.exists(self.vectors_path):
+            committed_bytes = len(self.entries) * self.row_width * 4
+            if os.path.getsize(self.vectors_path) > committed_bytes:
+                with open(self.vectors_path, 'rb+') as f:
+                    f.truncate(committed_bytes)
+        self._memmap = None
+
+    def _add_entry(self, year, company_code, company_name, row):
+        self.entries.append((year, company_code, company_name))
+        self.row_of[(year, company_code)] = row
+
+    @property
+    def row_width(self):
+        return self.dim * len(self.stored_poolings)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.row_of
+
+    def completed_keys(self):
+        """Returns the (year, company_code) keys already stored."""
+        return set(self.row_of)
+
+    def poolings(self):
+        """Returns the poolings stored side by side in each row."""
+        return list(self.stored_poolings)
+
+    def settings(self):
+        """Returns the run settings recorded with the store (e.g. the encoder backend), or {}."""
+        return _read_settings(self.settings_path)
+
+    def set_settings(self, settings):
+        _write_settings(self.settings_path, settings)
+
+    def append(self, year, company_code, company_name, pooled):
+        """Appends one document ({pooling: vector}) and commits it to disk."""
+        vectors = [np.asarray(v, dtype=np.float32).reshape(-1) for v in pooled.values()]
+        if self.dim is None:
+            self.dim = int(vectors[0].shape[0])
+            self.stored_poolings = list(pooled.keys())
+            with open(self.meta_path, 'w', encoding='utf-8') as f:
+                json.dump({'dim': self.dim, 'poolings': self.stored_poolings, 'dtype': 'float32'}, f)
+        elif list(pooled.keys()) != self.stored_poolings:
+            raise ValueError(f"Store holds poolings {self.stored_poolings}, got {list(pooled.keys())}")
+        if any(v.shape[0] != self.dim for v in vectors):
+            raise ValueError(f"Expected {self.dim}-dim vectors, got {[v.shape[0] for v in vectors]}")
+        vector = np.concatenate(vectors)
+
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vector.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        row = len(self.entries)
+        with open(self.index_path, 'a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow([year, company_code, company_name, row])
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._add_entry(year, company_code, company_name, row)
+        self._memmap = None
+
+    def matrix(self):
+        """Returns all rows as a read-only (n_documents, dim * n_poolings) float32 memmap."""
+        if not self.entries:
+            return np.empty((0, self.row_width if self.dim else 0), dtype=np.float32)
+        if self._memmap is None:
+            self._memmap = np.memmap(
+                self.vectors_path, dtype=np.float32, mode='r', shape=(len(self.entries), self.row_width)
+            )
+        return self._memmap
+
+    def _pooling_slice(self, pooling):
+        if pooling is None:
+            pooling = self.stored_poolings[0]
+        k = self.stored_poolings.index(pooling)
+        return slice(k * self.dim, (k + 1) * self.dim)
+
+    def pooling_matrix(self, pooling=None):
+        """Returns the (n_documents, dim) column block of one pooling as a view."""
+        return self.matrix()[:, self._pooling_slice(pooling)]
+
+    def get(self, year, company_code, pooling=None):
+        """Returns one document's vector (first pooling by default) as a zero-copy view."""
+        return self.matrix()[self.row_of[(year, company_code)], self._pooling_slice(pooling)]
+
+    def index_frame(self):
+        """Returns the key index as a DataFrame aligned with matrix() rows."""
+        return pd.DataFrame(self.entries, columns=INFO_COLUMNS)
+
+    def export_csv(self, output_file, chunk_size=1000):
+        """Writes the store in the original finbert_embeddings.csv layout."""
+        index = self.index_frame()
+        matrix = self.matrix()
+        vec_cols = vector_columns(self.stored_poolings, self.dim) if self.dim else []
+        with open(output_file, 'w', newline='', encoding='utf-8-sig') as f:
+            for start in range(0, max(len(index), 1), chunk_size):
+                chunk = index.iloc[start:start+chunk_size].reset_index(drop=True)
+                vectors = pd.DataFrame(np.asarray(matrix[start:start+chunk_size]), columns=vec_cols)
+                pd.concat([chunk, vectors], axis=1).to_csv(f, header=(start == 0), index=False)
+
+    def clear(self):
+        self._memmap = None
+        for path in (self.vectors_path, self.index_path, self.meta_path, self.settings_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.dim = None
+        self.stored_poolings = []
+        self.entries = []
+        self.row_of = {}
+
+    def close(self):
+        self._memmap = None
+
+
+def main():
+    """
+    Exports a binary store to the finbert_embeddings.csv layout.
+    """
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(
+        description='Export a binary document-embedding store to CSV',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--store_dir', type=str, default=os.path.join(base_dir, 'finbert_embeddings'),
+                        help='Directory of the binary store')
+    parser.add_argument('--output_csv', type=str, default=os.path.join(base_dir, 'finbert_embeddings.csv'),
+                        help='CSV file to write')
+    args = parser.parse_args()
+
+    store = BinaryEmbeddingStore(args.store_dir)
+    store.export_csv(args.output_csv)
+    print(f"Exported {len(store)} embeddings to {args.output_csv}")
+
+
+if __name__ == "__main__":
+    main()
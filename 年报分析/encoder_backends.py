@@ -0,0 +1,186 @@
+"""
+Author: Peter Li
+Date: 2025-11-28 11:20:36
+Description: FinBERT 编码器的 CPU 推理后端（fp32 / 动态 int8 量化 / ONNX Runtime）及与 fp32 的一致性检查
+"""
+
+import argparse
+import os
+import re
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+BACKEND_CHOICES = ('fp32', 'int8', 'onnx')
+DEFAULT_BACKEND = 'fp32'
+ONNX_INPUT_NAMES = ('input_ids', 'attention_mask', 'token_type_ids')
+
+
+def quantize_dynamic_int8(model):
+    """Quantizes every nn.Linear of the encoder to int8 with dynamic activation scales."""
+    return torch.ao.quantization.quantize_dynamic(model.to('cpu').eval(), {torch.nn.Linear}, dtype=torch.qint8).eval()
+
+
+class _EncoderExportWrapper(torch.nn.Module):
+    """Positional-input wrapper returning last_hidden_state, for ONNX export."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(
+            input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids
+        ).last_hidden_state
+
+
+def export_encoder_onnx(model, tokenizer, onnx_path, opset=17):
+    """
+    Exports the encoder to ONNX with dynamic batch and sequence axes. The graph
+    is written to a temporary file and renamed into place, so readers never
+    see a partial file.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+    tmp_path = f'{onnx_path}.{os.getpid()}.tmp'
+    # The exporter follows the wrapper's training flag, so it must be in eval mode too
+    wrapper = _EncoderExportWrapper(model.to('cpu').eval()).eval()
+    example = tokenizer(["示例文本", "样例"], padding=True, return_tensors="pt")
+    example_inputs = tuple(example.get(name, torch.zeros_like(example['input_ids'])) for name in ONNX_INPUT_NAMES)
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in ONNX_INPUT_NAMES}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                wrapper, example_inputs, tmp_path,
+                input_names=list(ONNX_INPUT_NAMES), output_names=['last_hidden_state'],
+                dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False
+            )
+        os.replace(tmp_path, onnx_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class OnnxEncoder:
+    """
+    Callable stand-in for AutoModel backed by ONNX Runtime; calls return an
+    object with last_hidden_state like the PyTorch model.
+    """
+
+    def __init__(self, onnx_path, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        # Follow the torch thread budget, e.g. the one set per worker by sharded_runner.py
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    def __call__(self, input_ids=None, attention_mask=None, token_type_ids=None, **kwargs):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        feed = {'input_ids': input_ids, 'attention_mask': attention_mask, 'token_type_ids': token_type_ids}
+        feed = {
+            name: value.detach().cpu().numpy().astype(np.int64)
+            for name, value in feed.items() if name in self.input_names
+        }
+        last_hidden_state = self.session.run(['last_hidden_state'], feed)[0]
+        return SimpleNamespace(last_hidden_state=torch.from_numpy(last_hidden_state))
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        if torch.device(device).type != 'cpu':
+            raise ValueError("The ONNX backend only runs on CPU")
+        return self
+
+
+def default_onnx_path(model_name):
+    """Returns where the ONNX graph of an encoder is cached by default."""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    safe_name = re.sub(r'[^\w.-]+', '_', model_name)
+    return os.path.join(base_dir, 'onnx_models', f'{safe_name}.onnx')
+
+
+def prepare_backend(model, tokenizer, backend, device, model_name, onnx_path=None):
+    """
+    Converts a loaded fp32 encoder to the requested backend. int8 and onnx run on CPU only.
+    """
+    if backend not in BACKEND_CHOICES:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {BACKEND_CHOICES}")
+    if backend == 'fp32':
+        return model
+    if torch.device(device).type != 'cpu':
+        raise ValueError(f"The {backend} backend only runs on CPU, got device {device}")
+
+    if backend == 'int8':
+        return quantize_dynamic_int8(model)
+
+    onnx_path = onnx_path or default_onnx_path(model_name)
+    if not os.path.exists(onnx_path):
+        print(f"Exporting ONNX encoder to {onnx_path}...")
+        export_encoder_onnx(model, tokenizer, onnx_path)
+    return OnnxEncoder(onnx_path)
+
+
+def check_parity(sentences, backends=('int8', 'onnx'), batch_size=32, max_length=512):
+    """
+    Encodes the sentences with every backend and compares the CLS vectors with
+    fp32. Returns {backend: {'cls_cosine_mean', 'cls_cosine_min', 'doc_mean_cosine'}}.
+    """
+    from analyze_sentiment import encode_sentences, load_encoder
+
+    def run(backend):
+        tokenizer, model = load_encoder("cpu", backend=backend)
+        return encode_sentences(sentences, model, tokenizer, "cpu", batch_size=batch_size, max_length=max_length)
+
+    reference = run('fp32')
+    report = {}
+    for backend in backends:
+        vectors = run(backend)
+        cosine = F.cosine_similarity(vectors, reference, dim=-1)
+        report[backend] = {
+            'cls_cosine_mean': float(cosine.mean()),
+            'cls_cosine_min': float(cosine.min()),
+            'doc_mean_cosine': float(F.cosine_similarity(vectors.mean(0), reference.mean(0), dim=0)),
+        }
+    return report
+
+
+def main():
+    """
+    Compares the int8 / ONNX encoder with fp32 on sentences sampled from csv_output/.
+    """
+    import pandas as pd
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(
+        description='Compare int8 / ONNX encoder backends against fp32',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--backends', nargs='+', choices=BACKEND_CHOICES[1:], default=list(BACKEND_CHOICES[1:]),
+                        help='Backends to compare with fp32')
+    parser.add_argument('--num_sentences', type=int, default=256, help='Sentences sampled from csv_output/')
+    parser.add_argument('--seed', type=int, default=42, help='Sampling seed')
+    args = parser.parse_args()
+
+    input_csv_dir = os.path.join(base_dir, 'csv_output')
+    sentences = []
+    for filename in sorted(f for f in os.listdir(input_csv_dir) if f.endswith('.csv')):
+        df = pd.read_csv(os.path.join(input_csv_dir, filename))
+        if 'sentence' in df.columns:
+            sentences.extend(df['sentence'].dropna().astype(str).tolist())
+    rng = np.random.default_rng(args.seed)
+    sample = [sentences[i] for i in rng.choice(len(sentences), min(args.num_sentences, len(sentences)), replace=False)]
+
+    for backend, metrics in check_parity(sample, args.backends).items():
+        print(f"{backend}: " + ", ".join(f"{name}={value:.5f}" for name, value in metrics.items()))
+
+
+if __name__ == "__main__":
+    main()
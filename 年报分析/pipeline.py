@@ -0,0 +1,134 @@
+"""
+Author: Peter Li
+Date: 2025-11-29 10:05:12
+Description: 后台生产者线程 + 有界队列，让读 CSV 与分词提前进行，主线程只做前向计算；记录队列深度与两端等待时间
+"""
+
+import queue
+import threading
+import time
+
+DEFAULT_QUEUE_SIZE = 8
+# How often a blocked producer re-checks whether the consumer has gone away
+_PUT_POLL_SECONDS = 0.1
+
+
+class PipelineStats:
+    """
+    Counters of one producer/consumer run.
+
+    producer_stall_seconds is time the producer waited on a full queue (the
+    model is the bottleneck); consumer_stall_seconds is time the consumer waited
+    on an empty queue (reading and tokenizing is the bottleneck). Queue depth is
+    sampled every time the consumer takes an item.
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.items = 0
+        self.producer_stall_seconds = 0.0
+        self.consumer_stall_seconds = 0.0
+        self.depth_total = 0
+        self.depth_max = 0
+
+    @property
+    def mean_depth(self):
+        return self.depth_total / self.items if self.items else 0.0
+
+    def as_dict(self):
+        return {
+            'items': self.items,
+            'queue_size': self.maxsize,
+            'mean_depth': self.mean_depth,
+            'max_depth': self.depth_max,
+            'producer_stall_seconds': self.producer_stall_seconds,
+            'consumer_stall_seconds': self.consumer_stall_seconds,
+        }
+
+    def summary(self):
+        return (f"{self.items} items, queue depth mean {self.mean_depth:.1f} / max {self.depth_max} "
+                f"of {self.maxsize}, producer stalled {self.producer_stall_seconds:.1f}s, "
+                f"consumer stalled {self.consumer_stall_seconds:.1f}s")
+
+
+class _ProducerError:
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+class BackgroundProducer:
+    """
+    Iterates `items` (any iterable) in a daemon thread and hands the values to
+    the consuming thread through a queue of at most maxsize entries.
+
+    An exception raised by the producer is re-raised in the consumer. If the
+    consumer stops early (break, close() or garbage collection of the
+    generator), the producer thread is told to stop and is joined.
+    """
+
+    def __init__(self, items, maxsize=DEFAULT_QUEUE_SIZE, stats=None):
+        self.items = items
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stats = stats if stats is not None else PipelineStats(maxsize)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pipeline-producer', daemon=True)
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        start = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.queue.put(item, timeout=_PUT_POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            self.stats.producer_stall_seconds += time.perf_counter() - start
+
+    def _run(self):
+        try:
+            for item in self.items:
+                if not self._put(item):
+                    return
+        except BaseException as e:
+            self._put(_ProducerError(e))
+            return
+        self._put(_DONE)
+
+    def __iter__(self):
+        self._thread.start()
+        try:
+            while True:
+                depth = self.queue.qsize()
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    start = time.perf_counter()
+                    item = self.queue.get()
+                    self.stats.consumer_stall_seconds += time.perf_counter() - start
+
+                if item is _DONE:
+                    return
+                if isinstance(item, _ProducerError):
+                    raise item.error
+                self.stats.items += 1
+                self.stats.depth_total += depth
+                self.stats.depth_max = max(self.stats.depth_max, depth)
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the producer thread and waits for it to exit."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
@@ -0,0 +1,143 @@
+"""
+Author: Peter Li
+Date: 2025-11-24 09:31:17
+Description: 文档级向量的流式池化，只保留运行统计量，一次编码同时得到多种池化结果
+"""
+
+import numpy as np
+import torch
+
+DEFAULT_POOLINGS = ('cls_mean',)
+POOLING_CHOICES = ('cls_mean', 'cls_max', 'cls_len_weighted', 'token_mean')
+WINDOW_AGGREGATIONS = ('mean', 'max', 'length_weighted')
+
+
+def sentence_features(last_hidden_state, attention_mask, cls_index=0):
+    """
+    Extracts the per-sentence features the poolers need from one encoder batch.
+
+    Returns a dict with 'cls' (B, H), 'token_sum' (B, H), the sum of the hidden
+    states over attended tokens, and 'length' (B,), the attended token count.
+    """
+    mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+    return {
+        'cls': last_hidden_state[:, cls_index, :].cpu(),
+        'token_sum': (last_hidden_state * mask).sum(dim=1).cpu(),
+        'length': attention_mask.sum(dim=1).cpu(),
+    }
+
+
+def aggregate_windows(features, owners, num_sentences, aggregation='mean'):
+    """
+    Combines the features of a sentence's overlapping windows into one row.
+
+    owners (W,) gives the sentence of every window row. The sentence CLS vector
+    is the mean, element-wise max or token-count-weighted mean
+    ('length_weighted') of its window CLS vectors; token_sum and length add up
+    over the windows, so overlapping tokens count once per window.
+    """
+    if aggregation not in WINDOW_AGGREGATIONS:
+        raise ValueError(f"Unknown window aggregation '{aggregation}', expected one of {WINDOW_AGGREGATIONS}")
+    cls = features['cls']
+    lengths = features['length']
+    hidden = cls.shape[1]
+
+    if aggregation == 'max':
+        index = owners.unsqueeze(-1).expand(-1, hidden)
+        sentence_cls = cls.new_full((num_sentences, hidden), float('-inf')).scatter_reduce(0, index, cls, 'amax')
+    else:
+        weights = lengths.to(cls.dtype) if aggregation == 'length_weighted' else torch.ones_like(cls[:, 0])
+        totals = cls.new_zeros(num_sentences).index_add(0, owners, weights)
+        sentence_cls = cls.new_zeros((num_sentences, hidden)).index_add(0, owners, cls * weights.unsqueeze(-1))
+        sentence_cls = sentence_cls / totals.unsqueeze(-1)
+
+    return {
+        'cls': sentence_cls,
+        'token_sum': features['token_sum'].new_zeros((num_sentences, hidden)).index_add(
+            0, owners, features['token_sum']
+        ),
+        'length': lengths.new_zeros(num_sentences).index_add(0, owners, lengths),
+    }
+
+
+def pack_features(features):
+    """Packs a features dict into (B, 2H + 1) float32 rows, e.g. for the cache."""
+    return np.concatenate([
+        features['cls'].numpy(),
+        features['token_sum'].numpy(),
+        features['length'].numpy().astype(np.float32)[:, None],
+    ], axis=1).astype(np.float32)
+
+
+def unpack_features(rows):
+    """Inverse of pack_features."""
+    hidden = (rows.shape[1] - 1) // 2
+    rows = torch.from_numpy(np.ascontiguousarray(rows, dtype=np.float32))
+    return {
+        'cls': rows[:, :hidden],
+        'token_sum': rows[:, hidden:2 * hidden],
+        'length': rows[:, 2 * hidden].round().long(),
+    }
+
+
+class DocumentPooler:
+    """
+    Pools sentence features into document vectors from running statistics.
+
+    Memory does not grow with the number of sentences. Supported poolings:
+    - cls_mean: mean of the sentence CLS vectors (the original document vector)
+    - cls_max: element-wise max of the sentence CLS vectors
+    - cls_len_weighted: CLS vectors weighted by their sentence token count
+    - token_mean: mean of all attended token states in the document
+    """
+
+    def __init__(self, poolings=DEFAULT_POOLINGS):
+        unknown = set(poolings) - set(POOLING_CHOICES)
+        if unknown:
+            raise ValueError(f"Unknown pooling(s): {sorted(unknown)}")
+        self.poolings = list(poolings)
+        self.count = 0
+        self.total_length = 0
+        self.cls_sum = None
+        self.cls_max = None
+        self.cls_weighted_sum = None
+        self.token_sum = None
+
+    def update(self, features):
+        """
+        Adds one batch of sentence features (see sentence_features).
+
+        An optional 'count' entry (B,) counts each row as that many occurrences
+        of the sentence, so a deduplicated document pools to the same vectors.
+        """
+        cls = features['cls'].double()
+        lengths = features['length'].double()
+        counts = features['count'].double() if 'count' in features else torch.ones_like(lengths)
+        if self.cls_sum is None:
+            self.cls_sum = cls.new_zeros(cls.shape[1])
+            self.cls_weighted_sum = cls.new_zeros(cls.shape[1])
+            self.token_sum = cls.new_zeros(cls.shape[1])
+
+        self.count += int(counts.sum().item())
+        self.total_length += int((lengths * counts).sum().item())
+        self.cls_sum += (cls * counts.unsqueeze(-1)).sum(dim=0)
+        if 'cls_max' in self.poolings:
+            # Repeats cannot change a maximum, so counts do not apply here
+            batch_max = cls.max(dim=0).values
+            self.cls_max = batch_max if self.cls_max is None else torch.maximum(self.cls_max, batch_max)
+        if 'cls_len_weighted' in self.poolings:
+            self.cls_weighted_sum += (cls * (lengths * counts).unsqueeze(-1)).sum(dim=0)
+        if 'token_mean' in self.poolings:
+            self.token_sum += (features['token_sum'].double() * counts.unsqueeze(-1)).sum(dim=0)
+
+    def result(self):
+        """Returns {pooling: float32 vector} in the requested order, or None if empty."""
+        if self.count == 0:
+            return None
+        pooled = {
+            'cls_mean': lambda: self.cls_sum / self.count,
+            'cls_max': lambda: self.cls_max,
+            'cls_len_weighted': lambda: self.cls_weighted_sum / self.total_length,
+            'token_mean': lambda: self.token_sum / self.total_length,
+        }
+        return {name: pooled[name]().float().numpy() for name in self.poolings}
@@ -0,0 +1,227 @@
+"""
+Author: Peter Li
+Date: 2025-11-26 15:08:42
+Description: 多进程 CPU 分片计算文档向量：每个进程固定线程数并绑定核心，各自加载一次模型，结束后按固定顺序合并
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import time
+
+import torch
+
+from analyze_sentiment import (MODEL_NAME, add_embedding_arguments, add_output_arguments, embed, list_documents,
+                               load_encoder, open_cache, open_store, prepare_store)
+from embedding_store import BinaryEmbeddingStore
+from encoder_backends import default_onnx_path
+from pipeline import PipelineStats
+
+SHARD_ROOT_NAME = 'finbert_embeddings_shards'
+
+
+def shard_documents(documents, num_shards):
+    """
+    Splits documents into num_shards lists of roughly equal total file size.
+
+    Largest files are assigned first, each to the currently lightest shard;
+    ties break on input order, so the split is deterministic. Every shard keeps
+    its documents in input order.
+    """
+    sizes = [os.path.getsize(d['file_path']) for d in documents]
+    loads = [0] * num_shards
+    assignment = [[] for _ in range(num_shards)]
+    for i in sorted(range(len(documents)), key=lambda i: (-sizes[i], i)):
+        shard = min(range(num_shards), key=lambda k: (loads[k], k))
+        assignment[shard].append(i)
+        loads[shard] += sizes[i]
+    return [[documents[i] for i in sorted(indices)] for indices in assignment]
+
+
+def assign_cores(num_workers, threads_per_worker):
+    """
+    Returns a disjoint block of threads_per_worker cores per worker, or None per
+    worker where the platform cannot pin processes. Blocks wrap around when
+    more threads are requested than cores are available.
+    """
+    if not hasattr(os, 'sched_getaffinity'):
+        return [None] * num_workers
+    cores = sorted(os.sched_getaffinity(0))
+    return [
+        [cores[(k * threads_per_worker + t) % len(cores)] for t in range(threads_per_worker)]
+        for k in range(num_workers)
+    ]
+
+
+def run_worker(worker_id, documents, shard_dir, cores, threads, args, stats_queue):
+    """
+    Embeds one shard into its own binary store and reports its throughput.
+    """
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    tokenizer, model = load_encoder("cpu", backend=args.backend)
+    store = BinaryEmbeddingStore(shard_dir)
+    completed_keys = store.completed_keys()
+    documents = [d for d in documents if (d['year'], d['company_code']) not in completed_keys]
+    cache = open_cache(args)
+    pipeline_stats = PipelineStats(args.prefetch_batches) if args.pipeline else None
+
+    start = time.perf_counter()
+    num_documents = 0
+    embeddings = embed(documents, model, tokenizer, "cpu", args, cache=cache, pipeline_stats=pipeline_stats)
+    for document, pooled in embeddings:
+        store.append(document['year'], document['company_code'], document['company_name'], pooled)
+        num_documents += 1
+    elapsed = time.perf_counter() - start
+
+    if cache is not None:
+        cache.close()
+    store.close()
+    stats_queue.put({
+        'worker': worker_id,
+        'documents': num_documents,
+        'seconds': elapsed,
+        'cores': cores,
+        'threads': threads,
+        'pipeline': pipeline_stats.summary() if pipeline_stats is not None else None,
+    })
+
+
+def merge_shards(store, documents, shard_dirs):
+    """
+    Appends the shard results to the main store in the order of `documents`,
+    so the output does not depend on the number of workers or their timing.
+    Returns the number of documents merged.
+    """
+    shards = [BinaryEmbeddingStore(shard_dir) for shard_dir in shard_dirs]
+    num_merged = 0
+    for document in documents:
+        key = (document['year'], document['company_code'])
+        for shard in shards:
+            if key in shard:
+                pooled = {
+                    pooling: shard.get(*key, pooling=pooling) for pooling in shard.poolings()
+                }
+                store.append(document['year'], document['company_code'], document['company_name'], pooled)
+                num_merged += 1
+                break
+    for shard in shards:
+        shard.close()
+    return num_merged
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Embed the sentence CSVs with several CPU worker processes',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=2,
+        help='Number of worker processes, each loading its own model'
+    )
+    parser.add_argument(
+        '--threads_per_worker',
+        type=int,
+        default=max((os.cpu_count() or 2) // 2, 1),
+        help='torch.set_num_threads budget and number of pinned cores per worker'
+    )
+    add_embedding_arguments(parser)
+    add_output_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    """
+    Shards csv_output/ across worker processes and merges their results.
+    """
+    args = parse_arguments()
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    input_csv_dir = os.path.join(base_dir, 'csv_output')
+    output_file = os.path.join(base_dir, 'finbert_embeddings.csv')
+    shard_root = os.path.join(base_dir, SHARD_ROOT_NAME)
+
+    if not os.path.exists(input_csv_dir):
+        print(f"Error: Input directory not found at '{input_csv_dir}'")
+        print("Please run the 'process_reports.py' script first to generate the sentence CSVs.")
+        return
+
+    all_documents = list_documents(input_csv_dir)
+    print(f"Found {len(all_documents)} CSV files to process in '{input_csv_dir}'.")
+
+    store, store_location = open_store(args, base_dir)
+    if args.rebuild and os.path.exists(shard_root):
+        shutil.rmtree(shard_root)
+    documents = prepare_store(store, store_location, all_documents, args)
+    if documents is None:
+        return
+    if not documents:
+        print("\nNo new embeddings were generated.")
+        return
+
+    # Shards are keyed by worker count, so a resumed run must use the same --workers
+    shards = shard_documents(documents, args.workers)
+    shard_dirs = [os.path.join(shard_root, f'shard_{k}_of_{args.workers}') for k in range(args.workers)]
+    core_blocks = assign_cores(args.workers, args.threads_per_worker)
+
+    if args.backend == 'onnx' and not os.path.exists(default_onnx_path(MODEL_NAME)):
+        # Export once here; the workers would otherwise all export the same file at once
+        load_encoder("cpu", backend=args.backend)
+
+    print(f"Running {args.workers} workers x {args.threads_per_worker} threads ({MODEL_NAME})...")
+    # spawn gives every worker a fresh torch runtime instead of a forked thread pool
+    ctx = mp.get_context('spawn')
+    stats_queue = ctx.Queue()
+    workers = []
+    for k in range(args.workers):
+        if not shards[k]:
+            continue
+        process = ctx.Process(
+            target=run_worker,
+            args=(k, shards[k], shard_dirs[k], core_blocks[k], args.threads_per_worker, args, stats_queue)
+        )
+        process.start()
+        workers.append(process)
+
+    for process in workers:
+        process.join()
+    # The stats messages are tiny, so joining before draining cannot block on the pipe
+    stats = []
+    while True:
+        try:
+            stats.append(stats_queue.get_nowait())
+        except queue.Empty:
+            break
+
+    for entry in sorted(stats, key=lambda e: e['worker']):
+        rate = entry['documents'] / entry['seconds'] if entry['seconds'] > 0 else 0.0
+        print(f"  worker {entry['worker']}: {entry['documents']} documents in {entry['seconds']:.1f}s "
+              f"({rate:.2f} docs/s), {entry['threads']} threads, cores {entry['cores']}")
+        if entry['pipeline']:
+            print(f"    pipeline: {entry['pipeline']}")
+
+    num_merged = merge_shards(store, documents, shard_dirs)
+    print(f"\nSuccessfully merged {num_merged} embeddings into {store_location}")
+
+    failed = [p for p in workers if p.exitcode != 0]
+    if failed:
+        print(f"Warning: {len(failed)} worker(s) failed; shard results were kept in {shard_root} for a re-run.")
+    else:
+        shutil.rmtree(shard_root, ignore_errors=True)
+
+    if args.store == 'binary' and args.export_csv:
+        store.export_csv(output_file)
+        print(f"Exported {len(store)} embeddings to {output_file}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()